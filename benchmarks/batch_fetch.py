@@ -0,0 +1,77 @@
+import time
+import logging
+from typing import Generator, Sequence
+
+import typer
+from sqlalchemy import text, RowMapping
+from sqlalchemy.orm import Session
+from nacsos_data.db import DatabaseEngine
+
+from common.config import settings
+from common.batches import iter_batches, ensure_created_at_index
+
+QUERIES = {
+    # 03_classify_sentiment
+    'item_id': ("SELECT item_id, text FROM item WHERE project_id = :project_id ",
+                [('item_id', 'item.item_id')]),
+    # 04_embed
+    'created_at': ("SELECT item.item_id, item.text, ti.created_at "
+                   "FROM item JOIN twitter_item ti on item.item_id = ti.item_id "
+                   "WHERE item.project_id = :project_id ",
+                   [('created_at', 'ti.created_at'), ('item_id', 'ti.item_id')])
+}
+
+
+def offset_batches(session: Session, query: str, keys: list[tuple[str, str]], params: dict, batch_size: int,
+                   num_rows: int) -> Generator[Sequence[RowMapping], None, None]:
+    # the way 03 and 04 used to page through the corpus
+    order = ', '.join(expression for _, expression in keys)
+    for batch_from in range(0, num_rows, batch_size):
+        yield session.execute(text(f'{query} ORDER BY {order} OFFSET :batch_start LIMIT :batch_size;'),
+                              {**params, 'batch_start': batch_from, 'batch_size': batch_size}).mappings().all()
+
+
+# Compares the total time to fetch all tweets of the project (or the first `max_rows`) in batches
+# with OFFSET pagination against keyset pagination (`common.batches.iter_batches`), for the queries of 03 and 04.
+def main(batch_size: int = 500,
+         max_rows: int | None = None,
+         create_index: bool = True,
+         log_level: str = 'INFO'):
+    logging.basicConfig(format='%(asctime)s [%(levelname)s] %(name)s: %(message)s', level=log_level)
+    logger = logging.getLogger('bench-batches')
+
+    db_engine = DatabaseEngine(host=settings.HOST, port=settings.PORT,
+                               user=settings.USER, password=settings.PASSWORD,
+                               database=settings.DATABASE)
+    params = {'project_id': settings.PROJECT_ID}
+
+    with db_engine.session() as session:  # type: Session
+        if create_index:
+            ensure_created_at_index(session)
+        num_rows = session.execute(text('SELECT count(1) FROM item WHERE project_id = :project_id;'),
+                                   params).scalar()
+        if max_rows is not None:
+            num_rows = min(num_rows, max_rows)
+        logger.info(f'Fetching {num_rows:,} tweets in batches of {batch_size}.')
+
+        for name, (query, keys) in QUERIES.items():
+            durations = {}
+            for method in ['offset', 'keyset']:
+                if method == 'offset':
+                    batches = offset_batches(session, query, keys, params, batch_size, num_rows)
+                else:
+                    batches = iter_batches(session, query, keys, params, batch_size=batch_size)
+                fetched = 0
+                start = time.perf_counter()
+                for batch in batches:
+                    fetched += len(batch)
+                    if fetched >= num_rows:
+                        break
+                durations[method] = time.perf_counter() - start
+                logger.info(f'{name} / {method}: {fetched:,} rows in {durations[method]:.2f}s '
+                            f'-> {fetched / max(durations[method], 1e-9):,.0f} rows/s')
+            logger.info(f'{name}: keyset is {durations["offset"] / max(durations["keyset"], 1e-9):.1f}x faster')
+
+
+if __name__ == '__main__':
+    typer.run(main)
@@ -0,0 +1,45 @@
+import time
+import logging
+from pathlib import Path
+
+import typer
+
+from common.config import settings
+from common.mock_api import fake_tweets
+from common.models import Classifier, agreement
+
+
+# Measures texts/s of the inference backends of `Classifier` (see `Classifier.load`) on synthetic tweets
+# and checks that they agree with the PyTorch backend, on the top label and on the scores.
+def main(num_texts: int = 2000,
+         model: str = 'cardiffnlp/twitter-roberta-base-sentiment-latest',
+         backends: str = 'torch,onnx,onnx-int8',
+         num_threads: int | None = None,
+         min_agreement: float = 0.98,  # fail if a backend agrees with PyTorch on fewer top labels
+         log_level: str = 'INFO'):
+    logging.basicConfig(format='%(asctime)s [%(levelname)s] %(name)s: %(message)s', level=log_level)
+    logger = logging.getLogger('bench-backends')
+
+    texts = Classifier.preprocess(fake_tweets(num_texts))
+    reference = None
+    baseline = None
+    for backend in ['torch'] + [b for b in backends.split(',') if b != 'torch']:
+        classifier = Classifier(hf_name=model, cache_dir=Path(settings.DATA_MODELS) / 'cardiff_latest')
+        classifier.load(backend=backend, num_threads=num_threads)
+        classifier.classify(texts[:32], return_all_scores=True)  # warm up
+
+        start = time.perf_counter()
+        scores = classifier.classify(texts, return_all_scores=True)
+        duration = time.perf_counter() - start
+        reference = reference or scores
+        baseline = baseline or duration
+
+        same_label, deviation = agreement(scores, reference)
+        logger.info(f'{backend}: {num_texts / duration:,.1f} texts/s (speedup {baseline / duration:.2f}x), '
+                    f'top label agrees for {same_label:.2%}, max score deviation {deviation:.3f}')
+        if same_label < min_agreement:
+            raise typer.Exit(code=1)
+
+
+if __name__ == '__main__':
+    typer.run(main)
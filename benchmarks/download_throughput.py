@@ -0,0 +1,55 @@
+import time
+import asyncio
+import logging
+import tempfile
+from pathlib import Path
+
+import typer
+
+from common.mock_api import make_app, start_server
+from common.async_twitter import download_entries, TokenBucket
+
+
+# Measures the throughput of the asynchronous download engine against the local mock API
+# for increasing numbers of concurrent streams.
+# With `--shard-size`, every query is split into time windows of that many tweets, e.g.
+#   --num-queries 1 --num-pages 200 --shard-size 2000
+# shows the speedup of sharding a single heavy query.
+def main(num_queries: int = 16,
+         num_pages: int = 10,
+         page_size: int = 100,
+         latency: float = 0.2,
+         min_interval: float = 0.,
+         port: int = 8089,
+         concurrency: str = '1,2,4,8,16',
+         shard_size: int = 0,
+         log_level: str = 'INFO'):
+    logging.basicConfig(format='%(asctime)s [%(levelname)s] %(name)s: %(message)s', level=log_level)
+    logger = logging.getLogger('bench-download')
+
+    entries = [{'qid': f'q_{i:02d}', 'query': f'benchmark query {i}'} for i in range(num_queries)]
+    endpoint = f'http://localhost:{port}/2/tweets/search/all'
+
+    async def run():
+        runner = await start_server(make_app(page_size=page_size, num_pages=num_pages, latency=latency,
+                                             rate_limit=10 ** 9), port=port)
+        try:
+            for n in [int(c) for c in concurrency.split(',')]:
+                with tempfile.TemporaryDirectory() as target:
+                    start = time.perf_counter()
+                    pages, tweets = await download_entries(entries, Path(target), concurrency=n, endpoint=endpoint,
+                                                           bucket=TokenBucket(capacity=10 ** 9,
+                                                                              min_interval=min_interval),
+                                                           shard=set(e['qid'] for e in entries) if shard_size else None,
+                                                           shard_size=shard_size)
+                    duration = time.perf_counter() - start
+                logger.info(f'concurrency={n:>3}: {pages:,} pages, {tweets:,} tweets in {duration:.2f}s '
+                            f'-> {pages / duration:,.1f} pages/s, {tweets / duration:,.0f} tweets/s')
+        finally:
+            await runner.cleanup()
+
+    asyncio.run(run())
+
+
+if __name__ == '__main__':
+    typer.run(main)
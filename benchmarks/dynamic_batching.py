@@ -0,0 +1,60 @@
+import time
+import logging
+from pathlib import Path
+
+import typer
+import numpy as np
+
+from common.config import settings
+from common.mock_api import fake_tweets
+from common.models import Classifier, Embedder
+
+
+# Measures texts/s of `Classifier.classify` and `Embedder.embed` with token-budget batches against the previous
+# behaviour (transformers pipeline one text at a time, and sentence-transformers with fixed batches of 32),
+# on texts with a realistic tweet length distribution. Also checks that both produce the same results.
+def main(num_texts: int = 2000,
+         classifier_model: str = 'cardiffnlp/twitter-roberta-base-sentiment-latest',
+         embedder_model: str = 'all-MiniLM-L6-v2',
+         max_tokens: str = '2048,8192,16384',
+         log_level: str = 'INFO'):
+    logging.basicConfig(format='%(asctime)s [%(levelname)s] %(name)s: %(message)s', level=log_level)
+    logger = logging.getLogger('bench-batching')
+
+    texts = Classifier.preprocess(fake_tweets(num_texts))
+    logger.info(f'{num_texts:,} texts with {np.mean([len(t.split()) for t in texts]):.1f} words on average')
+
+    classifier = Classifier(hf_name=classifier_model, cache_dir=Path(settings.DATA_MODELS) / 'cardiff_latest')
+    classifier.load()
+    start = time.perf_counter()
+    baseline = [{score['label']: score['score'] for score in scores}
+                for scores in classifier._classifier(texts, top_k=None)]
+    duration = time.perf_counter() - start
+    logger.info(f'classify / pipeline: {num_texts / duration:,.1f} texts/s')
+    for budget in [int(b) for b in max_tokens.split(',')]:
+        classifier.max_tokens = budget
+        start = time.perf_counter()
+        output = classifier.classify(texts, return_all_scores=True)
+        duration_budget = time.perf_counter() - start
+        deviation = max(abs(out[label] - base[label]) for out, base in zip(output, baseline) for label in base)
+        logger.info(f'classify / max_tokens={budget}: {num_texts / duration_budget:,.1f} texts/s '
+                    f'(speedup {duration / duration_budget:.2f}x, max score deviation {deviation:.1e})')
+
+    embedder = Embedder(hf_name=embedder_model, cache_dir=Path(settings.DATA_MODELS) / 'minilm_l6_v2')
+    embedder.load()
+    start = time.perf_counter()
+    baseline = embedder._model.encode(texts, convert_to_numpy=True)
+    duration = time.perf_counter() - start
+    logger.info(f'embed / sentence-transformers: {num_texts / duration:,.1f} texts/s')
+    for budget in [int(b) for b in max_tokens.split(',')]:
+        embedder.max_tokens = budget
+        start = time.perf_counter()
+        output = embedder.embed(texts)
+        duration_budget = time.perf_counter() - start
+        logger.info(f'embed / max_tokens={budget}: {num_texts / duration_budget:,.1f} texts/s '
+                    f'(speedup {duration / duration_budget:.2f}x, '
+                    f'max deviation {np.abs(output - baseline).max():.1e})')
+
+
+if __name__ == '__main__':
+    typer.run(main)
@@ -0,0 +1,50 @@
+import time
+import logging
+import tempfile
+from pathlib import Path
+
+import typer
+
+from common.mock_api import FakeCorpus
+from common.twitter import page_to_lines
+from common.importer import RowContext, iter_rows
+
+
+# Measures the throughput of the parse stage of the importer (jsonl lines -> row tuples for all tables)
+# for increasing numbers of parse workers on a synthetic `{qid}_explicit.jsonl`, without a database.
+def main(num_tweets: int = 200000,
+         chunk_size: int = 8 * 2 ** 20,
+         workers: str = '0,1,2,4,8',
+         log_level: str = 'INFO'):
+    logging.basicConfig(format='%(asctime)s [%(levelname)s] %(name)s: %(message)s', level=log_level)
+    logger = logging.getLogger('bench-parse')
+
+    corpus = FakeCorpus('benchmark', num_tweets=num_tweets)
+    ctx = RowContext(project_id='00000000-0000-0000-0000-000000000000',
+                     import_id='00000000-0000-0000-0000-000000000001',
+                     meta_id='00000000-0000-0000-0000-000000000002',
+                     cat_i=0, q_i=0, repeat=1)
+
+    with tempfile.TemporaryDirectory() as target:
+        file = Path(target) / 'q_explicit.jsonl'
+        with open(file, 'wb') as f_out:
+            for page_idx in range((num_tweets + 99) // 100):
+                page = corpus.page(corpus.start, corpus.end, page_idx)
+                for _, _, line in page_to_lines(page):
+                    f_out.write(line)
+        logger.info(f'Wrote {num_tweets:,} tweets ({file.stat().st_size / 2 ** 20:,.1f} MiB) to {file}')
+
+        baseline = None
+        for n in [int(w) for w in workers.split(',')]:
+            start = time.perf_counter()
+            num_rows = 0
+            for rows in iter_rows(file, ctx, parse_workers=n, chunk_size=chunk_size):
+                num_rows += len(rows[0][1])
+            duration = time.perf_counter() - start
+            baseline = baseline or duration
+            logger.info(f'parse_workers={n:>2}: {num_rows:,} tweets in {duration:.2f}s '
+                        f'-> {num_rows / duration:,.0f} tweets/s (speedup {baseline / duration:.2f}x)')
+
+
+if __name__ == '__main__':
+    typer.run(main)
@@ -0,0 +1,125 @@
+import time
+import asyncio
+import logging
+import resource
+import tempfile
+import multiprocessing as mp
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+import typer
+
+from common.queries import queries
+from common.twitter import PageConverter
+from common.mock_api import make_app, start_server
+from common.replay import PageRecorder, load_recording, make_recording_proxy, make_replay_app
+from common.async_twitter import download_entries, TokenBucket
+from common.threads import ThreadStore, download_threads, read_ids
+
+logger = logging.getLogger('bench-ingestion')
+
+
+def dir_size(path: Path) -> int:
+    return sum(f.stat().st_size for f in path.rglob('*') if f.is_file())
+
+
+async def ingest(stage: str, entries: list[dict[str, str]], target_dir: Path, endpoint: str,
+                 concurrency: int, raw: bool) -> tuple[int, int]:
+    bucket = TokenBucket(capacity=10 ** 9, min_interval=0.)
+    converter = PageConverter(raw=raw)
+    if stage == '00':
+        return await download_entries(entries, target_dir, concurrency=concurrency, endpoint=endpoint,
+                                      bucket=bucket, converter=converter)
+
+    store = ThreadStore(target_dir)
+    for entry in entries:
+        store.register(entry['qid'], read_ids(target_dir / f'{entry["qid"]}_conversations.txt'))
+    try:
+        return await download_threads(store.pending(), store, concurrency=concurrency, endpoint=endpoint,
+                                      bucket=bucket, converter=converter)
+    finally:
+        store.close()
+
+
+def run_stage(stage: str, entries: list[dict[str, str]], target_dir: Path, endpoint: str,
+              concurrency: int, raw: bool) -> dict[str, float]:
+    # runs in a fresh process, so that the peak RSS belongs to this stage alone
+    size_before = dir_size(target_dir)
+    start = time.perf_counter()
+    pages, tweets = asyncio.run(ingest(stage, entries, target_dir, endpoint, concurrency, raw))
+    return {
+        'pages': pages,
+        'tweets': tweets,
+        'duration': time.perf_counter() - start,
+        'bytes': dir_size(target_dir) - size_before,
+        'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    }
+
+
+# Measures the ingestion throughput of `00` (search) and `01` (threads) offline, by replaying recorded API pages.
+# Without `--recording`, a recording of synthetic queries is made from the mock API first. Real recordings come from
+# running the pipeline against the recording proxy, e.g.
+#   python -m common.replay data/recording --upstream https://api.twitter.com --port 8080
+#   python -m pipeline.00_download_data --endpoint http://localhost:8080/2/tweets/search/all
+def main(recording: str | None = None,
+         num_queries: int = 8,
+         num_pages: int = 20,
+         page_size: int = 100,
+         port: int = 8089,
+         speed: float = 0.,  # replay speed relative to the recording, 0 replays without delays
+         stages: str = '00,01',
+         concurrency: int = 4,
+         raw: bool = True,
+         log_level: str = 'INFO'):
+    logging.basicConfig(format='%(asctime)s [%(levelname)s] %(name)s: %(message)s', level=log_level)
+
+    if recording is not None:
+        entries = [entry for sub_queries in queries.values() for entry in sub_queries]
+    else:
+        entries = [{'qid': f'q_{i:02d}', 'query': f'benchmark query {i}'} for i in range(num_queries)]
+
+    async def record(recording_dir: Path):
+        mock = await start_server(make_app(page_size=page_size, num_pages=num_pages, latency=0.,
+                                           rate_limit=10 ** 9), port=port)
+        proxy = await start_server(make_recording_proxy(f'http://localhost:{port}', PageRecorder(recording_dir)),
+                                   port=port + 1)
+        try:
+            with tempfile.TemporaryDirectory() as target:
+                for stage in ['00', '01']:
+                    await ingest(stage, entries, Path(target), f'http://localhost:{port + 1}/2/tweets/search/all',
+                                 concurrency=concurrency, raw=raw)
+        finally:
+            await proxy.cleanup()
+            await mock.cleanup()
+
+    async def run(recording_dir: Path):
+        replay = await start_server(make_replay_app(load_recording(recording_dir), speed=speed), port=port + 2)
+        loop = asyncio.get_running_loop()
+        try:
+            with tempfile.TemporaryDirectory() as target:
+                for stage in stages.split(','):
+                    # a fresh interpreter per stage: a forked child would inherit the running event loop and the
+                    # peak RSS of earlier stages
+                    with ProcessPoolExecutor(max_workers=1, mp_context=mp.get_context('spawn')) as pool:
+                        stats = await loop.run_in_executor(pool, run_stage, stage, entries, Path(target),
+                                                           f'http://localhost:{port + 2}/2/tweets/search/all',
+                                                           concurrency, raw)
+                    logger.info(f'{stage}: {stats["pages"]:,} pages, {stats["tweets"]:,} tweets '
+                                f'in {stats["duration"]:.2f}s -> {stats["pages"] / stats["duration"]:,.1f} pages/s, '
+                                f'{stats["tweets"] / stats["duration"]:,.0f} tweets/s, '
+                                f'{stats["bytes"] / 2 ** 20:,.1f} MiB written, '
+                                f'peak RSS {stats["peak_rss"] / 2 ** 20:,.0f} MiB')
+        finally:
+            await replay.cleanup()
+
+    if recording is not None:
+        asyncio.run(run(Path(recording)))
+    else:
+        with tempfile.TemporaryDirectory() as recording_dir:
+            logger.info(f'Recording {num_queries} synthetic queries from the mock API.')
+            asyncio.run(record(Path(recording_dir)))
+            asyncio.run(run(Path(recording_dir)))
+
+
+if __name__ == '__main__':
+    typer.run(main)
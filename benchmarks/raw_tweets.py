@@ -0,0 +1,46 @@
+import time
+import logging
+
+import typer
+import orjson
+
+from common.mock_api import FakeCorpus
+from common.twitter import api_page_to_tweets, api_page_to_raw_tweets
+
+
+# Compares the conversion of API pages to jsonl lines via pydantic models (`api_page_to_tweets` + `.json()`)
+# with the raw fast path (`api_page_to_raw_tweets` + orjson) on synthetic pages.
+def main(num_pages: int = 200,
+         page_size: int = 100,
+         repeats: int = 3,
+         log_level: str = 'INFO'):
+    logging.basicConfig(format='%(asctime)s [%(levelname)s] %(name)s: %(message)s', level=log_level)
+    logger = logging.getLogger('bench-raw')
+
+    corpus = FakeCorpus('benchmark', num_tweets=num_pages * page_size)
+    pages = [corpus.page(corpus.start, corpus.end, i, page_size=page_size) for i in range(num_pages)]
+    num_tweets = sum(len(page['data']) for page in pages)
+
+    def models():
+        return sum(len(tweet.json()) + 1 for page in pages for tweet in api_page_to_tweets(page))
+
+    def raw():
+        return sum(len(orjson.dumps(tweet)) + 1 for page in pages for tweet in api_page_to_raw_tweets(page))
+
+    def raw_validated():
+        return sum(len(orjson.dumps(tweet)) + 1
+                   for page in pages for tweet in api_page_to_raw_tweets(page, validate=True))
+
+    for name, func in [('pydantic', models), ('raw', raw), ('raw+validate', raw_validated)]:
+        durations = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            num_bytes = func()
+            durations.append(time.perf_counter() - start)
+        best = min(durations)
+        logger.info(f'{name:>14}: {num_tweets / best:>10,.0f} tweets/s ({num_bytes / 1024 ** 2:.1f}MB, '
+                    f'best of {repeats}: {best:.2f}s)')
+
+
+if __name__ == '__main__':
+    typer.run(main)
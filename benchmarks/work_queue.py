@@ -0,0 +1,92 @@
+import os
+import time
+import uuid
+import logging
+import multiprocessing as mp
+
+import typer
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from nacsos_data.db import DatabaseEngine
+
+from common.config import settings
+from common.work_queue import ensure_queue_tables, create_queue, queue_progress, run_worker
+
+
+def get_engine() -> DatabaseEngine:
+    return DatabaseEngine(host=settings.HOST, port=settings.PORT,
+                          user=settings.USER, password=settings.PASSWORD,
+                          database=settings.DATABASE)
+
+
+class SleepTask:
+    # stands in for `ClassifyTask` / `EmbedTask`: "processes" a unit by sleeping, or dies in the middle of it
+    def __init__(self, unit_seconds: float, crash: bool):
+        self.unit_seconds = unit_seconds
+        self.crash = crash
+
+    def run(self, job) -> int:
+        time.sleep(self.unit_seconds / 2)
+        if self.crash:
+            os._exit(1)  # no clean-up, the unit stays 'running' until its lease runs out
+        time.sleep(self.unit_seconds / 2)
+        return 1
+
+
+def _work(queue: str, unit_seconds: float, crash: bool, lease_seconds: float):
+    logging.basicConfig(format='%(asctime)s [%(levelname)s] %(name)s: %(message)s', level='INFO')
+    run_worker(get_engine(), queue, SleepTask(unit_seconds, crash), lease_seconds=lease_seconds,
+               poll_seconds=1.)
+
+
+# Runs `workers` local processes against one queue of `units` dummy units on the configured Postgres, of which
+# `crashing` die in the middle of their first unit, and checks that every unit is done exactly once (units of the
+# crashed workers are processed a second time after `lease_seconds`). Start it on several hosts with the same `queue`
+# (and `create` on only one of them) to try the queue across machines.
+def main(queue: str = 'benchmark',
+         units: int = 100,
+         workers: int = 4,
+         crashing: int = 1,
+         unit_seconds: float = 0.5,
+         lease_seconds: float = 5.,
+         create: bool = True,
+         log_level: str = 'INFO'):
+    logging.basicConfig(format='%(asctime)s [%(levelname)s] %(name)s: %(message)s', level=log_level)
+    logger = logging.getLogger('bench-work-queue')
+
+    db_engine = get_engine()
+    if create:
+        with db_engine.session() as session:  # type: Session
+            ensure_queue_tables(session)
+            session.execute(text('DELETE FROM work_queue WHERE queue = :queue;'), {'queue': queue})
+            session.commit()
+            bounds = [None] + [uuid.UUID(int=(i * 2 ** 128) // units) for i in range(1, units)] + [None]
+            create_queue(session, queue, {'benchmark': True}, list(zip(bounds[:-1], bounds[1:])))
+
+    context = mp.get_context('spawn')
+    processes = [context.Process(target=_work, name=f'worker-{worker_i}',
+                                 args=(queue, unit_seconds, worker_i < crashing, lease_seconds))
+                 for worker_i in range(workers)]
+    start = time.perf_counter()
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    duration = time.perf_counter() - start
+
+    with db_engine.session() as session:  # type: Session
+        progress = queue_progress(session, queue)
+        attempts = dict(session.execute(text('SELECT attempts, count(1) FROM work_unit '
+                                             'WHERE queue = :queue GROUP BY attempts;'), {'queue': queue}).all())
+        units_per_worker = dict(session.execute(text('SELECT worker, count(1) FROM work_unit '
+                                                     'WHERE queue = :queue GROUP BY worker;'),
+                                                {'queue': queue}).all())
+    logger.info(f'{workers} workers ({crashing} crashing) finished in {duration:.1f}s '
+                f'(ideal {units * unit_seconds / max(workers - crashing, 1):.1f}s).')
+    logger.info(f'Units by status: {progress}, by attempts: {attempts}, by worker: {units_per_worker}')
+    if progress != {'done': units}:
+        raise RuntimeError(f'Not all units are done: {progress}')
+
+
+if __name__ == '__main__':
+    typer.run(main)
@@ -0,0 +1,213 @@
+import time
+import asyncio
+import logging
+from pathlib import Path
+from typing import Any, AsyncGenerator, Mapping
+
+import aiohttp
+
+from common.config import settings
+from common.twitter import SEARCH_ENDPOINT, START_TIME, END_TIME, PageConverter, search_params
+from common.checkpoint import CheckpointedWriter
+from common.parquet_store import jsonl_to_parquet
+
+logger = logging.getLogger('async-download')
+
+
+class TokenBucket:
+    """
+    Request budget shared by all concurrently running streams.
+
+    The bucket starts with `capacity` tokens per `window` seconds and refills continuously until the API
+    tells us otherwise. Every response re-synchronises the bucket with the `x-rate-limit-*` headers,
+    after which tokens are only restored once the announced reset time has passed.
+    In addition, consecutive requests are spaced by at least `min_interval` seconds
+    (the full-archive search endpoint allows at most one request per second).
+    """
+
+    def __init__(self, capacity: int = 300, window: float = 900., min_interval: float = 1.):
+        self.capacity = capacity
+        self.window = window
+        self.min_interval = min_interval
+        self.tokens = float(capacity)
+        self._reset_at: float | None = None
+        self._last_refill = time.monotonic()
+        self._last_request = 0.
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        if self._reset_at is not None:
+            if now >= self._reset_at:
+                self.tokens = float(self.capacity)
+                self._reset_at = None
+        else:
+            self.tokens = min(float(self.capacity),
+                              self.tokens + (now - self._last_refill) * self.capacity / self.window)
+        self._last_refill = now
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self.min_interval - (now - self._last_request)
+                if self.tokens < 1:
+                    if self._reset_at is not None:
+                        wait = max(wait, self._reset_at - now)
+                    else:
+                        wait = max(wait, (1 - self.tokens) * self.window / self.capacity)
+                if wait <= 0:
+                    self.tokens -= 1
+                    self._last_request = now
+                    return
+                logger.debug(f'Rate limit budget exhausted, waiting for {wait:.2f}s')
+                await asyncio.sleep(wait)
+
+    def update(self, headers: Mapping[str, str]):
+        limit = headers.get('x-rate-limit-limit')
+        remaining = headers.get('x-rate-limit-remaining')
+        reset = headers.get('x-rate-limit-reset')  # epoch seconds
+
+        if limit is not None:
+            self.capacity = int(limit)
+        if remaining is not None:
+            self.tokens = min(self.tokens, float(remaining))
+        if reset is not None:
+            self._reset_at = time.monotonic() + max(0., float(reset) - time.time())
+
+    def exhaust(self, headers: Mapping[str, str]):
+        self.tokens = 0.
+        self.update(headers)
+        if self._reset_at is None:
+            self._reset_at = time.monotonic() + self.window
+
+
+async def request_json(session: aiohttp.ClientSession,
+                       bucket: TokenBucket,
+                       endpoint: str,
+                       params: dict[str, str],
+                       max_retries: int = 8) -> dict[str, Any]:
+    """
+    Sends one GET request within the rate limit budget of `bucket`.
+    Requests are retried after rate limit violations (once the limit was reset) and server errors.
+    """
+    headers = {'Authorization': f'Bearer {settings.TWITTER_BEARER}'}
+    for retry in range(max_retries + 1):
+        await bucket.acquire()
+        async with session.get(endpoint, params=params, headers=headers) as response:
+            if response.status == 429:
+                logger.warning(f'Hit rate limit for query "{params.get("query")}", waiting for reset.')
+                bucket.exhaust(response.headers)
+                continue
+            if response.status >= 500:
+                logger.warning(f'Server error {response.status} for query "{params.get("query")}", retrying.')
+                await asyncio.sleep(min(2 ** retry, 60))
+                continue
+
+            bucket.update(response.headers)
+            response.raise_for_status()
+            return await response.json()
+
+    raise RuntimeError(f'Giving up on query "{params.get("query")}" after {max_retries} retries.')
+
+
+async def fetch_pages(session: aiohttp.ClientSession,
+                      bucket: TokenBucket,
+                      query: str,
+                      endpoint: str = SEARCH_ENDPOINT,
+                      start_time: str | None = START_TIME,
+                      end_time: str | None = END_TIME,
+                      since_id: str | None = None,
+                      next_token: str | None = None) -> AsyncGenerator[dict[str, Any], None]:
+    """
+    Asynchronous equivalent to the `ResultStream` used in `common.twitter.download_query`,
+    which yields the raw API response pages for `query`.
+    """
+    params = {key: str(value) for key, value in search_params(query, start_time, end_time, since_id).items()}
+
+    while True:
+        if next_token is not None:
+            params['next_token'] = next_token
+
+        page = await request_json(session, bucket, endpoint, params)
+        yield page
+
+        next_token = page.get('meta', {}).get('next_token')
+        if next_token is None:
+            return
+
+
+async def download_entry(session: aiohttp.ClientSession,
+                         bucket: TokenBucket,
+                         entry: dict[str, str],
+                         target_dir: Path,
+                         endpoint: str = SEARCH_ENDPOINT,
+                         restart: bool = False,
+                         converter: PageConverter | None = None,
+                         parquet: Path | None = None) -> tuple[int, int]:
+    num_pages = 0
+    num_tweets = 0
+    with CheckpointedWriter(target_dir, entry['qid'], restart=restart, converter=converter) as writer:
+        if writer.done:
+            logger.info(f'Skipping {entry["qid"]}, which was already downloaded completely.')
+            return 0, 0
+
+        async for page in fetch_pages(session, bucket, entry['query'] + ' -is:retweet lang:en',
+                                      endpoint=endpoint, next_token=writer.checkpoint.next_token):
+            num_tweets += writer.write_page(page)
+            num_pages += 1
+            logger.debug(f'{entry["qid"]}: received page {num_pages} ({num_tweets:,} tweets so far)')
+        writer.finish()
+
+    logger.info(f'Done with {entry["qid"]}: {num_tweets:,} tweets in {num_pages:,} pages.')
+    if parquet is not None:
+        await asyncio.to_thread(jsonl_to_parquet, writer.file_explicit, entry['qid'], parquet)
+    return num_pages, num_tweets
+
+
+async def download_entries(entries: list[dict[str, str]],
+                           target_dir: Path,
+                           concurrency: int = 4,
+                           endpoint: str = SEARCH_ENDPOINT,
+                           bucket: TokenBucket | None = None,
+                           restart: bool = False,
+                           shard: set[str] | None = None,
+                           shard_size: int = 250000,
+                           converter: PageConverter | None = None,
+                           parquet: Path | None = None) -> tuple[int, int]:
+    """
+    Downloads all sub-queries in `entries` with up to `concurrency` streams at the same time.
+    All streams draw from the same rate limit budget.
+    Sub-queries are resumed from their checkpoint unless `restart` is set.
+    Sub-queries listed in `shard` are split into time windows of about `shard_size` tweets,
+    which are downloaded in parallel (see `common.sharding`).
+    Tweets are converted by `converter`, by default via the fast path without pydantic models.
+    If a `parquet` directory is given, completed sub-queries are also added to the parquet dataset there.
+    Returns the total number of pages and tweets.
+    """
+    from common.sharding import download_sharded
+
+    if bucket is None:
+        bucket = TokenBucket()
+    if shard is None:
+        shard = set()
+    semaphore = asyncio.Semaphore(concurrency)
+    counts_endpoint = endpoint.replace('/search/all', '/counts/all')
+
+    async def run(session: aiohttp.ClientSession, entry: dict[str, str]) -> tuple[int, int]:
+        if entry['qid'] in shard:
+            return await download_sharded(session, bucket, semaphore, entry, target_dir,
+                                          endpoint=endpoint, counts_endpoint=counts_endpoint,
+                                          max_tweets=shard_size, restart=restart, converter=converter,
+                                          parquet=parquet)
+        async with semaphore:
+            logger.info(f'Getting tweets for {entry["qid"]} -> {entry["query"]}')
+            return await download_entry(session, bucket, entry, target_dir, endpoint=endpoint, restart=restart,
+                                        converter=converter, parquet=parquet)
+
+    timeout = aiohttp.ClientTimeout(total=None, sock_read=120)
+    async with aiohttp.ClientSession(timeout=timeout,
+                                     connector=aiohttp.TCPConnector(limit=concurrency)) as session:
+        stats = await asyncio.gather(*[run(session, entry) for entry in entries])
+
+    return sum(s[0] for s in stats), sum(s[1] for s in stats)
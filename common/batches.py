@@ -0,0 +1,97 @@
+import logging
+from typing import Any, Generator, Sequence
+
+from sqlalchemy import text, RowMapping
+from sqlalchemy.orm import Session
+
+logger = logging.getLogger('batches')
+
+
+def iter_batches(session: Session,
+                 query: str,
+                 keys: list[tuple[str, str]],
+                 params: dict[str, Any] | None = None,
+                 batch_size: int = 500) -> Generator[Sequence[RowMapping], None, None]:
+    """
+    Pages through the result of `query` with keyset pagination: instead of `OFFSET`, which re-reads all
+    preceding rows for every batch, each batch continues after the last row of the previous one,
+    i.e. `(key_1, ..., key_n) > (:last_1, ..., :last_n)`, which an index on the keys can answer directly.
+
+    `query` is a `SELECT ... FROM ... WHERE ...` without `ORDER BY` or `LIMIT` that selects the key columns.
+    `keys` are pairs of (column in the result, expression in the query), e.g. `('item_id', 'item.item_id')`;
+    together they have to be unique, so the last key should be a primary key.
+    """
+    params = params or {}
+    order = ', '.join(expression for _, expression in keys)
+    condition = f'AND ({order}) > ({", ".join(f":_key_{ki}" for ki in range(len(keys)))}) '
+    last: dict[str, Any] | None = None
+    while True:
+        rows = session.execute(text(f'{query} '
+                                    f'{"" if last is None else condition}'
+                                    f'ORDER BY {order} '
+                                    f'LIMIT :_batch_size;'),
+                               {**params, **(last or {}), '_batch_size': batch_size}).mappings().all()
+        if len(rows) > 0:
+            yield rows
+        if len(rows) < batch_size:
+            break
+        last = {f'_key_{ki}': rows[-1][column] for ki, (column, _) in enumerate(keys)}
+
+
+def key_ranges(session: Session,
+               query: str,
+               key: tuple[str, str],
+               params: dict[str, Any] | None = None,
+               step: int = 10000) -> list[tuple[Any, Any]]:
+    """
+    Splits the result of `query` (see `iter_batches`) into ranges `[lower, upper)` of about `step` rows
+    along the single, unique `key`, e.g. to hand them out as jobs. The first range has no lower and the last
+    no upper bound (`None`), so that rows that are added in the meantime are still covered.
+    Each boundary is found by skipping `step` rows along the index of the key.
+    """
+    params = params or {}
+    column, expression = key
+    bounds = []
+    condition = ''
+    while True:
+        row = session.execute(text(f'{query} '
+                                   f'{condition}'
+                                   f'ORDER BY {expression} '
+                                   f'LIMIT 1 OFFSET :_step;'),
+                              {**params, '_lower': bounds[-1] if bounds else None, '_step': step}).mappings().first()
+        if row is None:
+            break
+        bounds.append(row[column])
+        condition = f'AND {expression} >= :_lower '
+    return list(zip([None] + bounds, bounds + [None]))
+
+
+def range_condition(expression: str, lower: Any, upper: Any) -> tuple[str, dict[str, Any]]:
+    """
+    Condition (to append to a `WHERE` clause) and parameters for rows in the range `[lower, upper)` of `key_ranges`.
+    """
+    condition = ''
+    if lower is not None:
+        condition += f'AND {expression} >= :_range_lower '
+    if upper is not None:
+        condition += f'AND {expression} < :_range_upper '
+    return condition, {'_range_lower': lower, '_range_upper': upper}
+
+
+def ensure_created_at_index(session: Session):
+    """
+    Index that lets `iter_batches` walk tweets in the order of (created_at, item_id) without sorting.
+    """
+    session.execute(text('CREATE INDEX IF NOT EXISTS twitter_item_created_at_item_id '
+                         'ON twitter_item (created_at, item_id);'))
+    session.commit()
+
+
+def ensure_annotation_index(session: Session):
+    """
+    Index that answers whether an item has annotations of a metadata item (see `common.classify.unannotated_filter`)
+    with a single lookup instead of a scan of all annotations.
+    """
+    session.execute(text('CREATE INDEX IF NOT EXISTS bot_annotation_metadata_item_key '
+                         'ON bot_annotation (bot_annotation_metadata_id, item_id, key);'))
+    session.commit()
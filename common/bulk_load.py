@@ -0,0 +1,186 @@
+import time
+import logging
+from dataclasses import dataclass
+from typing import Any, Iterable
+
+import orjson
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+logger = logging.getLogger('bulk-load')
+
+# Columns that are written by the importer, everything else is filled by the column defaults.
+TABLES = {
+    'item': ['item_id', 'project_id', 'type', 'text'],
+    'twitter_item': ['item_id', 'project_id', 'twitter_id', 'twitter_author_id', 'created_at', 'language',
+                     'conversation_id', 'referenced_tweets', 'annotations', 'latitude', 'longitude', 'hashtags',
+                     'mentions', 'urls', 'cashtags', 'retweet_count', 'reply_count', 'like_count', 'quote_count',
+                     'user'],
+    'm2m_import_item': ['item_id', 'import_id', 'type'],
+    'bot_annotation': ['bot_annotation_id', 'bot_annotation_metadata_id', 'item_id', 'parent', 'key', 'repeat',
+                       'value_int', 'confidence']
+}
+REQUIRED_FIELDS = ['twitter_id', 'text', 'created_at']
+JSON_COLUMNS = {'referenced_tweets', 'annotations', 'hashtags', 'mentions', 'urls', 'cashtags', 'user'}
+
+
+def _json(value: Any) -> str:
+    # missing values are JSON `null` (not SQL NULL), like the ORM wrote them; queries rely on `... = 'null'`
+    return orjson.dumps(value).decode()
+
+
+def tweet_rows(tweet: dict[str, Any], item_id: str, project_id: str) -> tuple[tuple, tuple]:
+    """
+    Rows for `item` and `twitter_item` from one line of `{qid}_explicit.jsonl` (see `common.twitter.page_to_lines`).
+    Used by both loaders. Lines are not validated with `TwitterItemModel` anymore, so only the fields that every
+    tweet needs are checked here; everything else is left to the column types in Postgres.
+    """
+    if missing := [col for col in REQUIRED_FIELDS if tweet.get(col) is None]:
+        raise ValueError(f'Tweet {tweet.get("twitter_id")} lacks {missing}.')
+    return ((item_id, project_id, 'twitter', tweet['text']),
+            (item_id, project_id, *[_json(tweet.get(col)) if col in JSON_COLUMNS else tweet.get(col)
+                                    for col in TABLES['twitter_item'][2:]]))
+
+
+def check_json_nulls(session: Session, twitter_item_rows: list[tuple]):
+    """
+    Checks that a tweet without `referenced_tweets` among the loaded `twitter_item_rows` reads back as JSON `null`,
+    which the figures and the paper use to find original tweets (`referenced_tweets = 'null'`).
+    """
+    ci = TABLES['twitter_item'].index('referenced_tweets')
+    item_id = next((row[0] for row in twitter_item_rows if row[ci] == 'null'), None)
+    if item_id is None:
+        return
+    is_null = session.execute(text("SELECT referenced_tweets = 'null' FROM twitter_item WHERE item_id = :item_id;"),
+                              {'item_id': item_id}).scalar()
+    if is_null is not True:
+        raise RuntimeError(f'Tweet {item_id} has no referenced tweets, but `referenced_tweets` is not JSON null '
+                           f'({is_null}); rows were not serialised like the ORM does.')
+
+
+@dataclass
+class TableStats:
+    rows: int = 0
+    merged: int = 0
+    copy_seconds: float = 0.
+    merge_seconds: float = 0.
+
+    @property
+    def rows_per_second(self) -> float:
+        seconds = self.copy_seconds + self.merge_seconds
+        return self.rows / seconds if seconds > 0 else 0.
+
+    def add(self, other: 'TableStats'):
+        self.rows += other.rows
+        self.merged += other.merged
+        self.copy_seconds += other.copy_seconds
+        self.merge_seconds += other.merge_seconds
+
+
+def log_stats(stats: dict[str, TableStats]):
+    for table, table_stats in stats.items():
+        if table_stats.rows == 0:
+            continue
+        logger.info(f'{table}: {table_stats.rows:,} rows ({table_stats.copy_seconds:.1f}s COPY), '
+                    f'{table_stats.merged:,} inserted ({table_stats.merge_seconds:.1f}s) '
+                    f'-> {table_stats.rows_per_second:,.0f} rows/s')
+
+
+class InsertLoader:
+    """
+    Writes rows (tuples in the order of `TABLES[table]`) with batched `INSERT ... ON CONFLICT DO NOTHING`
+    statements, so that loading the same rows twice (e.g. from parallel workers or a rerun) is safe.
+    """
+
+    def __init__(self, session: Session):
+        self.session = session
+        self.stats: dict[str, TableStats] = {table: TableStats() for table in TABLES}
+
+    def load(self, table: str, rows: Iterable[tuple]) -> int:
+        rows = list(rows)
+        if len(rows) == 0:
+            return 0
+        columns = ', '.join(f'"{col}"' for col in TABLES[table])
+        params = ', '.join(f':p{ci}' for ci in range(len(TABLES[table])))
+        start = time.perf_counter()
+        result = self.session.execute(text(f'INSERT INTO {table} ({columns}) '
+                                           f'VALUES ({params}) '
+                                           f'ON CONFLICT DO NOTHING;'),
+                                      [{f'p{ci}': value for ci, value in enumerate(row)} for row in rows])
+        self.stats[table].rows += len(rows)
+        self.stats[table].merged += max(0, result.rowcount)
+        self.stats[table].merge_seconds += time.perf_counter() - start
+        return result.rowcount
+
+    def close(self):
+        pass
+
+    def report(self):
+        log_stats(self.stats)
+
+
+class BulkLoader(InsertLoader):
+    """
+    Streams rows into Postgres with `COPY ... FROM STDIN` instead of per-row INSERTs through the ORM.
+    Rows are first copied into a temporary staging table (`_stage_{table}`, same columns and defaults as the target)
+    and then merged into the target with a single `INSERT ... SELECT ... ON CONFLICT DO NOTHING`,
+    so that rows that already exist are skipped instead of aborting the whole load.
+    Requires the psycopg (version 3) driver underneath the SQLAlchemy session.
+    """
+
+    def __init__(self, session: Session):
+        super().__init__(session)
+        self._staged: set[str] = set()
+
+    def _stage_table(self, table: str) -> str:
+        # TEMP tables belong to a connection, and the session may get another one from the pool after a commit,
+        # so the staging table is (re)created in every transaction instead of once per loader
+        stage = f'_stage_{table}'
+        self.session.execute(text(f'CREATE TEMP TABLE IF NOT EXISTS {stage} '
+                                  f'(LIKE {table} INCLUDING DEFAULTS) ON COMMIT DELETE ROWS;'))
+        self._staged.add(table)
+        return stage
+
+    def copy(self, table: str, rows: Iterable[tuple]) -> int:
+        """
+        Copies `rows` (tuples in the order of `TABLES[table]`) into the staging table of `table`;
+        they have to be merged in the same transaction.
+        """
+        stage = self._stage_table(table)
+        columns = ', '.join(f'"{col}"' for col in TABLES[table])
+        num_rows = 0
+        start = time.perf_counter()
+        dbapi_connection = self.session.connection().connection.dbapi_connection
+        with dbapi_connection.cursor() as cursor:
+            with cursor.copy(f'COPY {stage} ({columns}) FROM STDIN') as copy:
+                for row in rows:
+                    copy.write_row(row)
+                    num_rows += 1
+        self.stats[table].rows += num_rows
+        self.stats[table].copy_seconds += time.perf_counter() - start
+        return num_rows
+
+    def merge(self, table: str) -> int:
+        """
+        Moves all staged rows of `table` into the target table and empties the staging table.
+        Returns the number of rows that were actually inserted.
+        """
+        stage = self._stage_table(table)
+        columns = ', '.join(f'"{col}"' for col in TABLES[table])
+        start = time.perf_counter()
+        result = self.session.execute(text(f'INSERT INTO {table} ({columns}) '
+                                           f'SELECT {columns} FROM {stage} '
+                                           f'ON CONFLICT DO NOTHING;'))
+        self.session.execute(text(f'TRUNCATE {stage};'))
+        self.stats[table].merged += result.rowcount
+        self.stats[table].merge_seconds += time.perf_counter() - start
+        return result.rowcount
+
+    def load(self, table: str, rows: Iterable[tuple]) -> int:
+        self.copy(table, rows)
+        return self.merge(table)
+
+    def close(self):
+        for table in self._staged:
+            self.session.execute(text(f'DROP TABLE IF EXISTS _stage_{table};'))
+        self._staged.clear()
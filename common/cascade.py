@@ -0,0 +1,88 @@
+import time
+import logging
+from pathlib import Path
+
+import typer
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from nacsos_data.db import DatabaseEngine
+
+from common.config import settings
+from common.models import Classifier, NgramClassifier, SENTIMENT_LABELS, agreement
+from common.classify import MODEL, MODEL_PATH, FIRST_STAGE_FILE
+
+logger = logging.getLogger('cascade')
+
+
+def load_annotations(session: Session, meta_id: str, max_rows: int) -> list[tuple[str, str, str]]:
+    """
+    Returns (item_id, text, label) of tweets with their top sentiment label from the annotations `meta_id` (see 03).
+    """
+    labels = {value: label for label, value in SENTIMENT_LABELS.items()}
+    rows = session.execute(text('SELECT ba.item_id, i.text, ba.value_int '
+                                'FROM bot_annotation ba JOIN item i ON i.item_id = ba.item_id '
+                                'WHERE ba.bot_annotation_metadata_id = :meta_id '
+                                "  AND ba.key = 'senti' AND ba.repeat = 1 "
+                                'ORDER BY ba.item_id '
+                                'LIMIT :max_rows;'),
+                           {'meta_id': meta_id, 'max_rows': max_rows})
+    return [(str(item_id), txt, labels[value]) for item_id, txt, value in rows]
+
+
+# Trains the first stage of the sentiment cascade (see `Classifier.cascade`) on the labels that the full model
+# produced in an earlier run of 03, and evaluates the cascade on a holdout of these tweets: share of tweets that are
+# escalated to the full model, speedup over the full model alone, and agreement with the labels of the full model.
+def main(meta_id: str,  # annotations of 03 to learn from
+         target_file: str | None = None,
+         max_rows: int = 200000,
+         holdout: float = 0.1,  # share of tweets (by item id) that are held out for the evaluation
+         max_holdout: int = 5000,
+         thresholds: str = '0.7,0.8,0.9,0.95',
+         backend: str = 'torch',
+         num_threads: int | None = None,
+         log_level: str = 'INFO'):
+    logging.basicConfig(format='%(asctime)s [%(levelname)s] %(name)s: %(message)s', level=log_level)
+    target_file = FIRST_STAGE_FILE if target_file is None else Path(target_file)
+
+    db_engine = DatabaseEngine(host=settings.HOST, port=settings.PORT,
+                               user=settings.USER, password=settings.PASSWORD,
+                               database=settings.DATABASE)
+    with db_engine.session() as session:  # type: Session
+        rows = load_annotations(session, meta_id, max_rows)
+
+    # the split only depends on the item id, so it is stable across runs
+    is_holdout = [int(item_id[-8:], 16) % 1000 < holdout * 1000 for item_id, _, _ in rows]
+    train = [row for row, h in zip(rows, is_holdout) if not h]
+    test = [row for row, h in zip(rows, is_holdout) if h][:max_holdout]
+    logger.info(f'Training on {len(train):,} tweets, evaluating on {len(test):,} tweets.')
+
+    start = time.perf_counter()
+    first_stage = NgramClassifier().fit(Classifier.preprocess([txt for _, txt, _ in train]),
+                                        [label for _, _, label in train])
+    logger.info(f'Trained first stage in {time.perf_counter() - start:.1f}s, saving to {target_file}')
+    first_stage.save(target_file)
+
+    texts = Classifier.preprocess([txt for _, txt, _ in test])
+    classifier = Classifier(hf_name=MODEL, cache_dir=MODEL_PATH)
+    classifier.load(backend=backend, num_threads=num_threads)
+    classifier.classify(texts[:32])  # warm up
+
+    start = time.perf_counter()
+    reference = classifier.classify(texts, return_all_scores=True)
+    duration_full = time.perf_counter() - start
+    logger.info(f'Full model: {len(texts) / duration_full:,.1f} texts/s')
+
+    for threshold in [float(t) for t in thresholds.split(',')]:
+        classifier.cascade(first_stage, threshold=threshold)
+        start = time.perf_counter()
+        scores = classifier.classify(texts, return_all_scores=True)
+        duration = time.perf_counter() - start
+        same_label, _ = agreement(scores, reference)
+        logger.info(f'threshold={threshold}: '
+                    f'{classifier.cascade_stats["escalated"] / len(texts):.1%} escalated, '
+                    f'{len(texts) / duration:,.1f} texts/s (speedup {duration_full / duration:.2f}x), '
+                    f'top label agrees with the full model for {same_label:.2%}')
+
+
+if __name__ == '__main__':
+    typer.run(main)
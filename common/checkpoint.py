@@ -0,0 +1,170 @@
+import os
+import json
+import logging
+from pathlib import Path
+from typing import Any
+from dataclasses import dataclass, asdict, field
+
+from common.twitter import PageConverter
+
+logger = logging.getLogger('checkpoint')
+
+
+@dataclass
+class Checkpoint:
+    next_token: str | None = None  # token for the next page to request
+    oldest_created_at: str | None = None  # creation date of the oldest tweet written so far
+    pages_written: int = 0
+    tweets_written: int = 0
+    # size of the output files after the last completely written page
+    explicit_size: int = 0
+    conversations_size: int = 0
+    done: bool = False
+    # stamps of incremental refreshes that were appended to the output files
+    deltas: list[str] = field(default_factory=list)
+
+    @classmethod
+    def load(cls, path: Path) -> 'Checkpoint':
+        with open(path, 'r') as f:
+            return cls(**json.load(f))
+
+    def save(self, path: Path):
+        # write to a temporary file first, so that a crash never leaves a broken checkpoint behind
+        tmp = path.with_suffix('.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(asdict(self), f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+
+class TruncatedFileError(RuntimeError):
+    # the file lost data that its checkpoint had already recorded (e.g. after a power loss)
+    pass
+
+
+def repair_file(path: Path, size: int | None = None) -> int:
+    """
+    Truncates `path` to `size` bytes (the size recorded in the last checkpoint) or, if no size is given,
+    drops a trailing line that is missing its line break. Returns the number of bytes that were removed.
+    Raises `TruncatedFileError` if the file is shorter than `size`, because resuming would silently skip data.
+    """
+    current = path.stat().st_size if path.exists() else 0
+    if size is not None and size > current:
+        raise TruncatedFileError(f'{path} has {current:,} bytes, but its checkpoint recorded {size:,} bytes.')
+    if not path.exists():
+        return 0
+
+    if size is None:
+        size = current
+        with open(path, 'rb') as f:
+            if current > 0:
+                f.seek(current - 1)
+                if f.read(1) != b'\n':
+                    # walk back to the last complete line
+                    pos = current - 1
+                    while pos > 0:
+                        step = min(pos, 65536)
+                        f.seek(pos - step)
+                        chunk = f.read(step)
+                        nl = chunk.rfind(b'\n')
+                        if nl >= 0:
+                            size = pos - step + nl + 1
+                            break
+                        pos -= step
+                    else:
+                        size = 0
+
+    if size < current:
+        logger.warning(f'Truncating {path} from {current:,} to {size:,} bytes '
+                       f'(dropping partially written data).')
+        with open(path, 'r+b') as f:
+            f.truncate(size)
+    return current - size
+
+
+class CheckpointedWriter:
+    """
+    Writes the pages of one sub-query to `{qid}_explicit.jsonl` and `{qid}_conversations.txt` and
+    keeps a sidecar `{qid}_checkpoint.json` up to date after every page.
+    When the checkpoint exists, the output files are repaired to the state of the last checkpoint and
+    further pages are appended, so that the download can continue with `checkpoint.next_token`.
+    Tweets are serialised by the given `converter` (by default the raw fast path, see `common.twitter.page_to_lines`).
+    """
+
+    def __init__(self, target_dir: Path, qid: str, restart: bool = False, converter: PageConverter | None = None):
+        self.qid = qid
+        self.converter = converter or PageConverter()
+        self.file_explicit = (target_dir / f'{qid}_explicit.jsonl').resolve()
+        self.file_conv_ids = (target_dir / f'{qid}_conversations.txt').resolve()
+        self.file_checkpoint = (target_dir / f'{qid}_checkpoint.json').resolve()
+        self.file_explicit.parent.mkdir(parents=True, exist_ok=True)
+
+        if restart:
+            self.file_checkpoint.unlink(missing_ok=True)
+
+        if self.file_checkpoint.exists():
+            self.checkpoint = Checkpoint.load(self.file_checkpoint)
+            logger.info(f'{qid}: resuming after {self.checkpoint.pages_written:,} pages '
+                        f'({self.checkpoint.tweets_written:,} tweets, oldest: {self.checkpoint.oldest_created_at})')
+        else:
+            self.checkpoint = Checkpoint()
+
+        self._f_out_ex = None
+        self._f_out_conv_ids = None
+
+    def __enter__(self) -> 'CheckpointedWriter':
+        mode = 'wb'
+        if self.checkpoint.pages_written > 0:
+            try:
+                repair_file(self.file_explicit, self.checkpoint.explicit_size)
+                repair_file(self.file_conv_ids, self.checkpoint.conversations_size)
+                mode = 'ab'
+            except TruncatedFileError as e:
+                if self.checkpoint.deltas:
+                    # a new download would not contain the appended refreshes
+                    raise
+                logger.error(f'{self.qid}: {e} Downloading the sub-query again.')
+                self.checkpoint = Checkpoint()
+        self._f_out_ex = open(self.file_explicit, mode)
+        self._f_out_conv_ids = open(self.file_conv_ids, mode)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._f_out_ex.close()
+        self._f_out_conv_ids.close()
+
+    @property
+    def done(self) -> bool:
+        return self.checkpoint.done
+
+    def write_page(self, page: dict[str, Any]) -> int:
+        num_tweets = 0
+        if 'data' in page and type(page['data']) == list:
+            for _, conversation_id, line in self.converter(page):
+                self._f_out_ex.write(line)
+                if conversation_id:
+                    self._f_out_conv_ids.write(f'{conversation_id}\n'.encode())
+                num_tweets += 1
+            # pages are sorted by recency, the last tweet is the oldest
+            self.checkpoint.oldest_created_at = page['data'][-1]['created_at']
+        elif page.get('meta', {}).get('result_count') != 0:
+            logger.error('Something went wrong!')
+
+        # the data has to be on disk before the checkpoint that points behind it
+        for f_out in [self._f_out_ex, self._f_out_conv_ids]:
+            f_out.flush()
+            os.fsync(f_out.fileno())
+
+        self.checkpoint.next_token = page.get('meta', {}).get('next_token')
+        self.checkpoint.pages_written += 1
+        self.checkpoint.tweets_written += num_tweets
+        self.checkpoint.explicit_size = self._f_out_ex.tell()
+        self.checkpoint.conversations_size = self._f_out_conv_ids.tell()
+        self.checkpoint.save(self.file_checkpoint)
+        return num_tweets
+
+    def finish(self):
+        self.checkpoint.done = True
+        self.checkpoint.next_token = None
+        self.checkpoint.save(self.file_checkpoint)
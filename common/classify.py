@@ -0,0 +1,194 @@
+import logging
+from pathlib import Path
+from typing import Any
+
+from sqlalchemy.orm import Session
+from nacsos_data.db import DatabaseEngine
+from nacsos_data.db.schemas.annotations import AnnotationScheme
+from nacsos_data.db.schemas.bot_annotations import BotAnnotationMetaData
+
+from common.config import settings
+from common.models import Classifier, NgramClassifier, classify_heads, export_onnx
+from common.inference_cache import InferenceCache
+from common.batches import iter_batches, range_condition
+from common.bulk_load import InsertLoader
+from common.importer import annotation_uuid
+from common.pipelined import run_pipelined, StageTimes
+
+logger = logging.getLogger('classify')
+
+MODEL = 'cardiffnlp/twitter-roberta-base-sentiment-latest'
+MODEL_PATH = Path(f'{settings.DATA_MODELS}') / 'cardiff_latest'
+EMOTION_MODEL = 'cardiffnlp/twitter-roberta-base-emotion'
+EMOTION_MODEL_PATH = Path(f'{settings.DATA_MODELS}') / 'cardiff_emotion'
+FIRST_STAGE_FILE = MODEL_PATH / 'first_stage.pkl'
+
+# Annotation key -> (label name, model, model cache); all heads are classified in the same pass over the corpus
+HEADS = {
+    'senti': ('Sentiment', MODEL, MODEL_PATH),
+    'emo': ('Emotion', EMOTION_MODEL, EMOTION_MODEL_PATH)
+}
+
+
+def scheme_heads(session: Session, meta_id: str) -> list[str]:
+    """
+    Keys of the labels in the annotation scheme of the metadata item `meta_id`
+    (only `senti` for schemes of 03 from before emotions were classified as well).
+    """
+    meta = session.get(BotAnnotationMetaData, meta_id)
+    if meta is None:
+        raise KeyError(f'There is no metadata item {meta_id}.')
+    scheme = session.get(AnnotationScheme, meta.annotation_scheme_id)
+    return [label['key'] for label in scheme.labels]
+
+
+def unannotated_filter(meta_id: str, heads: list[str]) -> tuple[str, dict[str, Any]]:
+    """
+    Condition on `item` (and its parameters) that only keeps items without annotations of `meta_id` for any of the
+    `heads`. With `common.batches.ensure_annotation_index`, this is an anti-join with one index lookup per item and
+    head, so the keyset pagination over `item.item_id` stays a walk along the primary key of `item`.
+    """
+    missing = ' OR '.join(f'NOT EXISTS (SELECT 1 FROM bot_annotation ba '
+                          f'WHERE ba.bot_annotation_metadata_id = :_annotated_meta_id '
+                          f'  AND ba.item_id = item.item_id AND ba.key = :_annotated_key_{hi})'
+                          for hi in range(len(heads)))
+    return f'AND ({missing}) ', {'_annotated_meta_id': meta_id,
+                                 **{f'_annotated_key_{hi}': key for hi, key in enumerate(heads)}}
+
+
+class ClassifyTask:
+    """
+    Classifies tweets with all `heads` and writes their annotations to `meta_id` (see 03). Everything that is
+    needed is passed to the constructor and the models are only loaded in `setup`, so that the task can be sent
+    to worker processes (see `common.inference_pool`) that each classify their own ranges of item ids.
+    """
+
+    def __init__(self,
+                 meta_id: str,
+                 heads: list[str],
+                 item_filter: str = '',
+                 filter_params: dict[str, Any] | None = None,
+                 batch_size: int = 500,
+                 queue_size: int = 2,
+                 backend: str = 'torch',
+                 cache: bool = True,
+                 cascade_threshold: float | None = None,  # use the cascade for sentiment
+                 first_stage_file: Path = FIRST_STAGE_FILE):
+        self.meta_id = meta_id
+        self.heads = heads
+        self.item_filter = item_filter
+        self.filter_params = filter_params or {}
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.backend = backend
+        self.use_cache = cache
+        self.cascade_threshold = cascade_threshold
+        self.first_stage_file = first_stage_file
+
+        self.classifiers: dict[str, Classifier] = {}
+        self.labels: dict[str, dict[str, int]] = {}
+        self.cache: InferenceCache | None = None
+        self.db_engine: DatabaseEngine | None = None
+        self.times = {stage: StageTimes() for stage in ['read', 'infer', 'write']}
+
+    def __getstate__(self):
+        # only the configuration is sent to worker processes
+        return {**self.__dict__, 'classifiers': {}, 'labels': {}, 'cache': None, 'db_engine': None}
+
+    def prepare(self):
+        """
+        Exports the ONNX models (if the backend needs them) once in this process, before the workers start,
+        instead of every worker exporting the same model into the same files.
+        """
+        if self.backend in ('onnx', 'onnx-int8'):
+            for key in self.heads:
+                _, model, model_path = HEADS[key]
+                logger.info(f'Exporting model "{model}" for {self.backend}')
+                export_onnx(model, model_path, quantize=self.backend == 'onnx-int8')
+
+    def setup(self, num_threads: int | None = None):
+        if self.use_cache:
+            self.cache = InferenceCache(Path(settings.DATA_MODELS))
+        for key in self.heads:
+            _, model, model_path = HEADS[key]
+            logger.info(f'Loading model "{model}" (caching at {model_path})')
+            self.classifiers[key] = Classifier(hf_name=model, cache_dir=model_path, cache=self.cache)
+            self.classifiers[key].load(backend=self.backend, num_threads=num_threads)
+            self.labels[key] = self.classifiers[key].labels
+        if self.cascade_threshold is not None and 'senti' in self.classifiers:
+            logger.info(f'Using cascade with first stage {self.first_stage_file} '
+                        f'(threshold {self.cascade_threshold})')
+            self.classifiers['senti'].cascade(NgramClassifier.load(self.first_stage_file),
+                                              threshold=self.cascade_threshold)
+        self.db_engine = DatabaseEngine(host=settings.HOST, port=settings.PORT,
+                                        user=settings.USER, password=settings.PASSWORD,
+                                        database=settings.DATABASE)
+
+    @property
+    def query(self) -> str:
+        return ("SELECT item_id, text "
+                "FROM item "
+                "WHERE project_id = :project_id "
+                f"{self.item_filter}")
+
+    def classify(self, texts: list[str]) -> list[list[dict[str, float]]]:
+        return classify_heads(list(self.classifiers.values()), Classifier.preprocess(texts))
+
+    def annotation_rows(self, tweets, outputs: list[list[dict[str, float]]]) -> list[tuple]:
+        return [
+            (annotation_uuid(self.meta_id, str(tweet['item_id']), f'{key}/{repeat}'), self.meta_id,
+             str(tweet['item_id']), None, key, repeat, self.labels[key][label], score)
+            for key, output in zip(self.classifiers.keys(), outputs)
+            for tweet, res in zip(tweets, output)
+            for repeat, (label, score) in enumerate(sorted(res.items(), key=lambda e: e[1], reverse=True), start=1)
+        ]
+
+    def run(self, job: tuple[Any, Any] = (None, None)) -> int:
+        """
+        Classifies all tweets in the range of item ids `job` = `[lower, upper)` (see `common.batches.key_ranges`),
+        by default all of them, with reading, inference, and writing pipelined (see `common.pipelined`).
+        Returns the number of tweets.
+        """
+        condition, range_params = range_condition('item.item_id', *job)
+        num_tweets = 0
+
+        def read():
+            # prefetches batches in the reader thread with its own session
+            with self.db_engine.session() as read_session:  # type: Session
+                yield from iter_batches(read_session,
+                                        query=f'{self.query}{condition}',
+                                        keys=[('item_id', 'item.item_id')],
+                                        params={**self.filter_params, **range_params,
+                                                'project_id': settings.PROJECT_ID},
+                                        batch_size=self.batch_size)
+
+        def infer(tweets):
+            # one tokenization per batch for all heads that share a tokenizer
+            return tweets, self.classify([tweet['text'] for tweet in tweets])
+
+        with self.db_engine.session() as write_session:  # type: Session
+            loader = InsertLoader(write_session)
+
+            def write(result):
+                nonlocal num_tweets
+                tweets, outputs = result
+                # annotations of all heads in one bulk insert
+                loader.load('bot_annotation', self.annotation_rows(tweets, outputs))
+                write_session.commit()
+                num_tweets += len(tweets)
+                logger.debug(f'Classified {num_tweets:,} tweets.')
+
+            times = run_pipelined(read(), infer, write, queue_size=self.queue_size)
+
+        for stage, stage_times in times.items():
+            self.times[stage].items += stage_times.items
+            self.times[stage].busy += stage_times.busy
+            self.times[stage].waiting += stage_times.waiting
+        return num_tweets
+
+    def close(self):
+        for classifier in self.classifiers.values():
+            classifier.report_cascade()
+        if self.cache is not None:
+            self.cache.report()
+            self.cache.close()
@@ -0,0 +1,115 @@
+import logging
+from pathlib import Path
+from typing import Any
+
+from sqlalchemy.orm import Session
+from nacsos_data.db import DatabaseEngine
+
+from common.config import settings
+from common.models import Embedder
+from common.inference_cache import InferenceCache
+from common.batches import iter_batches, range_condition
+from common.vector_index import VectorIndex
+from common.pyw_hnsw import Index
+
+logger = logging.getLogger('embed')
+
+
+class EmbedTask:
+    """
+    Embeds the tweets in a range of item ids and saves them as a `VectorIndex` in `units_dir` (see 04). The hnsw index
+    can only be built by one process, so workers only write these units and `merge_units` adds them to the index.
+    """
+
+    def __init__(self,
+                 model: str,
+                 model_path: Path,
+                 units_dir: Path,
+                 item_filter: str = '',
+                 filter_params: dict[str, Any] | None = None,
+                 batch_size: int = 500,
+                 cache: bool = True):
+        self.model = model
+        self.model_path = model_path
+        self.units_dir = units_dir
+        self.item_filter = item_filter
+        self.filter_params = filter_params or {}
+        self.batch_size = batch_size
+        self.use_cache = cache
+
+        self.embedder: Embedder | None = None
+        self.cache: InferenceCache | None = None
+        self.db_engine: DatabaseEngine | None = None
+
+    def setup(self):
+        if self.use_cache:
+            self.cache = InferenceCache(Path(settings.DATA_MODELS))
+        logger.info(f'Loading model "{self.model}" (caching at {self.model_path})')
+        self.embedder = Embedder(hf_name=self.model, cache_dir=self.model_path, cache=self.cache)
+        self.embedder.load()
+        self.db_engine = DatabaseEngine(host=settings.HOST, port=settings.PORT,
+                                        user=settings.USER, password=settings.PASSWORD,
+                                        database=settings.DATABASE)
+
+    @property
+    def query(self) -> str:
+        return ("SELECT item_id, text "
+                "FROM item "
+                "WHERE project_id = :project_id "
+                f"{self.item_filter}")
+
+    def unit_file(self, lower: Any) -> Path:
+        return self.units_dir / f'unit_{lower or "first"}'
+
+    def run(self, job: tuple[Any, Any]) -> int:
+        """
+        Embeds all tweets in the range of item ids `job` = `[lower, upper)` (see `common.batches.key_ranges`)
+        and overwrites the unit of that range. Returns the number of tweets.
+        """
+        condition, range_params = range_condition('item.item_id', *job)
+        unit = VectorIndex()
+        with self.db_engine.session() as session:  # type: Session
+            for tweets in iter_batches(session,
+                                       query=f'{self.query}{condition}',
+                                       keys=[('item_id', 'item.item_id')],
+                                       params={**self.filter_params, **range_params,
+                                               'project_id': settings.PROJECT_ID},
+                                       batch_size=self.batch_size):
+                texts = self.embedder.preprocess([tweet['text'] for tweet in tweets])
+                unit.add_items(self.embedder.embed(texts), [str(tweet['item_id']) for tweet in tweets])
+        unit.save(self.unit_file(job[0]))
+        return len(unit.dict_labels)
+
+    def close(self):
+        if self.cache is not None:
+            self.cache.report()
+            self.cache.close()
+
+
+def merge_units(unit_files: list[tuple[Path, int]], index: Index, known: set[str] | None = None) -> int:
+    """
+    Adds the vectors of the units (files of `EmbedTask.unit_file` with the number of items they should have) that are
+    not `known` yet to `index`, which has to have room for them. Returns the number of added vectors.
+    Raises if a unit is missing or incomplete, e.g. because it was embedded on another host.
+    """
+    missing = [str(file) for file, _ in unit_files if not Path(f'{file}_keys.pkl').exists()]
+    if len(missing) > 0:
+        raise FileNotFoundError(f'{len(missing):,} of {len(unit_files):,} units are missing, the units of all '
+                                f'workers have to be in one directory (e.g. on a shared drive): {missing[:5]}')
+
+    known = known or set()
+    num_added = 0
+    for file, num_items in unit_files:
+        unit = VectorIndex()
+        unit.load(file)
+        ids, vectors = unit.get_all_items()
+        if len(ids) != num_items:
+            raise ValueError(f'{file} has {len(ids):,} vectors instead of {num_items:,}.')
+        new = [i for i, item_id in enumerate(ids) if item_id not in known]
+        if len(new) == 0:
+            continue
+        index.add_items(vectors[new], [ids[i] for i in new])
+        known.update(ids[i] for i in new)
+        num_added += len(new)
+        logger.debug(f'Added {len(new):,} vectors from {file.name} ({num_added:,} so far).')
+    return num_added
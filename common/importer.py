@@ -0,0 +1,305 @@
+import os
+import json
+import uuid
+import logging
+from collections import deque
+from pathlib import Path
+from typing import Generator
+from dataclasses import dataclass, asdict, field
+from concurrent.futures import ProcessPoolExecutor
+
+import orjson
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from nacsos_data.db import DatabaseEngine
+from nacsos_data.db.schemas.imports import Import
+
+from common.config import settings
+from common.bulk_load import InsertLoader, BulkLoader, TableStats, tweet_rows, check_json_nulls
+from common.threads import ThreadStore
+
+logger = logging.getLogger('importer')
+
+# Namespace for the deterministic ids of everything the importer creates
+NAMESPACE = uuid.UUID('6f4b7a52-3c1e-5d0a-9f0b-2e7c8d1a4b30')
+
+
+def item_uuid(project_id: str, twitter_id: str) -> str:
+    return str(uuid.uuid5(NAMESPACE, f'{project_id}/twitter/{twitter_id}'))
+
+
+def import_uuid(project_id: str, qid: str, delta: str | None = None) -> str:
+    return str(uuid.uuid5(NAMESPACE, f'{project_id}/import/{qid}' + (f'/{delta}' if delta else '')))
+
+
+def annotation_uuid(meta_id: str, item_id: str, key: str) -> str:
+    return str(uuid.uuid5(NAMESPACE, f'{meta_id}/{item_id}/{key}'))
+
+
+def existing_item_ids(session: Session, project_id: str, twitter_ids: list[str]) -> dict[str, str]:
+    """
+    Maps those of `twitter_ids` that are already in the database to their `item_id`, which is random
+    (instead of `item_uuid`) for tweets of imports that did not derive ids from the data yet.
+    """
+    rows = session.execute(text('SELECT twitter_id, item_id '
+                                'FROM twitter_item '
+                                'WHERE project_id = :project_id AND twitter_id = ANY(:twitter_ids);'),
+                           {'project_id': project_id, 'twitter_ids': twitter_ids}).all()
+    return {row[0]: str(row[1]) for row in rows}
+
+
+@dataclass
+class ImportState:
+    """
+    Progress of an import (`import_state.json`, or `import_state_{delta}.json` for deltas),
+    so that a rerun adds to the same annotation metadata and skips sub-queries (and threads) that were completed.
+    """
+    meta_id: str | None = None
+    done: list[str] = field(default_factory=list)
+    threads_done: bool = False
+
+    @classmethod
+    def load(cls, path: Path) -> 'ImportState':
+        if not path.exists():
+            return cls()
+        with open(path, 'r') as f:
+            return cls(**json.load(f))
+
+    def save(self, path: Path):
+        tmp = path.with_suffix('.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(asdict(self), f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+
+@dataclass
+class RowContext:
+    # everything that is needed to turn lines of one sub-query into rows (sent to the parse workers)
+    project_id: str
+    import_id: str
+    meta_id: str
+    qid: str
+    cat_i: int
+    q_i: int
+    repeat: int  # position of the sub-query, until `renumber_tech` turns it into the ordinal per tweet
+    known: dict[str, str] = field(default_factory=dict)
+
+
+Rows = list[tuple[str, list[tuple]]]
+
+
+def byte_ranges(file: Path, chunk_size: int) -> list[tuple[int, int]]:
+    """
+    Splits `file` into ranges of about `chunk_size` bytes that start and end at line boundaries.
+    """
+    ranges = []
+    file_size = file.stat().st_size
+    with open(file, 'rb') as f:
+        start = 0
+        while start < file_size:
+            f.seek(min(start + chunk_size, file_size))
+            f.readline()  # move on to the end of the current line
+            end = min(f.tell(), file_size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def parse_chunk(file: Path, start: int, end: int, ctx: RowContext) -> Rows:
+    """
+    Parses the lines in the byte range `[start, end)` of `file` into row tuples for all tables,
+    in the order in which they have to be written (see `common.bulk_load.TABLES`).
+    """
+    with open(file, 'rb') as f:
+        f.seek(start)
+        lines = f.read(end - start).splitlines()
+
+    items = []
+    tweets = []
+    m2m = []
+    parents = []
+    children = []
+    for line in lines:
+        tweet = orjson.loads(line)
+        item_id = ctx.known.get(tweet['twitter_id']) or item_uuid(ctx.project_id, tweet['twitter_id'])
+        item_row, twitter_item_row = tweet_rows(tweet, item_id, ctx.project_id)
+        items.append(item_row)
+        tweets.append(twitter_item_row)
+        m2m.append((item_id, ctx.import_id, 'explicit'))
+
+        parent_id = annotation_uuid(ctx.meta_id, item_id, f'tech/{ctx.qid}')
+        parents.append((parent_id, ctx.meta_id, item_id, None, 'tech', ctx.repeat, ctx.cat_i, None))
+        children.append((annotation_uuid(ctx.meta_id, item_id, f'cat_{ctx.cat_i}/{ctx.qid}'), ctx.meta_id,
+                         item_id, parent_id, f'cat_{ctx.cat_i}', 1, ctx.q_i, None))
+
+    return [('item', items), ('twitter_item', tweets), ('m2m_import_item', m2m),
+            ('bot_annotation', parents), ('bot_annotation', children)]
+
+
+def iter_rows(file: Path, ctx: RowContext, parse_workers: int = 0,
+              chunk_size: int = 8 * 2 ** 20) -> Generator[Rows, None, None]:
+    """
+    Yields the rows of `file` chunk by chunk (in file order). With `parse_workers`, chunks are parsed
+    by a process pool; at most two chunks per worker are in flight, so parsing never runs away from the writer.
+    """
+    ranges = byte_ranges(file, chunk_size)
+    if parse_workers < 1:
+        for start, end in ranges:
+            yield parse_chunk(file, start, end, ctx)
+        return
+
+    with ProcessPoolExecutor(max_workers=parse_workers) as pool:
+        pending = deque()
+        for start, end in ranges:
+            if len(pending) >= 2 * parse_workers:
+                yield pending.popleft().result()
+            pending.append(pool.submit(parse_chunk, file, start, end, ctx))
+        while pending:
+            yield pending.popleft().result()
+
+
+def import_qid(cat_i: int,
+               cat: str,
+               q_i: int,
+               entry: dict[str, str],
+               repeat: int,
+               meta_id: str,
+               file: Path,
+               delta: str | None = None,
+               name_suffix: str | None = None,
+               known: dict[str, str] | None = None,
+               bulk: bool = False,
+               parse_workers: int = 0,
+               chunk_size: int = 8 * 2 ** 20) -> dict[str, TableStats]:
+    """
+    Imports the tweets of one sub-query chunk by chunk (see `iter_rows`), together with their m2m rows and query annotations
+    (`tech` = `cat_i` and `cat_{cat_i}` = `q_i` below it). The `repeat` of `tech` is the position `repeat` of the
+    sub-query until `renumber_tech` runs after all sub-queries.
+    All ids are derived from the data and every insert skips existing rows, so this can run in parallel
+    for different sub-queries (each worker opens its own connection) and can be repeated safely.
+    Tweets in `known` keep the item id they already have in the database (from imports with random ids).
+    """
+    qid = entry['qid']
+    import_id = import_uuid(settings.PROJECT_ID, qid, delta)
+
+    db_engine = DatabaseEngine(host=settings.HOST, port=settings.PORT,
+                               user=settings.USER, password=settings.PASSWORD,
+                               database=settings.DATABASE)
+    with db_engine.session() as session:  # type: Session
+        if session.get(Import, import_id) is None:
+            session.add(Import(import_id=import_id,
+                               project_id=settings.PROJECT_ID,
+                               type='script',
+                               user_id=settings.USER_ID,
+                               name=f'{cat} ({qid})' + (f' {name_suffix}' if name_suffix else ''),
+                               description=f'Subquery *{qid}* for *{cat}* '
+                                           f'with query `{entry["query"]} -is:retweet lang:en`'))
+            session.commit()
+
+        loader = BulkLoader(session) if bulk else InsertLoader(session)
+        ctx = RowContext(project_id=settings.PROJECT_ID, import_id=import_id, meta_id=meta_id, qid=qid,
+                         cat_i=cat_i, q_i=q_i, repeat=repeat, known=known or {})
+        num_tweets = 0
+        for rows in iter_rows(file, ctx, parse_workers=parse_workers, chunk_size=chunk_size):
+            for table, table_rows in rows:
+                loader.load(table, table_rows)
+            session.commit()
+            if num_tweets == 0:
+                check_json_nulls(session, rows[1][1])
+
+            num_tweets += len(rows[0][1])
+            logger.debug(f'{qid}: imported {num_tweets:,} tweets '
+                         f'({loader.stats["item"].merged:,} new, the others already existed)')
+
+        loader.close()
+        session.commit()
+    return loader.stats
+
+
+def renumber_tech(session: Session, meta_id: str) -> int:
+    """
+    Sets the `repeat` of the `tech` annotations of `meta_id` to 1..n per tweet, in the order of the sub-queries
+    (`cat_i`, `q_i`) that found it. Sub-queries are imported independently (and in parallel), so this only
+    works once all of them are done. Returns the number of annotations that changed.
+    """
+    result = session.execute(text('''
+        UPDATE bot_annotation ba
+        SET repeat = ordered.ordinal
+        FROM (SELECT parent.bot_annotation_id,
+                     row_number() OVER (PARTITION BY parent.item_id
+                                        ORDER BY parent.value_int, child.value_int) AS ordinal
+              FROM bot_annotation parent
+                  JOIN bot_annotation child ON child.parent = parent.bot_annotation_id
+              WHERE parent.bot_annotation_metadata_id = :meta_id
+                AND parent.key = 'tech') ordered
+        WHERE ba.bot_annotation_id = ordered.bot_annotation_id
+          AND ba.repeat IS DISTINCT FROM ordered.ordinal;'''), {'meta_id': meta_id})
+    session.commit()
+    return result.rowcount
+
+
+def import_threads(store: ThreadStore,
+                   qids: list[str],
+                   delta: str | None = None,
+                   conv_ids: dict[str, list[str]] | None = None,
+                   bulk: bool = False,
+                   batch_size: int = 10000) -> dict[str, TableStats]:
+    """
+    Imports the thread tweets of `store` (see `common.threads.ThreadStore`) as implicit tweets of the sub-queries `qids`.
+    Every tweet is loaded at most once, no matter how many sub-queries refer to its conversation: tweets that are
+    already in the database (e.g. as explicit tweets, or from imports with random item ids) are looked up by their
+    twitter id and skipped without being read or parsed; their m2m rows use the item id they already have.
+    The `implicit` m2m rows come from the index of the store alone and never replace an `explicit` row of the
+    same import. With `conv_ids`, sub-queries only get the tweets of these conversations.
+    Sub-queries without an import (i.e. without explicit tweets) are skipped.
+    """
+    db_engine = DatabaseEngine(host=settings.HOST, port=settings.PORT,
+                               user=settings.USER, password=settings.PASSWORD,
+                               database=settings.DATABASE)
+    with db_engine.session() as session:  # type: Session
+        loader = BulkLoader(session) if bulk else InsertLoader(session)
+
+        num_tweets = 0
+        with open(store.file_store, 'rb') as f_in:
+            for batch in store.iter_tweet_ids(batch_size):
+                existing = existing_item_ids(session, settings.PROJECT_ID, [twitter_id for twitter_id, _ in batch])
+
+                items = []
+                tweets = []
+                for twitter_id, offset in batch:
+                    if twitter_id in existing:
+                        continue
+                    item_id = item_uuid(settings.PROJECT_ID, twitter_id)
+                    f_in.seek(offset)
+                    item_row, twitter_item_row = tweet_rows(orjson.loads(f_in.readline()), item_id,
+                                                            settings.PROJECT_ID)
+                    items.append(item_row)
+                    tweets.append(twitter_item_row)
+                loader.load('item', items)
+                loader.load('twitter_item', tweets)
+                session.commit()
+
+                num_tweets += len(batch)
+                logger.debug(f'threads: looked at {num_tweets:,} tweets '
+                             f'({loader.stats["item"].merged:,} new, the others already existed)')
+
+        for qid in qids:
+            import_id = import_uuid(settings.PROJECT_ID, qid, delta)
+            if session.get(Import, import_id) is None:
+                logger.warning(f'Skipping implicit tweets of {qid}, which has no import.')
+                continue
+            for twitter_ids in store.iter_member_ids(qid, None if conv_ids is None else conv_ids.get(qid, []),
+                                                     batch_size=batch_size):
+                # tweets of earlier imports keep their (random) item id
+                existing = existing_item_ids(session, settings.PROJECT_ID, twitter_ids)
+                loader.load('m2m_import_item', [(existing.get(twitter_id) or item_uuid(settings.PROJECT_ID, twitter_id),
+                                                 import_id, 'implicit')
+                                                for twitter_id in twitter_ids])
+                session.commit()
+            logger.debug(f'{qid}: linked {loader.stats["m2m_import_item"].merged:,} implicit tweets so far')
+
+        loader.close()
+        session.commit()
+    return loader.stats
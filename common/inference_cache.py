@@ -0,0 +1,94 @@
+import sqlite3
+import hashlib
+import logging
+from pathlib import Path
+from collections import Counter
+from typing import Callable
+
+import numpy as np
+
+logger = logging.getLogger('inference-cache')
+
+
+def text_key(text: str) -> bytes:
+    return hashlib.blake2b(text.encode(), digest_size=16).digest()
+
+
+class InferenceCache:
+    """
+    Persistent cache of model outputs (`inference_cache.sqlite`), keyed by the name of the model and
+    the hash of the preprocessed text, so that reposts and texts that become identical after `prepare_tweet`
+    only go through the model once, across batches and runs. Outputs are stored as raw arrays of `dtype`
+    (e.g. float16 for embeddings), one row per text.
+    """
+
+    def __init__(self, target_dir: Path):
+        self.file = (target_dir / 'inference_cache.sqlite').resolve()
+        self.file.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(self.file, timeout=60)  # several inference workers may share the cache
+        self.db.execute('''CREATE TABLE IF NOT EXISTS output (
+                               model TEXT NOT NULL,
+                               key BLOB NOT NULL,
+                               value BLOB NOT NULL,
+                               PRIMARY KEY (model, key)
+                           ) WITHOUT ROWID;''')
+        self.db.commit()
+        self.hits: Counter[str] = Counter()
+        self.misses: Counter[str] = Counter()
+
+    def close(self):
+        self.db.close()
+
+    def get(self, model: str, texts: list[str], dtype: np.dtype) -> list[np.ndarray | None]:
+        keys = [text_key(text) for text in texts]
+        found = {}
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            found.update(self.db.execute(f'SELECT key, value FROM output '
+                                         f'WHERE model = ? AND key IN ({",".join("?" * len(chunk))});',
+                                         [model, *chunk]))
+        return [None if key not in found else np.frombuffer(found[key], dtype=dtype) for key in keys]
+
+    def put(self, model: str, texts: list[str], outputs: np.ndarray, dtype: np.dtype):
+        self.db.executemany('INSERT OR REPLACE INTO output (model, key, value) VALUES (?, ?, ?);',
+                            [(model, text_key(text), output.astype(dtype).tobytes())
+                             for text, output in zip(texts, outputs)])
+        self.db.commit()
+
+    def run_many(self, models: list[str], texts: list[str], compute: Callable[[list[str]], list[np.ndarray]],
+                 dtype: np.dtype) -> list[np.ndarray]:
+        """
+        Returns the outputs of each of `models` for `texts` (rows in the same order), looking them up in the cache
+        and calling `compute` (outputs of all models at once) only for the unique texts that are not cached
+        for at least one of the models.
+        """
+        cached = [self.get(model, texts, dtype) for model in models]
+        missing = list(dict.fromkeys(text for ti, text in enumerate(texts)
+                                     if any(cached_m[ti] is None for cached_m in cached)))
+        computed: list[dict[str, np.ndarray]] = [{} for _ in models]
+        if len(missing) > 0:
+            for mi, (model, outputs) in enumerate(zip(models, compute(missing))):
+                self.put(model, missing, outputs, dtype)
+                # round through the cache dtype, so that results do not depend on whether they were cached
+                computed[mi] = dict(zip(missing, np.asarray(outputs).astype(dtype)))
+
+        results = []
+        for mi, model in enumerate(models):
+            self.hits[model] += len(texts) - len(missing)
+            self.misses[model] += len(missing)
+            results.append(np.stack([computed[mi][text] if output is None else output
+                                     for text, output in zip(texts, cached[mi])]).astype(np.float32))
+        return results
+
+    def run(self, model: str, texts: list[str], compute: Callable[[list[str]], np.ndarray],
+            dtype: np.dtype) -> np.ndarray:
+        """
+        Same as `run_many` for a single model.
+        """
+        return self.run_many([model], texts, lambda batch: [compute(batch)], dtype)[0]
+
+    def report(self):
+        for model in self.hits.keys() | self.misses.keys():
+            total = self.hits[model] + self.misses[model]
+            logger.info(f'{model}: {self.hits[model]:,} of {total:,} texts from the cache '
+                        f'({self.hits[model] / max(total, 1):.1%} hit rate), {self.misses[model]:,} computed')
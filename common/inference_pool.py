@@ -0,0 +1,185 @@
+import os
+import copy
+import time
+import queue
+import logging
+import traceback
+import multiprocessing as mp
+from dataclasses import dataclass, field
+from typing import Any, Iterable, Protocol
+
+import torch
+
+logger = logging.getLogger('inference-pool')
+
+
+class Task(Protocol):
+    use_cache: bool
+
+    def setup(self, num_threads: int | None = None):
+        ...
+
+    def run(self, job: Any) -> int:
+        ...
+
+    def classify(self, texts: list[str]) -> Any:
+        ...
+
+    def close(self):
+        ...
+
+
+@dataclass
+class PoolStats:
+    items: int = 0
+    seconds: float = 0.  # from the start of the first job to the end of the last one, without loading models
+    per_worker: dict[int, int] = field(default_factory=dict)
+
+    @property
+    def items_per_second(self) -> float:
+        return self.items / self.seconds if self.seconds > 0 else 0.
+
+
+def available_cores() -> list[int]:
+    return sorted(os.sched_getaffinity(0))
+
+
+def available_memory() -> int:
+    # bytes of physical memory that are free right now (without caches the kernel could drop)
+    return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+
+def configurations(num_cores: int, max_workers: int | None = None) -> list[tuple[int, int]]:
+    """
+    (number of workers, threads per worker) that split `num_cores` evenly.
+    """
+    return [(num_workers, num_cores // num_workers) for num_workers in range(1, num_cores + 1)
+            if num_cores % num_workers == 0 and (max_workers is None or num_workers <= max_workers)]
+
+
+def _work(task: Task, worker_i: int, cores: list[int], jobs: mp.Queue, results: mp.Queue):
+    # runs in a worker process: pinned to `cores` with one intra-op thread per core
+    try:
+        os.sched_setaffinity(0, cores)
+        torch.set_num_threads(len(cores))
+        task.setup(num_threads=len(cores))
+        while (job := jobs.get()) is not None:
+            start = time.time()
+            num_items = task.run(job)
+            results.put((worker_i, num_items, start, time.time(), None))
+        task.close()
+        results.put((worker_i, None, 0., 0., None))
+    except BaseException:
+        results.put((worker_i, None, 0., 0., traceback.format_exc()))
+
+
+def run_pool(task: Task, jobs: Iterable[Any], num_workers: int, threads: int) -> PoolStats:
+    """
+    Starts `num_workers` processes, each pinned to its own `threads` cores, that take jobs from a shared queue
+    and pass them to their own copy of `task` (which loads its models in `setup` and writes its own results).
+    Raises if a worker fails.
+    """
+    cores = available_cores()
+    if num_workers * threads > len(cores):
+        raise ValueError(f'{num_workers} workers with {threads} threads need more than {len(cores)} cores.')
+
+    context = mp.get_context('spawn')
+    job_queue = context.Queue()
+    results = context.Queue()
+    for job in jobs:
+        job_queue.put(job)
+    for _ in range(num_workers):
+        job_queue.put(None)
+
+    processes = [context.Process(target=_work, name=f'inference-{worker_i}',
+                                 args=(task, worker_i, cores[worker_i * threads:(worker_i + 1) * threads],
+                                       job_queue, results))
+                 for worker_i in range(num_workers)]
+    for process in processes:
+        process.start()
+
+    stats = PoolStats(per_worker={worker_i: 0 for worker_i in range(num_workers)})
+    first_start = None
+    last_end = None
+    running = num_workers
+    try:
+        while running > 0:
+            try:
+                worker_i, num_items, start, end, error = results.get(timeout=1.)
+            except queue.Empty:
+                if any(process.exitcode not in (None, 0) for process in processes):
+                    raise RuntimeError('An inference worker died.')
+                continue
+            if error is not None:
+                raise RuntimeError(f'Inference worker {worker_i} failed:\n{error}')
+            if num_items is None:
+                running -= 1
+                continue
+            stats.items += num_items
+            stats.per_worker[worker_i] += num_items
+            first_start = start if first_start is None else min(first_start, start)
+            last_end = end if last_end is None else max(last_end, end)
+            logger.debug(f'Worker {worker_i} finished a job with {num_items:,} items ({stats.items:,} so far).')
+    except BaseException:
+        for process in processes:
+            process.terminate()
+        raise
+    finally:
+        for process in processes:
+            process.join()
+
+    if first_start is not None:
+        stats.seconds = last_end - first_start
+    return stats
+
+
+class CalibrationTask:
+    """
+    Only runs the inference of `task` on `texts` (in batches of `batch_size`), without the database and
+    without the inference cache, to measure the throughput of a pool configuration.
+    """
+
+    def __init__(self, task: Task, texts: list[str], batch_size: int = 500):
+        self.task = copy.copy(task)
+        self.task.use_cache = False
+        self.texts = texts
+        self.batch_size = batch_size
+
+    def setup(self, num_threads: int | None = None):
+        self.task.setup(num_threads=num_threads)
+
+    def run(self, job: Any) -> int:
+        for i in range(0, len(self.texts), self.batch_size):
+            self.task.classify(self.texts[i:i + self.batch_size])
+        return len(self.texts)
+
+    def close(self):
+        pass
+
+
+def calibrate(task: Task, texts: list[str], max_workers: int | None = None, worker_memory: float | None = None,
+              jobs_per_worker: int = 2, batch_size: int = 500) -> tuple[int, int]:
+    """
+    Tries the configurations of workers × threads on the available cores with a short run on `texts`
+    and returns the one with the highest throughput. Every worker loads its own models, so configurations
+    with more than `max_workers`, or with more workers than fit into the free memory at `worker_memory` bytes
+    each, are skipped.
+    """
+    if worker_memory is not None:
+        fit = max(1, int(available_memory() // worker_memory))
+        max_workers = fit if max_workers is None else min(max_workers, fit)
+    candidates = configurations(len(available_cores()), max_workers)
+    skipped = [config for config in configurations(len(available_cores())) if config not in candidates]
+    if len(skipped) > 0:
+        logger.info(f'Skipping {", ".join(f"{w} workers × {t} threads" for w, t in skipped)} '
+                    f'(at most {max_workers} workers).')
+
+    best = None
+    for num_workers, threads in candidates:
+        stats = run_pool(CalibrationTask(task, texts, batch_size=batch_size), range(num_workers * jobs_per_worker),
+                         num_workers=num_workers, threads=threads)
+        logger.info(f'{num_workers} workers × {threads} threads: {stats.items_per_second:,.1f} texts/s')
+        if best is None or stats.items_per_second > best[0]:
+            best = (stats.items_per_second, num_workers, threads)
+    logger.info(f'Using {best[1]} workers × {best[2]} threads.')
+    return best[1], best[2]
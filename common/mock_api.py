@@ -0,0 +1,247 @@
+import math
+import time
+import random
+import asyncio
+import hashlib
+import logging
+from datetime import datetime, timedelta
+from typing import Any
+
+import typer
+from aiohttp import web
+
+logger = logging.getLogger('mock-api')
+
+WORDS = ['carbon', 'capture', 'storage', 'climate', 'co2', 'removal', 'biochar', 'ocean', 'negative', 'emissions',
+         'direct', 'air', 'the', 'a', 'is', 'of', 'we', 'need', 'more', 'less', 'new', 'report', 'study', 'plan']
+
+
+def fake_user(rng: random.Random, user_id: int) -> dict[str, Any]:
+    return {
+        'id': str(user_id),
+        'name': f'User {user_id}',
+        'username': f'user{user_id}',
+        'created_at': '2010-05-12T08:13:37.000Z',
+        'verified': rng.random() < 0.05,
+        'description': ' '.join(rng.choices(WORDS, k=12)),
+        'location': 'Earth',
+        'public_metrics': {
+            'followers_count': rng.randint(0, 10000),
+            'following_count': rng.randint(0, 2000),
+            'tweet_count': rng.randint(1, 50000),
+            'listed_count': rng.randint(0, 100)
+        }
+    }
+
+
+def fake_tweet(rng: random.Random, tweet_id: int, author_id: int, created_at: datetime) -> dict[str, Any]:
+    words = rng.choices(WORDS, k=rng.randint(5, 45))
+    text = ' '.join(words)
+    tweet = {
+        'id': str(tweet_id),
+        'author_id': str(author_id),
+        'conversation_id': str(tweet_id if rng.random() < 0.6 else tweet_id - rng.randint(1, 5) * (1 << 32)),
+        'created_at': created_at.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+        'lang': 'en',
+        'text': text,
+        'public_metrics': {
+            'retweet_count': rng.randint(0, 50),
+            'reply_count': rng.randint(0, 10),
+            'like_count': rng.randint(0, 200),
+            'quote_count': rng.randint(0, 5)
+        },
+        'entities': {
+            'hashtags': [{'start': 0, 'end': len(words[0]) + 1, 'tag': words[0]}],
+            'mentions': [{'start': 0, 'end': 8, 'username': f'user{author_id + 1}', 'id': str(author_id + 1)}],
+            'urls': [{'start': 0, 'end': 23, 'url': 'https://t.co/abcdefghij',
+                      'expanded_url': 'https://example.com/article'}]
+        },
+        'context_annotations': [{'domain': {'id': '123', 'name': 'Interests and Hobbies Vertical'},
+                                 'entity': {'id': '456', 'name': 'Climate change'}}]
+    }
+    if rng.random() < 0.3:
+        tweet['referenced_tweets'] = [{'id': str(tweet_id - 1), 'type': 'replied_to'}]
+    return tweet
+
+
+def fake_tweets(num_texts: int, seed: int = 42) -> list[str]:
+    # word counts of tweets are skewed: many short tweets and a long tail up to the 280 character limit
+    rng = random.Random(seed)
+    texts = []
+    for _ in range(num_texts):
+        num_words = min(55, max(1, int(rng.lognormvariate(2.6, 0.7))))
+        words = [rng.choice(WORDS) if rng.random() > 0.1 else rng.choice(['@user1', 'https://t.co/abc', '#cdr'])
+                 for _ in range(num_words)]
+        texts.append(' '.join(words))
+    return texts
+
+
+def _parse_time(value: str | None, default: datetime) -> datetime:
+    if value is None:
+        return default
+    return datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S')
+
+
+class FakeCorpus:
+    """
+    Deterministic fake result set for a query with `num_tweets` tweets evenly spread between
+    `start` and `end`. Tweet `k` (counting from the newest) is always the same, no matter which
+    time window or page it is requested with, so sharded and unsharded downloads are comparable.
+    """
+
+    def __init__(self, query: str, num_tweets: int,
+                 start: datetime = datetime(2006, 3, 21), end: datetime = datetime(2022, 12, 31)):
+        self.query = query
+        self.num_tweets = num_tweets
+        self.start = start
+        self.end = end
+        self.step = (end - start) / num_tweets
+        self.query_hash = int(hashlib.md5(query.encode()).hexdigest()[:8], 16)
+
+    def created_at(self, k: int) -> datetime:
+        return self.end - self.step * (k + 1)
+
+    def tweet_range(self, start_time: datetime, end_time: datetime) -> range:
+        # tweets with start_time <= created_at < end_time
+        first = max(0, math.ceil((self.end - end_time) / self.step - 1 + 1e-9))
+        last = min(self.num_tweets, math.floor((self.end - start_time) / self.step - 1) + 1)
+        return range(first, max(first, last))
+
+    def tweet(self, k: int) -> tuple[dict[str, Any], dict[str, Any]]:
+        rng = random.Random(self.query_hash * 1000003 + k)
+        created_at = self.created_at(k)
+        tweet_id = (int(created_at.timestamp() * 1000) << 22) | (self.query_hash & 0x3fffff)
+        author_id = rng.randint(1, max(10, self.num_tweets // 20))
+        return fake_tweet(rng, tweet_id, author_id, created_at), fake_user(rng, author_id)
+
+    def page(self, start_time: datetime, end_time: datetime, page_idx: int, page_size: int = 100) -> dict[str, Any]:
+        """
+        Generates page `page_idx` of the search result within the given time window in the
+        layout of the Twitter API v2 (newest tweets first, authors expanded in `includes`).
+        """
+        window = self.tweet_range(start_time, end_time)
+        ks = window[page_idx * page_size:(page_idx + 1) * page_size]
+
+        authors = {}
+        tweets = []
+        for k in ks:
+            tweet, user = self.tweet(k)
+            tweets.append(tweet)
+            authors[user['id']] = user
+
+        meta: dict[str, Any] = {'result_count': len(tweets)}
+        if len(tweets) == 0:
+            return {'meta': meta}
+        meta['newest_id'] = tweets[0]['id']
+        meta['oldest_id'] = tweets[-1]['id']
+        if (page_idx + 1) * page_size < len(window):
+            meta['next_token'] = str(page_idx + 1)
+        return {'data': tweets, 'includes': {'users': list(authors.values())}, 'meta': meta}
+
+    def counts(self, start_time: datetime, end_time: datetime, page_idx: int, granularity: str = 'day',
+               buckets_per_page: int = 31) -> dict[str, Any]:
+        size = timedelta(hours=1) if granularity == 'hour' else timedelta(days=1)
+        bucket_start = start_time + size * page_idx * buckets_per_page
+        data = []
+        while bucket_start < end_time and len(data) < buckets_per_page:
+            bucket_end = min(bucket_start + size, end_time)
+            data.append({'start': bucket_start.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+                         'end': bucket_end.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+                         'tweet_count': len(self.tweet_range(bucket_start, bucket_end))})
+            bucket_start = bucket_end
+
+        meta: dict[str, Any] = {'total_tweet_count': sum(d['tweet_count'] for d in data)}
+        if bucket_start < end_time:
+            meta['next_token'] = str(page_idx + 1)
+        return {'data': data, 'meta': meta}
+
+
+def make_app(page_size: int = 100,
+             num_pages: int = 10,
+             latency: float = 0.2,
+             rate_limit: int = 300,
+             rate_window: float = 900.,
+             thread_pages: int = 1) -> web.Application:
+    """
+    Local stand-in for the full-archive search endpoint at `/2/tweets/search/all` (and the
+    counts endpoint at `/2/tweets/counts/all`). Every query matches `num_pages` pages of tweets,
+    batched `conversation_id:` queries (see `common.threads`) match `thread_pages` pages.
+    Each request takes `latency` seconds and the server enforces a fixed-window rate limit
+    of `rate_limit` requests per `rate_window` seconds, reported via `x-rate-limit-*` headers.
+    """
+    state = {'window_start': time.time(), 'used': 0}
+
+    def rate_limit_headers() -> tuple[dict[str, str], bool]:
+        now = time.time()
+        if now - state['window_start'] >= rate_window:
+            state['window_start'] = now
+            state['used'] = 0
+        state['used'] += 1
+        return {
+            'x-rate-limit-limit': str(rate_limit),
+            'x-rate-limit-remaining': str(max(0, rate_limit - state['used'])),
+            'x-rate-limit-reset': str(int(state['window_start'] + rate_window))
+        }, state['used'] > rate_limit
+
+    def window(request: web.Request) -> tuple[FakeCorpus, datetime, datetime, int]:
+        query = request.query['query']
+        corpus = FakeCorpus(query, num_tweets=page_size * (thread_pages if query.startswith('(conversation_id:')
+                                                           else num_pages))
+        start_time = _parse_time(request.query.get('start_time'), corpus.start)
+        if 'since_id' in request.query:
+            # fake tweet ids carry their creation time in milliseconds (like snowflake ids)
+            start_time = datetime.fromtimestamp(((int(request.query['since_id']) >> 22) + 1) / 1000)
+        return (corpus,
+                max(corpus.start, start_time),
+                min(corpus.end, _parse_time(request.query.get('end_time'), corpus.end)),
+                int(request.query.get('next_token', 0)))
+
+    async def search(request: web.Request) -> web.Response:
+        headers, exceeded = rate_limit_headers()
+        if exceeded:
+            return web.json_response({'title': 'Too Many Requests'}, status=429, headers=headers)
+
+        await asyncio.sleep(latency)
+        corpus, start_time, end_time, page_idx = window(request)
+        page = corpus.page(start_time, end_time, page_idx,
+                           page_size=int(request.query.get('max_results', page_size)))
+        return web.json_response(page, headers=headers)
+
+    async def counts(request: web.Request) -> web.Response:
+        headers, exceeded = rate_limit_headers()
+        if exceeded:
+            return web.json_response({'title': 'Too Many Requests'}, status=429, headers=headers)
+
+        await asyncio.sleep(latency)
+        corpus, start_time, end_time, page_idx = window(request)
+        page = corpus.counts(start_time, end_time, page_idx, granularity=request.query.get('granularity', 'day'))
+        return web.json_response(page, headers=headers)
+
+    app = web.Application()
+    app.router.add_get('/2/tweets/search/all', search)
+    app.router.add_get('/2/tweets/counts/all', counts)
+    return app
+
+
+async def start_server(app: web.Application, port: int = 8080) -> web.AppRunner:
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, 'localhost', port).start()
+    logger.info(f'Mock API listening at http://localhost:{port}/2/tweets/search/all')
+    return runner
+
+
+def main(port: int = 8080,
+         page_size: int = 100,
+         num_pages: int = 10,
+         latency: float = 0.2,
+         rate_limit: int = 300,
+         rate_window: float = 900.):
+    logging.basicConfig(format='%(asctime)s [%(levelname)s] %(name)s: %(message)s', level=logging.INFO)
+    web.run_app(make_app(page_size=page_size, num_pages=num_pages, latency=latency,
+                         rate_limit=rate_limit, rate_window=rate_window),
+                host='localhost', port=port)
+
+
+if __name__ == '__main__':
+    typer.run(main)
@@ -1,5 +1,11 @@
 from pathlib import Path
 import os
+import time
+import pickle
+import inspect
+import logging
+from collections import Counter
+import torch
 from transformers import (AutoModel,
                           AutoModelForSequenceClassification,
                           AutoTokenizer, TextClassificationPipeline, AutoConfig)
@@ -10,6 +16,18 @@ from dataclasses import dataclass
 import numpy as np
 from abc import ABC, abstractmethod
 from sentence_transformers import SentenceTransformer
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.linear_model import LogisticRegression
+
+from common.inference_cache import InferenceCache
+
+logger = logging.getLogger('models')
+
+SENTIMENT_LABELS = {
+    'negative': 0,
+    'neutral': 1,
+    'positive': 2
+}
 
 
 def prepare_tweet(text: str):
@@ -22,12 +40,175 @@ def prepare_tweet(text: str):
     ])
 
 
+def token_batches(lengths: list[int], max_tokens: int, max_batch_size: int) -> list[list[int]]:
+    """
+    Groups the indices of texts with `lengths` (in tokens) into batches of similar length, so that little padding
+    is needed. A batch grows as long as it stays below `max_tokens` once padded to its longest text.
+    """
+    batches = []
+    batch: list[int] = []
+    longest = 0
+    for i in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+        if len(batch) > 0 and (max(longest, lengths[i]) * (len(batch) + 1) > max_tokens
+                               or len(batch) >= max_batch_size):
+            batches.append(batch)
+            batch = []
+            longest = 0
+        batch.append(i)
+        longest = max(longest, lengths[i])
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
+
+
+def run_batched(tokenizer, texts: list[str], forward, max_tokens: int, max_batch_size: int,
+                max_length: int | None = None, device: torch.device | None = None) -> np.ndarray:
+    """
+    Tokenizes `texts` once, runs `forward` (padded tensors -> numpy array) on batches formed by `token_batches`,
+    and returns the outputs in the original order of `texts`.
+    """
+    return run_batched_heads(tokenizer, texts, [forward], max_tokens, max_batch_size,
+                             max_length=max_length, device=device)[0]
+
+
+def run_batched_heads(tokenizer, texts: list[str], forwards: list, max_tokens: int, max_batch_size: int,
+                      max_length: int | None = None, device: torch.device | None = None) -> list[np.ndarray]:
+    """
+    Same as `run_batched` for several models that share the tokenizer: every padded batch is passed to each
+    of `forwards`. Returns the outputs of each model.
+    """
+    encodings = tokenizer(texts, truncation=True, max_length=max_length)
+    results: list[np.ndarray | None] = [None] * len(forwards)
+    for batch in token_batches([len(ids) for ids in encodings['input_ids']], max_tokens, max_batch_size):
+        inputs = tokenizer.pad({key: [encodings[key][i] for i in batch] for key in encodings.keys()},
+                               return_tensors='pt')
+        if device is not None:
+            inputs = inputs.to(device)
+        for fi, forward in enumerate(forwards):
+            with torch.inference_mode():
+                outputs = forward(inputs)
+            if results[fi] is None:
+                results[fi] = np.empty((len(texts), *outputs.shape[1:]), dtype=outputs.dtype)
+            results[fi][batch] = outputs
+    return results
+
+
+Backend = Literal['torch', 'onnx', 'onnx-int8']
+
+
+def export_onnx(hf_name: str, cache_dir: Path, quantize: bool = False) -> Path:
+    """
+    Exports the sequence classification model `hf_name` to `{cache_dir}/onnx/model.onnx` (dynamic batch and sequence
+    axes) and, with `quantize`, its weights with dynamic int8 quantization to `model.int8.onnx`. Existing files are reused.
+    Files are written under a temporary name and renamed when complete, so processes that export at the same time
+    never read a partial file (but better export once before starting them, see `ClassifyTask.prepare`).
+    """
+    target = cache_dir / 'onnx'
+    file_fp32 = target / 'model.onnx'
+    file_int8 = target / 'model.int8.onnx'
+    if not file_fp32.exists():
+        target.mkdir(parents=True, exist_ok=True)
+        tokenizer = AutoTokenizer.from_pretrained(hf_name, cache_dir=str(cache_dir))
+        model = AutoModelForSequenceClassification.from_pretrained(hf_name, cache_dir=str(cache_dir))
+        model.config.return_dict = False
+        model.eval()
+
+        dummy = tokenizer(['a tweet about carbon removal'], return_tensors='pt')
+        # positional inputs in the order of the signature of `forward`
+        input_names = [name for name in inspect.signature(model.forward).parameters if name in dummy]
+        tmp = target / f'model.onnx.{os.getpid()}.tmp'
+        with torch.inference_mode():
+            torch.onnx.export(model, tuple(dummy[name] for name in input_names), str(tmp),
+                              input_names=input_names,
+                              output_names=['logits'],
+                              dynamic_axes={**{name: {0: 'batch', 1: 'sequence'} for name in input_names},
+                                            'logits': {0: 'batch'}},
+                              opset_version=14)
+        os.replace(tmp, file_fp32)
+    if not quantize:
+        return file_fp32
+
+    if not file_int8.exists():
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        tmp = target / f'model.int8.onnx.{os.getpid()}.tmp'
+        quantize_dynamic(str(file_fp32), str(tmp), weight_type=QuantType.QInt8)
+        os.replace(tmp, file_int8)
+    return file_int8
+
+
+def onnx_session(file: Path, num_threads: int | None = None):
+    import onnxruntime as ort
+
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    if num_threads is not None:
+        options.intra_op_num_threads = num_threads
+        options.inter_op_num_threads = 1
+    return ort.InferenceSession(str(file), options, providers=['CPUExecutionProvider'])
+
+
+def agreement(scores: list[dict[str, float]], reference: list[dict[str, float]]) -> tuple[float, float]:
+    """
+    Share of texts for which `scores` and `reference` (both from `Classifier.classify(..., return_all_scores=True)`)
+    agree on the top label, and the largest absolute difference of any score.
+    """
+    if len(reference) == 0:
+        return 1., 0.
+    same = sum(max(a, key=a.get) == max(b, key=b.get) for a, b in zip(scores, reference))
+    deviation = max(abs(a[label] - b[label]) for a, b in zip(scores, reference) for label in b)
+    return same / len(reference), deviation
+
+
+class NgramClassifier:
+    """
+    Cheap first stage of a classifier cascade (see `Classifier.cascade`): a linear model on hashed
+    character n-grams (within words), trained on the labels of the full model.
+    """
+
+    def __init__(self, n_features: int = 2 ** 18, C: float = 4.):
+        self.vectorizer = HashingVectorizer(analyzer='char_wb', ngram_range=(2, 5), n_features=n_features,
+                                            alternate_sign=False, norm='l2')
+        self.model = LogisticRegression(C=C, max_iter=1000)
+
+    def fit(self, texts: list[str], labels: list[str]) -> 'NgramClassifier':
+        self.model.fit(self.vectorizer.transform(texts), labels)
+        return self
+
+    def predict_proba(self, texts: list[str]) -> list[dict[str, float]]:
+        probabilities = self.model.predict_proba(self.vectorizer.transform(texts))
+        return [{label: float(p) for label, p in zip(self.model.classes_, probabilities_i)}
+                for probabilities_i in probabilities]
+
+    def save(self, file: Path):
+        file.parent.mkdir(parents=True, exist_ok=True)
+        with open(file, 'wb') as f:
+            pickle.dump(self, f)
+
+    @staticmethod
+    def load(file: Path) -> 'NgramClassifier':
+        with open(file, 'rb') as f:
+            return pickle.load(f)
+
+
 class Classifier:
-    def __init__(self, hf_name: str, cache_dir: Path):
+    def __init__(self, hf_name: str, cache_dir: Path, max_tokens: int = 8192, max_batch_size: int = 256,
+                 cache: InferenceCache | None = None):
         self.hf_name = hf_name
+        self.cache = cache  # scores of texts that were classified before
+        self.first_stage: NgramClassifier | None = None
+        self.threshold = 1.
+        self.cascade_stats: Counter[str] = Counter()
         self._classifier: TextClassificationPipeline | None = None
         self._config: AutoConfig | None = None
         self._cache = cache_dir
+        self.max_tokens = max_tokens  # padded tokens per batch
+        self.max_batch_size = max_batch_size
+        self.backend: Backend | None = None
+        self._tokenizer = None
+        self._forward = None  # padded inputs -> logits (numpy)
+        self._device: torch.device | None = None
+        self.tokenizer_key: tuple | None = None  # classifiers with the same key can share the tokenization
 
     # def store(self, target_dir: Path):
     #     target_dir.mkdir(parents=True, exist_ok=True)
@@ -48,32 +229,150 @@ class Classifier:
     #     tokenizer = AutoTokenizer.from_pretrained(self.hf_name)
     #     tokenizer.save_pretrained(target)
 
-    def load(self):
-        if self._classifier is None:
+    def load_config(self) -> 'Classifier':
+        """
+        Only loads the config of the model (e.g. for its `labels`), without the model itself.
+        """
+        if self._config is None:
+            self._cache.mkdir(parents=True, exist_ok=True)
+            self._config = AutoConfig.from_pretrained(self.hf_name, cache_dir=str(self._cache))
+        return self
+
+    def load(self, backend: Backend = 'torch', num_threads: int | None = None):
+        """
+        Loads the model for inference with PyTorch (`torch`) or with ONNX Runtime on the CPU (`onnx`, or `onnx-int8`
+        for dynamically quantized weights), exporting the model first if needed (see `export_onnx`).
+        """
+        if self._forward is None:
             self._cache.mkdir(parents=True, exist_ok=True)
             target = str(self._cache)
 
-            tokenizer = AutoTokenizer.from_pretrained(self.hf_name, cache_dir=target)
-            model = AutoModelForSequenceClassification.from_pretrained(self.hf_name, cache_dir=target)
-            self._config = AutoConfig.from_pretrained(self.hf_name, cache_dir=target)
-            self._classifier = TextClassificationPipeline(model=model, tokenizer=tokenizer)
+            self._tokenizer = AutoTokenizer.from_pretrained(self.hf_name, cache_dir=target)
+            self.load_config()
+            if backend == 'torch':
+                if num_threads is not None:
+                    torch.set_num_threads(num_threads)
+                model = AutoModelForSequenceClassification.from_pretrained(self.hf_name, cache_dir=target)
+                self._classifier = TextClassificationPipeline(model=model, tokenizer=self._tokenizer)
+                self._forward = lambda inputs: model(**inputs).logits.cpu().numpy()
+                self._device = model.device
+            else:
+                session = onnx_session(export_onnx(self.hf_name, self._cache, quantize=backend == 'onnx-int8'),
+                                       num_threads=num_threads)
+                input_names = [node.name for node in session.get_inputs()]
+                self._forward = lambda inputs: session.run(['logits'], {name: inputs[name].numpy()
+                                                                        for name in input_names})[0]
+            self.backend = backend
+            self.tokenizer_key = (type(self._tokenizer).__name__, self._tokenizer.model_max_length,
+                                  hash(frozenset(self._tokenizer.get_vocab().items())))
+
+    @property
+    def model_key(self) -> str:
+        return f'{self.hf_name}/{self.backend}'
+
+    @property
+    def labels(self) -> dict[str, int]:
+        return {label: int(li) for li, label in self._config.id2label.items()}
 
     @staticmethod
     def preprocess(texts: list[str]):
         return [prepare_tweet(text) for text in texts]
 
+    def cascade(self, first_stage: NgramClassifier | None, threshold: float = 0.9):
+        """
+        Lets `first_stage` label all texts and only escalates those to the full model, for which the first stage
+        is less confident than `threshold` (probability of its top label). `None` turns the cascade off.
+        """
+        self.first_stage = first_stage
+        self.threshold = threshold
+        self.cascade_stats.clear()
+
+    def report_cascade(self):
+        texts, escalated = self.cascade_stats['texts'], self.cascade_stats['escalated']
+        if texts == 0:
+            return
+        logger.info(f'Cascade: {escalated:,} of {texts:,} texts escalated to the full model '
+                    f'({escalated / texts:.1%}), {self.cascade_stats["first_seconds"]:.1f}s in the first stage, '
+                    f'{self.cascade_stats["full_seconds"]:.1f}s in the full model')
+
+    def _classify_full(self, texts: list[str]) -> list[dict[str, float]]:
+        return _run_heads([self], texts)[0]
+
     def classify(self, texts: list[str], return_all_scores: bool = False):
-        scores = self._classifier(texts, top_k=None if return_all_scores else 1)
+        if len(texts) == 0:
+            return []
+
+        if self.first_stage is None:
+            scores = self._classify_full(texts)
+        else:
+            start = time.perf_counter()
+            scores = self.first_stage.predict_proba(texts)
+            escalate = [i for i, scores_i in enumerate(scores) if max(scores_i.values()) < self.threshold]
+            self.cascade_stats['first_seconds'] += time.perf_counter() - start
+
+            start = time.perf_counter()
+            if len(escalate) > 0:
+                for i, scores_i in zip(escalate, self._classify_full([texts[i] for i in escalate])):
+                    scores[i] = scores_i
+            self.cascade_stats['full_seconds'] += time.perf_counter() - start
+            self.cascade_stats['texts'] += len(texts)
+            self.cascade_stats['escalated'] += len(escalate)
+
         if return_all_scores:
-            return [{score['label']: score['score'] for score in scores_i} for scores_i in scores]
-        return [{score['label']: score['score']} for score in scores]
+            return scores
+        return [{max(scores_i, key=scores_i.get): max(scores_i.values())} for scores_i in scores]
+
+
+def _run_heads(heads: list[Classifier], texts: list[str]) -> list[list[dict[str, float]]]:
+    # full models of `heads` on the same device with the same tokenizer (and cache): one tokenization and
+    # one padded batch for all of them
+    def compute(batch: list[str]) -> list[np.ndarray]:
+        outputs = run_batched_heads(heads[0]._tokenizer, batch, [head._forward for head in heads],
+                                    max_tokens=min(head.max_tokens for head in heads),
+                                    max_batch_size=min(head.max_batch_size for head in heads),
+                                    device=heads[0]._device)
+        return [softmax(logits, axis=-1) for logits in outputs]
+
+    if heads[0].cache is None:
+        scores = compute(texts)
+    else:
+        scores = heads[0].cache.run_many([head.model_key for head in heads], texts, compute, dtype=np.float32)
+    return [[{head._config.id2label[li]: float(score) for li, score in enumerate(scores_i)} for scores_i in scores_h]
+            for head, scores_h in zip(heads, scores)]
+
+
+def classify_heads(classifiers: list[Classifier], texts: list[str]) -> list[list[dict[str, float]]]:
+    """
+    Classifies `texts` with all `classifiers` in a single pass and returns the scores of each
+    (as `Classifier.classify(..., return_all_scores=True)`). Classifiers with identical tokenizers (and the same
+    device and cache) share the tokenization, batching, and padding of the texts; classifiers with a cascade
+    run on their own.
+    """
+    if len(texts) == 0:
+        return [[] for _ in classifiers]
+    results: list[list[dict[str, float]] | None] = [None] * len(classifiers)
+    groups: dict[tuple, list[int]] = {}
+    for ci, classifier in enumerate(classifiers):
+        if classifier.first_stage is not None:
+            results[ci] = classifier.classify(texts, return_all_scores=True)
+        else:
+            groups.setdefault((classifier.tokenizer_key, str(classifier._device), id(classifier.cache)), []).append(ci)
+
+    for group in groups.values():
+        for ci, scores in zip(group, _run_heads([classifiers[ci] for ci in group], texts)):
+            results[ci] = scores
+    return results
 
 
 class Embedder:
-    def __init__(self, hf_name: str, cache_dir: Path):
+    def __init__(self, hf_name: str, cache_dir: Path, max_tokens: int = 16384, max_batch_size: int = 512,
+                 cache: InferenceCache | None = None):
         self.hf_name = hf_name
+        self.cache = cache  # vectors (as float16) of texts that were embedded before
         self._model: SentenceTransformer | None = None
         self._cache = cache_dir
+        self.max_tokens = max_tokens  # padded tokens per batch
+        self.max_batch_size = max_batch_size
 
     def load(self):
         if self._model is None:
@@ -87,4 +386,15 @@ class Embedder:
         return [prepare_tweet(text) for text in texts]
 
     def embed(self, texts: list[str]) -> np.ndarray:
-        return self._model.encode(texts, convert_to_numpy=True)
+        if len(texts) == 0:
+            return np.empty((0, self._model.get_sentence_embedding_dimension()), dtype=np.float32)
+
+        def compute(batch: list[str]) -> np.ndarray:
+            return run_batched(self._model.tokenizer, batch,
+                               forward=lambda inputs: self._model(inputs)['sentence_embedding'].cpu().numpy(),
+                               max_tokens=self.max_tokens, max_batch_size=self.max_batch_size,
+                               max_length=self._model.max_seq_length, device=self._model.device)
+
+        if self.cache is None:
+            return compute(texts)
+        return self.cache.run(self.hf_name, texts, compute, dtype=np.float16)
@@ -0,0 +1,160 @@
+import shutil
+import logging
+from pathlib import Path
+from typing import Any, Generator
+
+import typer
+import orjson
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.dataset as ds
+
+from common.queries import queries
+from common.config import settings
+from common.twitter import parse_timestamp
+
+logger = logging.getLogger('parquet-store')
+
+# Columnar export of the downloaded tweets for analyses; the importer (02) still reads the jsonl files.
+# Thread tweets belong to the conversations of many sub-queries, they are stored once under this qid
+# (`common.threads.ThreadStore` knows which conversations belong to which sub-query).
+THREADS_QID = 'threads'
+
+_entity = {'start': pa.int32(), 'end': pa.int32()}
+
+USER_SCHEMA = pa.struct([
+    ('id', pa.string()),
+    ('name', pa.string()),
+    ('username', pa.string()),
+    ('created_at', pa.timestamp('s')),
+    ('verified', pa.bool_()),
+    ('description', pa.string()),
+    ('location', pa.string()),
+    ('followers_count', pa.int64()),
+    ('following_count', pa.int64()),
+    ('tweet_count', pa.int64()),
+    ('listed_count', pa.int64())
+])
+
+# columns of `TwitterItemModel` plus the partitioning columns
+SCHEMA = pa.schema([
+    ('twitter_id', pa.string()),
+    ('twitter_author_id', pa.string()),
+    ('text', pa.string()),
+    ('created_at', pa.timestamp('s')),
+    ('language', pa.string()),
+    ('conversation_id', pa.string()),
+    ('referenced_tweets', pa.list_(pa.struct([('id', pa.string()), ('type', pa.string())]))),
+    ('annotations', pa.list_(pa.struct([('domain_id', pa.string()), ('domain_name', pa.string()),
+                                        ('entity_id', pa.string()), ('entity_name', pa.string())]))),
+    ('latitude', pa.float64()),
+    ('longitude', pa.float64()),
+    ('hashtags', pa.list_(pa.struct([*_entity.items(), ('tag', pa.string())]))),
+    ('mentions', pa.list_(pa.struct([*_entity.items(), ('username', pa.string()), ('user_id', pa.string())]))),
+    ('urls', pa.list_(pa.struct([*_entity.items(), ('url', pa.string()), ('url_expanded', pa.string())]))),
+    ('cashtags', pa.list_(pa.struct([*_entity.items(), ('tag', pa.string())]))),
+    ('retweet_count', pa.int32()),
+    ('reply_count', pa.int32()),
+    ('like_count', pa.int32()),
+    ('quote_count', pa.int32()),
+    ('user', USER_SCHEMA),
+    ('qid', pa.string()),
+    ('year', pa.int16()),
+    ('month', pa.int8())
+])
+PARTITIONING = ds.partitioning(pa.schema([('qid', pa.string()), ('year', pa.int16()), ('month', pa.int8())]),
+                               flavor='hive')
+
+
+def _to_row(tweet: dict[str, Any], qid: str) -> dict[str, Any]:
+    created_at = parse_timestamp(tweet['created_at'])
+    tweet['created_at'] = created_at
+    if tweet.get('user') and tweet['user'].get('created_at'):
+        tweet['user']['created_at'] = parse_timestamp(tweet['user']['created_at'])
+    tweet['qid'] = qid
+    tweet['year'] = created_at.year
+    tweet['month'] = created_at.month
+    return tweet
+
+
+def iter_batches(file: Path, qid: str, batch_size: int = 50000) -> Generator[pa.Table, None, None]:
+    rows = []
+    with open(file, 'rb') as f_in:
+        for line in f_in:
+            rows.append(_to_row(orjson.loads(line), qid))
+            if len(rows) >= batch_size:
+                yield pa.Table.from_pylist(rows, schema=SCHEMA)
+                rows = []
+    if rows:
+        yield pa.Table.from_pylist(rows, schema=SCHEMA)
+
+
+def jsonl_to_parquet(file: Path, qid: str, root: Path, batch_size: int = 50000,
+                     replace: bool = True, tag: str | None = None) -> int:
+    """
+    Writes the tweets of `qid` from a jsonl file into the dataset at `root`, which is partitioned
+    as `qid=.../year=.../month=.../*.parquet`. Existing data for this qid is replaced, unless `replace`
+    is turned off (e.g. to add a delta, in which case the file names are marked with `tag`).
+    """
+    if replace:
+        shutil.rmtree(root / f'qid={qid}', ignore_errors=True)
+    prefix = qid if tag is None else f'{qid}-{tag}'
+
+    num_tweets = 0
+    for bi, table in enumerate(iter_batches(file, qid, batch_size=batch_size)):
+        pq.write_to_dataset(table, root,
+                            partitioning=PARTITIONING,
+                            basename_template=f'{prefix}-{bi:05d}-{{i}}.parquet',
+                            existing_data_behavior='overwrite_or_ignore',
+                            compression='zstd')
+        num_tweets += table.num_rows
+    logger.info(f'Wrote {num_tweets:,} tweets for {qid} to {root}')
+    return num_tweets
+
+
+def dataset(root: Path | str | None = None) -> ds.Dataset:
+    if root is None:
+        root = Path(settings.DATA_RAW_TWEETS) / 'parquet'
+    return ds.dataset(root, format='parquet', schema=SCHEMA, partitioning=PARTITIONING)
+
+
+def read_tweets(root: Path | str | None = None,
+                columns: list[str] | None = None,
+                qids: list[str] | None = None,
+                years: tuple[int, int] | None = None) -> pa.Table:
+    """
+    Reads only the requested `columns` of the tweets from the given sub-queries and range of years (inclusive).
+    Filters on the partitioning columns skip the respective files entirely, filters on other columns
+    are pushed down to the row group statistics.
+    """
+    expr = None
+    if qids is not None:
+        expr = ds.field('qid').isin(qids)
+    if years is not None:
+        year_expr = (ds.field('year') >= years[0]) & (ds.field('year') <= years[1])
+        expr = year_expr if expr is None else expr & year_expr
+    return dataset(root).to_table(columns=columns, filter=expr)
+
+
+# Converts already downloaded `{qid}_explicit.jsonl` files and the thread tweets (`threads.jsonl`)
+# into the parquet dataset.
+def main(source_dir: str | None = None,
+         target_dir: str | None = None,
+         batch_size: int = 50000):
+    logging.basicConfig(format='%(asctime)s [%(levelname)s] %(name)s: %(message)s', level=logging.INFO)
+    source = Path(source_dir or settings.DATA_RAW_TWEETS)
+    target = Path(target_dir) if target_dir else source / 'parquet'
+
+    for cat, sub_queries in queries.items():
+        for entry in sub_queries:
+            file = (source / f'{entry["qid"]}_explicit.jsonl').resolve()
+            if file.exists():
+                jsonl_to_parquet(file, entry['qid'], target, batch_size=batch_size)
+
+    file_threads = (source / 'threads.jsonl').resolve()
+    if file_threads.exists():
+        jsonl_to_parquet(file_threads, THREADS_QID, target, batch_size=batch_size)
+
+
+if __name__ == '__main__':
+    typer.run(main)
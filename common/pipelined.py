@@ -0,0 +1,131 @@
+import time
+import queue
+import logging
+import threading
+from dataclasses import dataclass
+from typing import Any, Callable, Iterable
+
+logger = logging.getLogger('pipelined')
+
+_DONE = object()
+
+
+@dataclass
+class StageTimes:
+    items: int = 0
+    busy: float = 0.  # seconds spent doing the actual work of the stage
+    waiting: float = 0.  # seconds spent blocked on the queues before or after the stage
+
+    @property
+    def utilisation(self) -> float:
+        total = self.busy + self.waiting
+        return self.busy / total if total > 0 else 0.
+
+
+def log_times(times: dict[str, StageTimes]):
+    for stage, stage_times in times.items():
+        logger.info(f'{stage}: {stage_times.items:,} batches, {stage_times.busy:.1f}s busy, '
+                    f'{stage_times.waiting:.1f}s waiting ({stage_times.utilisation:.0%} utilised)')
+    bottleneck = max(times, key=lambda stage: times[stage].busy)
+    logger.info(f'Bottleneck: {bottleneck}')
+
+
+def _put(q: queue.Queue, item: Any, stop: threading.Event, times: StageTimes) -> bool:
+    # blocks until there is room in the queue, unless the pipeline was stopped
+    start = time.perf_counter()
+    try:
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+    finally:
+        times.waiting += time.perf_counter() - start
+
+
+def _get(q: queue.Queue, stop: threading.Event, times: StageTimes) -> Any:
+    # blocks until there is an item in the queue, returns `_DONE` if the pipeline was stopped
+    start = time.perf_counter()
+    try:
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return _DONE
+    finally:
+        times.waiting += time.perf_counter() - start
+
+
+def run_pipelined(batches: Iterable[Any],
+                  infer: Callable[[Any], Any],
+                  write: Callable[[Any], None],
+                  queue_size: int = 2) -> dict[str, StageTimes]:
+    """
+    Runs `write(infer(batch))` for all `batches` as a pipeline of three stages connected by bounded queues:
+    a reader thread prefetches batches (i.e. iterates `batches`, which should use its own database session),
+    `infer` runs in the calling thread, and a writer thread stores the results (with its own session).
+    So the database work of the reader and writer overlaps with inference instead of alternating with it,
+    and at most `queue_size` batches wait between two stages. An exception in any stage stops all of them
+    and is raised here. Returns the time each stage spent working and waiting.
+    """
+    times = {stage: StageTimes() for stage in ['read', 'infer', 'write']}
+    inbox: queue.Queue = queue.Queue(maxsize=queue_size)
+    outbox: queue.Queue = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    errors: list[BaseException] = []
+
+    def reader():
+        try:
+            iterator = iter(batches)
+            while True:
+                start = time.perf_counter()
+                batch = next(iterator, _DONE)
+                times['read'].busy += time.perf_counter() - start
+                if batch is _DONE:
+                    break
+                times['read'].items += 1
+                if not _put(inbox, batch, stop, times['read']):
+                    return
+            _put(inbox, _DONE, stop, times['read'])
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+
+    def writer():
+        try:
+            while (result := _get(outbox, stop, times['write'])) is not _DONE:
+                start = time.perf_counter()
+                write(result)
+                times['write'].busy += time.perf_counter() - start
+                times['write'].items += 1
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+
+    threads = [threading.Thread(target=reader, name='pipeline-reader', daemon=True),
+               threading.Thread(target=writer, name='pipeline-writer', daemon=True)]
+    for thread in threads:
+        thread.start()
+
+    try:
+        while (batch := _get(inbox, stop, times['infer'])) is not _DONE:
+            start = time.perf_counter()
+            result = infer(batch)
+            times['infer'].busy += time.perf_counter() - start
+            times['infer'].items += 1
+            if not _put(outbox, result, stop, times['infer']):
+                break
+        _put(outbox, _DONE, stop, times['infer'])
+    except BaseException:
+        stop.set()
+        raise
+    finally:
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        raise errors[0]
+    return times
@@ -18,6 +18,12 @@ class Index:
     def init_index(self, max_elements: int, ef_construction: int = 200, M: int = 16, random_seed: int = 100):
         self.index.init_index(max_elements=max_elements, ef_construction=ef_construction, M=M, random_seed=random_seed)
 
+    def resize_index(self, new_size: int):
+        self.index.resize_index(new_size)
+
+    def get_max_elements(self) -> int:
+        return self.index.get_max_elements()
+
     def add_items(self, data, ids: list[str] | None = None):
         if ids is not None:
             assert len(data) == len(ids)
@@ -0,0 +1,200 @@
+import os
+import shutil
+import asyncio
+import logging
+from pathlib import Path
+
+import orjson
+import aiohttp
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from common.twitter import SEARCH_ENDPOINT, START_TIME, PageConverter
+from common.checkpoint import Checkpoint, CheckpointedWriter, repair_file
+from common.async_twitter import TokenBucket, fetch_pages
+from common.parquet_store import jsonl_to_parquet
+from common.importer import existing_item_ids
+
+logger = logging.getLogger('refresh')
+
+
+def delta_name(qid: str, stamp: str) -> str:
+    # file prefix for the delta, e.g. `c_17_delta_20230115T1200_explicit.jsonl`
+    return f'{qid}_delta_{stamp}'
+
+
+def delta_tag(stamp: str) -> str:
+    # suffix of the import name for tweets from the delta, used to select them in later stages
+    return f'[delta {stamp}]'
+
+
+# Filter on `item` for items that belong to the imports of one delta (parameter :delta_pattern)
+DELTA_FILTER = '''EXISTS (SELECT 1
+               FROM m2m_import_item m2m
+                   JOIN import imp ON imp.import_id = m2m.import_id
+               WHERE m2m.item_id = item.item_id
+                 AND imp.name LIKE :delta_pattern)'''
+
+
+def delta_params(stamp: str) -> dict[str, str]:
+    return {'delta_pattern': f'%{delta_tag(stamp)}'}
+
+
+def newest_on_disk(file: Path) -> tuple[str | None, str | None]:
+    """
+    Returns the largest tweet id and the respective `created_at` in a jsonl file.
+    Files are usually sorted by recency, but earlier refreshes append newer tweets at the end.
+    """
+    newest_id = None
+    created_at = None
+    if not file.exists():
+        return newest_id, created_at
+    with open(file, 'rb') as f_in:
+        for line in f_in:
+            tweet = orjson.loads(line)
+            if newest_id is None or int(tweet['twitter_id']) > newest_id:
+                newest_id = int(tweet['twitter_id'])
+                created_at = tweet['created_at']
+    return (str(newest_id) if newest_id is not None else None), created_at
+
+
+def newest_in_db(session: Session, project_id: str, qid: str) -> tuple[str | None, str | None]:
+    """
+    Returns the largest tweet id (and its `created_at`) that was imported for `qid`.
+    """
+    row = session.execute(text('''
+        SELECT ti.twitter_id, ti.created_at
+        FROM twitter_item ti
+            JOIN m2m_import_item m2m ON m2m.item_id = ti.item_id
+            JOIN import imp ON imp.import_id = m2m.import_id
+        WHERE imp.project_id = :project_id
+          AND imp.name LIKE :name_pattern
+        ORDER BY ti.twitter_id::bigint DESC
+        LIMIT 1;'''), {'project_id': project_id, 'name_pattern': f'% ({qid})%'}).one_or_none()
+    if row is None:
+        return None, None
+    return str(row[0]), str(row[1])
+
+
+def existing_items(session: Session, project_id: str, files: list[Path],
+                   batch_size: int = 10000) -> dict[str, str]:
+    """
+    Maps the tweet ids in the given (delta) files to the `item_id` of tweets that are already in the database.
+    """
+    twitter_ids = []
+    for file in files:
+        if file.exists():
+            with open(file, 'rb') as f_in:
+                twitter_ids += [orjson.loads(line)['twitter_id'] for line in f_in]
+
+    mapping = {}
+    for batch_from in range(0, len(twitter_ids), batch_size):
+        mapping.update(existing_item_ids(session, project_id, twitter_ids[batch_from:batch_from + batch_size]))
+    return mapping
+
+
+def append_delta(writer: CheckpointedWriter, stamp: str, file_explicit: Path, file_conv_ids: Path,
+                 file_checkpoint: Path) -> bool:
+    """
+    Appends a completed delta to the main files of the sub-query and records it in their checkpoint,
+    so that a resume of the main download keeps the appended data and the delta is never appended twice.
+    Returns False if the delta was already appended.
+    """
+    checkpoint = Checkpoint.load(file_checkpoint)
+    if stamp in checkpoint.deltas:
+        return False
+
+    # drop whatever a crash during an earlier attempt left behind
+    repair_file(file_explicit, checkpoint.explicit_size)
+    repair_file(file_conv_ids, checkpoint.conversations_size)
+    for file_main, file_delta in [(file_explicit, writer.file_explicit), (file_conv_ids, writer.file_conv_ids)]:
+        with open(file_main, 'ab') as f_out, open(file_delta, 'rb') as f_in:
+            shutil.copyfileobj(f_in, f_out)
+            f_out.flush()
+            os.fsync(f_out.fileno())
+
+    checkpoint.tweets_written += writer.checkpoint.tweets_written
+    checkpoint.explicit_size = file_explicit.stat().st_size
+    checkpoint.conversations_size = file_conv_ids.stat().st_size
+    checkpoint.deltas.append(stamp)
+    checkpoint.save(file_checkpoint)
+    return True
+
+
+async def refresh_entry(session: aiohttp.ClientSession,
+                        bucket: TokenBucket,
+                        entry: dict[str, str],
+                        target_dir: Path,
+                        stamp: str,
+                        since_id: str | None = None,
+                        end_time: str | None = None,
+                        endpoint: str = SEARCH_ENDPOINT,
+                        converter: PageConverter | None = None,
+                        parquet: Path | None = None) -> tuple[int, int]:
+    """
+    Downloads only tweets newer than what is already on disk (or `since_id`, e.g. from the database)
+    into the delta files `{qid}_delta_{stamp}_*` and appends them to `{qid}_explicit.jsonl`
+    and `{qid}_conversations.txt` once the delta is complete.
+    """
+    qid = entry['qid']
+    file_explicit = (target_dir / f'{qid}_explicit.jsonl').resolve()
+    file_conv_ids = (target_dir / f'{qid}_conversations.txt').resolve()
+    file_checkpoint = (target_dir / f'{qid}_checkpoint.json').resolve()
+
+    if not file_checkpoint.exists() or not Checkpoint.load(file_checkpoint).done:
+        raise RuntimeError(f'{qid} was not downloaded completely yet, finish the full download first.')
+
+    num_pages = 0
+    with CheckpointedWriter(target_dir, delta_name(qid, stamp), converter=converter) as writer:
+        if not writer.done:
+            if since_id is None:
+                since_id, created_at = await asyncio.to_thread(newest_on_disk, file_explicit)
+                logger.info(f'{qid}: newest tweet on disk is {since_id} from {created_at}')
+
+            async for page in fetch_pages(session, bucket, entry['query'] + ' -is:retweet lang:en',
+                                          endpoint=endpoint, end_time=end_time, since_id=since_id,
+                                          # the API does not accept `start_time` together with `since_id`
+                                          start_time=START_TIME if since_id is None else None,
+                                          next_token=writer.checkpoint.next_token):
+                writer.write_page(page)
+                num_pages += 1
+            writer.finish()
+
+    if not await asyncio.to_thread(append_delta, writer, stamp, file_explicit, file_conv_ids, file_checkpoint):
+        logger.info(f'Skipping {qid}, delta {stamp} was already downloaded completely.')
+        return 0, 0
+    if parquet is not None:
+        await asyncio.to_thread(jsonl_to_parquet, writer.file_explicit, qid, parquet, replace=False, tag=stamp)
+
+    logger.info(f'Done with {qid}: {writer.checkpoint.tweets_written:,} new tweets in delta {stamp}.')
+    return num_pages, writer.checkpoint.tweets_written
+
+
+async def refresh_entries(entries: list[dict[str, str]],
+                          target_dir: Path,
+                          stamp: str,
+                          since_ids: dict[str, str] | None = None,
+                          end_time: str | None = None,
+                          concurrency: int = 4,
+                          endpoint: str = SEARCH_ENDPOINT,
+                          bucket: TokenBucket | None = None,
+                          converter: PageConverter | None = None,
+                          parquet: Path | None = None) -> tuple[int, int]:
+    if bucket is None:
+        bucket = TokenBucket()
+    if since_ids is None:
+        since_ids = {}
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(session: aiohttp.ClientSession, entry: dict[str, str]) -> tuple[int, int]:
+        async with semaphore:
+            return await refresh_entry(session, bucket, entry, target_dir, stamp=stamp,
+                                       since_id=since_ids.get(entry['qid']), end_time=end_time, endpoint=endpoint,
+                                       converter=converter, parquet=parquet)
+
+    timeout = aiohttp.ClientTimeout(total=None, sock_read=120)
+    async with aiohttp.ClientSession(timeout=timeout,
+                                     connector=aiohttp.TCPConnector(limit=concurrency)) as session:
+        stats = await asyncio.gather(*[run(session, entry) for entry in entries])
+
+    return sum(s[0] for s in stats), sum(s[1] for s in stats)
@@ -0,0 +1,141 @@
+import gzip
+import time
+import asyncio
+import logging
+from pathlib import Path
+from typing import Any, Mapping
+
+import typer
+import orjson
+import aiohttp
+from aiohttp import web
+
+from common.config import settings
+
+logger = logging.getLogger('replay')
+
+# query parameters that identify a request (fields and expansions are the same for every request)
+KEY_PARAMS = ['query', 'start_time', 'end_time', 'since_id', 'until_id', 'granularity', 'next_token']
+RATE_LIMIT_HEADERS = ['x-rate-limit-limit', 'x-rate-limit-remaining', 'x-rate-limit-reset']
+
+
+def request_key(path: str, params: Mapping[str, str]) -> bytes:
+    return orjson.dumps([path, *[params.get(key) for key in KEY_PARAMS]])
+
+
+class PageRecorder:
+    """
+    Appends raw API responses together with the request that produced them to the gzip-compressed
+    `pages.jsonl.gz` in `target_dir`. Every record is its own gzip member, so a recording that is
+    interrupted can be continued and remains readable up to the last complete record.
+    """
+
+    def __init__(self, target_dir: Path):
+        self.file = (target_dir / 'pages.jsonl.gz').resolve()
+        self.file.parent.mkdir(parents=True, exist_ok=True)
+        self._f_out = open(self.file, 'ab')
+        self.num_pages = 0
+
+    def close(self):
+        self._f_out.close()
+
+    def record(self, path: str, params: Mapping[str, str], page: dict[str, Any], elapsed: float):
+        self._f_out.write(gzip.compress(orjson.dumps({
+            'path': path,
+            'params': {key: params[key] for key in KEY_PARAMS if key in params},
+            'elapsed': elapsed,
+            'page': page
+        }) + b'\n', compresslevel=6))
+        self._f_out.flush()
+        self.num_pages += 1
+
+
+def load_recording(source_dir: Path) -> dict[bytes, dict[str, Any]]:
+    """
+    Reads all recorded responses from `source_dir/pages.jsonl.gz`, indexed by `request_key`.
+    """
+    recording = {}
+    with gzip.open(source_dir / 'pages.jsonl.gz', 'rb') as f_in:
+        try:
+            for line in f_in:
+                record = orjson.loads(line)
+                recording[request_key(record['path'], record['params'])] = record
+        except EOFError:
+            logger.warning('Recording ends with an incomplete record, ignoring it.')
+    logger.info(f'Loaded {len(recording):,} recorded responses from {source_dir}')
+    return recording
+
+
+def make_recording_proxy(upstream: str, recorder: PageRecorder) -> web.Application:
+    """
+    Forwards all requests to `upstream` (e.g. `https://api.twitter.com`, or the local mock API)
+    and records every successful response. Point the `--endpoint` of `00`/`01` at this proxy.
+    Rate limit headers and error responses are passed through unchanged, errors are not recorded.
+    """
+    headers = {'Authorization': f'Bearer {settings.TWITTER_BEARER}'}
+
+    async def forward(request: web.Request) -> web.Response:
+        session: aiohttp.ClientSession = request.app['session']
+        start = time.perf_counter()
+        async with session.get(upstream.rstrip('/') + request.path, params=request.query,
+                               headers=headers) as response:
+            body = await response.read()
+            passed_headers = {key: response.headers[key] for key in RATE_LIMIT_HEADERS if key in response.headers}
+            if response.status == 200:
+                recorder.record(request.path, request.query, orjson.loads(body), time.perf_counter() - start)
+        return web.Response(body=body, status=response.status, headers=passed_headers,
+                            content_type='application/json')
+
+    async def session_context(app: web.Application):
+        app['session'] = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=None, sock_read=120))
+        yield
+        await app['session'].close()
+        recorder.close()
+
+    app = web.Application()
+    app.cleanup_ctx.append(session_context)
+    app.router.add_get('/2/{endpoint:.+}', forward)
+    return app
+
+
+def make_replay_app(recording: dict[bytes, dict[str, Any]],
+                    speed: float = 0.,
+                    latency: float = 0.) -> web.Application:
+    """
+    Serves recorded responses for the same requests. Each response is delayed by the time it took
+    when it was recorded divided by `speed` (0 replays as fast as possible), plus a fixed `latency`.
+    Requests that were never recorded get a 404. No rate limit headers are sent.
+    """
+
+    async def replay(request: web.Request) -> web.Response:
+        record = recording.get(request_key(request.path, request.query))
+        if record is None:
+            logger.warning(f'No recorded response for {request.path} with {dict(request.query)}')
+            return web.json_response({'title': 'Not Found'}, status=404)
+
+        delay = latency + (record['elapsed'] / speed if speed > 0 else 0.)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return web.Response(body=orjson.dumps(record['page']), content_type='application/json')
+
+    app = web.Application()
+    app.router.add_get('/2/{endpoint:.+}', replay)
+    return app
+
+
+# Records (with `--upstream`) or replays API responses at http://localhost:{port}/2/tweets/search/all
+def main(recording: str,
+         upstream: str | None = None,
+         port: int = 8080,
+         speed: float = 0.,
+         latency: float = 0.):
+    logging.basicConfig(format='%(asctime)s [%(levelname)s] %(name)s: %(message)s', level=logging.INFO)
+    if upstream is not None:
+        app = make_recording_proxy(upstream, PageRecorder(Path(recording)))
+    else:
+        app = make_replay_app(load_recording(Path(recording)), speed=speed, latency=latency)
+    web.run_app(app, host='localhost', port=port)
+
+
+if __name__ == '__main__':
+    typer.run(main)
@@ -0,0 +1,171 @@
+import json
+import asyncio
+import logging
+from pathlib import Path
+from dataclasses import dataclass, asdict
+
+import orjson
+import aiohttp
+
+from common.twitter import COUNTS_ENDPOINT, START_TIME, END_TIME, PageConverter
+from common.checkpoint import Checkpoint, CheckpointedWriter
+from common.async_twitter import TokenBucket, request_json, fetch_pages
+from common.parquet_store import jsonl_to_parquet
+
+logger = logging.getLogger('sharding')
+
+
+@dataclass
+class Window:
+    start_time: str  # inclusive
+    end_time: str  # exclusive
+    tweet_count: int
+
+
+async def fetch_counts(session: aiohttp.ClientSession,
+                       bucket: TokenBucket,
+                       query: str,
+                       endpoint: str = COUNTS_ENDPOINT,
+                       start_time: str = START_TIME,
+                       end_time: str = END_TIME,
+                       granularity: str = 'day') -> list[Window]:
+    """
+    Probes the number of tweets matching `query` per day (or hour) via the counts endpoint.
+    The API returns at most 31 days per page, so the full range takes about 200 requests.
+    """
+    params = {'query': query, 'start_time': start_time, 'end_time': end_time, 'granularity': granularity}
+    buckets = []
+    while True:
+        page = await request_json(session, bucket, endpoint, params)
+        buckets += [Window(start_time=b['start'][:19] + 'Z', end_time=b['end'][:19] + 'Z',
+                           tweet_count=b['tweet_count'])
+                    for b in page.get('data', [])]
+        next_token = page.get('meta', {}).get('next_token')
+        if next_token is None:
+            break
+        params['next_token'] = next_token
+    return buckets
+
+
+def plan_windows(buckets: list[Window], max_tweets: int) -> list[Window]:
+    """
+    Greedily merges consecutive count buckets into windows of at most `max_tweets` tweets
+    (a single bucket that is denser than that becomes its own window).
+    Sparse years end up as one long window, while dense years are split into weeks or days.
+    Windows are returned newest first, matching the order in which the search API returns tweets.
+    """
+    buckets = sorted(buckets, key=lambda b: b.start_time)
+    windows: list[Window] = []
+    current: Window | None = None
+    for b in buckets:
+        if current is not None and current.tweet_count + b.tweet_count > max_tweets:
+            windows.append(current)
+            current = None
+        if current is None:
+            current = Window(start_time=b.start_time, end_time=b.end_time, tweet_count=b.tweet_count)
+        else:
+            current.end_time = b.end_time
+            current.tweet_count += b.tweet_count
+    if current is not None:
+        windows.append(current)
+    return [w for w in reversed(windows) if w.tweet_count > 0]
+
+
+def merge_shards(shard_files: list[Path], file_explicit: Path, file_conv_ids: Path) -> int:
+    """
+    Concatenates the shard files (given newest window first, each sorted by recency) into one
+    time-ordered `{qid}_explicit.jsonl`, dropping tweets that appear in more than one shard.
+    """
+    seen: set[str] = set()
+    num_tweets = 0
+    with open(file_explicit, 'wb') as f_out_ex, open(file_conv_ids, 'w') as f_out_conv_ids:
+        for shard_file in shard_files:
+            with open(shard_file, 'rb') as f_in:
+                for line in f_in:
+                    tweet = orjson.loads(line)
+                    if tweet['twitter_id'] in seen:
+                        continue
+                    seen.add(tweet['twitter_id'])
+                    f_out_ex.write(line)
+                    if tweet.get('conversation_id'):
+                        f_out_conv_ids.write(f'{tweet["conversation_id"]}\n')
+                    num_tweets += 1
+    return num_tweets
+
+
+async def download_sharded(session: aiohttp.ClientSession,
+                           bucket: TokenBucket,
+                           semaphore: asyncio.Semaphore,
+                           entry: dict[str, str],
+                           target_dir: Path,
+                           endpoint: str,
+                           counts_endpoint: str,
+                           max_tweets: int = 250000,
+                           restart: bool = False,
+                           converter: PageConverter | None = None,
+                           parquet: Path | None = None) -> tuple[int, int]:
+    """
+    Splits the time range of one sub-query into windows of roughly `max_tweets` tweets,
+    downloads all windows in parallel (each with its own checkpoint in `{qid}_shards/`)
+    and merges them into the usual `{qid}_explicit.jsonl` / `{qid}_conversations.txt`.
+    """
+    qid = entry['qid']
+    query = entry['query'] + ' -is:retweet lang:en'
+    shard_dir = target_dir / f'{qid}_shards'
+    shard_dir.mkdir(parents=True, exist_ok=True)
+    file_plan = shard_dir / 'plan.json'
+    file_checkpoint = (target_dir / f'{qid}_checkpoint.json').resolve()
+
+    if restart:
+        file_plan.unlink(missing_ok=True)
+    elif file_checkpoint.exists() and Checkpoint.load(file_checkpoint).done:
+        logger.info(f'Skipping {qid}, which was already downloaded completely.')
+        return 0, 0
+
+    # keep the plan of earlier runs, so that we resume into the same windows
+    if file_plan.exists():
+        with open(file_plan, 'r') as f:
+            windows = [Window(**w) for w in json.load(f)]
+    else:
+        async with semaphore:
+            logger.info(f'Probing tweet counts for {qid}')
+            buckets = await fetch_counts(session, bucket, query, endpoint=counts_endpoint)
+        windows = plan_windows(buckets, max_tweets=max_tweets)
+        with open(file_plan, 'w') as f:
+            json.dump([asdict(w) for w in windows], f)
+    logger.info(f'Splitting {qid} with {sum(w.tweet_count for w in windows):,} tweets into {len(windows)} windows.')
+
+    async def run(wi: int, window: Window) -> tuple[int, int]:
+        async with semaphore:
+            num_pages = 0
+            num_tweets = 0
+            with CheckpointedWriter(shard_dir, f'{qid}_{wi:04d}', restart=restart, converter=converter) as writer:
+                if writer.done:
+                    return 0, 0
+                async for page in fetch_pages(session, bucket, query, endpoint=endpoint,
+                                              start_time=window.start_time, end_time=window.end_time,
+                                              next_token=writer.checkpoint.next_token):
+                    num_tweets += writer.write_page(page)
+                    num_pages += 1
+                writer.finish()
+            logger.debug(f'{qid}: done with window {window.start_time} to {window.end_time} '
+                         f'({num_tweets:,} tweets in {num_pages:,} pages)')
+            return num_pages, num_tweets
+
+    stats = await asyncio.gather(*[run(wi, window) for wi, window in enumerate(windows)])
+
+    file_explicit = (target_dir / f'{qid}_explicit.jsonl').resolve()
+    file_conv_ids = (target_dir / f'{qid}_conversations.txt').resolve()
+    num_tweets = merge_shards([shard_dir / f'{qid}_{wi:04d}_explicit.jsonl' for wi in range(len(windows))],
+                              file_explicit, file_conv_ids)
+    Checkpoint(pages_written=sum(s[0] for s in stats),
+               tweets_written=num_tweets,
+               oldest_created_at=windows[-1].start_time if windows else None,
+               explicit_size=file_explicit.stat().st_size,
+               conversations_size=file_conv_ids.stat().st_size,
+               done=True).save(file_checkpoint)
+
+    logger.info(f'Done with {qid}: merged {num_tweets:,} unique tweets from {len(windows)} windows.')
+    if parquet is not None:
+        await asyncio.to_thread(jsonl_to_parquet, file_explicit, qid, parquet)
+    return sum(s[0] for s in stats), num_tweets
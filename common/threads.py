@@ -0,0 +1,245 @@
+import os
+import sqlite3
+import asyncio
+import logging
+from pathlib import Path
+from typing import Generator
+from collections import Counter
+
+import aiohttp
+
+from common.twitter import SEARCH_ENDPOINT, PageConverter
+from common.async_twitter import TokenBucket, fetch_pages
+from common.checkpoint import repair_file
+
+logger = logging.getLogger('threads')
+
+QUERY_SUFFIX = ' -is:retweet lang:en'
+# maximum query length for the full-archive search with academic access
+MAX_QUERY_LENGTH = 1024
+
+
+def batch_query(conv_ids: list[str]) -> str:
+    return '(' + ' OR '.join(f'conversation_id:{conv_id}' for conv_id in conv_ids) + ')' + QUERY_SUFFIX
+
+
+def plan_batches(conv_ids: list[str], max_length: int = MAX_QUERY_LENGTH) -> list[list[str]]:
+    """
+    Packs as many `conversation_id:` clauses into each query as fit into `max_length` characters.
+    """
+    batches = []
+    batch: list[str] = []
+    length = len('()' + QUERY_SUFFIX)
+    for conv_id in conv_ids:
+        clause = len(f'conversation_id:{conv_id}') + (len(' OR ') if batch else 0)
+        if batch and length + clause > max_length:
+            batches.append(batch)
+            batch = []
+            length = len('()' + QUERY_SUFFIX)
+            clause = len(f'conversation_id:{conv_id}')
+        batch.append(conv_id)
+        length += clause
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def read_ids(file: Path) -> list[str]:
+    """
+    Reads unique ids (one per line) in order of first appearance.
+    """
+    if not file.exists():
+        return []
+    with open(file, 'r') as f_in:
+        return list(dict.fromkeys(line.strip() for line in f_in if line.strip()))
+
+
+class ThreadStore:
+    """
+    Global store for conversation threads across all sub-queries.
+
+    Every thread is downloaded once and appended to the shared `threads.jsonl`.
+    The SQLite registry `threads.sqlite` next to it keeps track of
+      - `conversation`: all conversation ids and whether they were fetched already,
+      - `membership`: which sub-query (qid) refers to which conversation,
+      - `thread_tweet`: the byte offset of every tweet in `threads.jsonl`.
+    The size of `threads.jsonl` is committed together with the registry, so data that was
+    written after the last commit (e.g. before a crash) is truncated when the store is opened.
+    """
+
+    def __init__(self, target_dir: Path):
+        self.file_store = (target_dir / 'threads.jsonl').resolve()
+        self.file_registry = (target_dir / 'threads.sqlite').resolve()
+        self.file_store.parent.mkdir(parents=True, exist_ok=True)
+
+        self.db = sqlite3.connect(self.file_registry)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS conversation (
+                conversation_id TEXT PRIMARY KEY,
+                done INTEGER NOT NULL DEFAULT 0,
+                num_tweets INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS membership (
+                qid TEXT NOT NULL,
+                conversation_id TEXT NOT NULL,
+                PRIMARY KEY (qid, conversation_id)
+            );
+            CREATE TABLE IF NOT EXISTS thread_tweet (
+                twitter_id TEXT PRIMARY KEY,
+                conversation_id TEXT NOT NULL,
+                offset INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS thread_tweet_conversation ON thread_tweet (conversation_id);
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+        ''')
+
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'store_size';").fetchone()
+        repair_file(self.file_store, int(row[0]) if row else 0)
+        self._f_store = open(self.file_store, 'ab')
+
+    def close(self):
+        self._f_store.close()
+        self.db.close()
+
+    def register(self, qid: str, conv_ids: list[str]):
+        self.db.executemany('INSERT OR IGNORE INTO conversation (conversation_id) VALUES (?);',
+                            [(conv_id,) for conv_id in conv_ids])
+        self.db.executemany('INSERT OR IGNORE INTO membership (qid, conversation_id) VALUES (?, ?);',
+                            [(qid, conv_id) for conv_id in conv_ids])
+        self.db.commit()
+
+    def pending(self) -> list[str]:
+        return [r[0] for r in self.db.execute('SELECT conversation_id FROM conversation WHERE done = 0;')]
+
+    def num_conversations(self, qid: str | None = None) -> tuple[int, int]:
+        """
+        Returns the number of conversations and how many of them were fetched already.
+        """
+        if qid is None:
+            return self.db.execute('SELECT count(1), coalesce(sum(done), 0) FROM conversation;').fetchone()
+        return self.db.execute('''SELECT count(1), coalesce(sum(c.done), 0)
+                                  FROM membership m JOIN conversation c ON c.conversation_id = m.conversation_id
+                                  WHERE m.qid = ?;''', (qid,)).fetchone()
+
+    def add_batch(self, conv_ids: list[str], tweets: list[tuple[str, str, bytes]]):
+        """
+        Appends the tweets (twitter_id, conversation_id, json line) of a completely downloaded batch
+        of conversations to the store and marks the conversations as done.
+        """
+        known = set()
+        for i in range(0, len(tweets), 500):
+            chunk = [t[0] for t in tweets[i:i + 500]]
+            known.update(r[0] for r in self.db.execute(
+                f'SELECT twitter_id FROM thread_tweet WHERE twitter_id IN ({",".join("?" * len(chunk))});', chunk))
+
+        index = []
+        counts: Counter[str] = Counter()
+        offset = self._f_store.tell()
+        for twitter_id, conversation_id, line in tweets:
+            counts[conversation_id] += 1
+            if twitter_id in known:
+                continue
+            known.add(twitter_id)
+            self._f_store.write(line)
+            index.append((twitter_id, conversation_id, offset))
+            offset += len(line)
+        self._f_store.flush()
+        os.fsync(self._f_store.fileno())  # before `store_size` is committed
+
+        self.db.executemany('INSERT OR IGNORE INTO thread_tweet (twitter_id, conversation_id, offset) '
+                            'VALUES (?, ?, ?);', index)
+        self.db.executemany('UPDATE conversation SET done = 1, num_tweets = ? WHERE conversation_id = ?;',
+                            [(counts[conv_id], conv_id) for conv_id in conv_ids])
+        self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('store_size', ?);", (str(offset),))
+        self.db.commit()
+
+    def iter_lines(self, qid: str | None = None) -> Generator[bytes, None, None]:
+        """
+        Yields the stored tweets (as raw json lines) of all threads or only those referred to by `qid`.
+        """
+        if qid is None:
+            query, params = 'SELECT offset FROM thread_tweet ORDER BY offset;', ()
+        else:
+            query, params = ('''SELECT t.offset
+                                FROM membership m JOIN thread_tweet t ON t.conversation_id = m.conversation_id
+                                WHERE m.qid = ?
+                                ORDER BY t.offset;''', (qid,))
+        with open(self.file_store, 'rb') as f_in:
+            for (offset,) in self.db.execute(query, params):
+                f_in.seek(offset)
+                yield f_in.readline()
+
+    def iter_tweet_ids(self, batch_size: int = 10000) -> Generator[list[tuple[str, int]], None, None]:
+        """
+        Yields batches of (twitter_id, offset) of all stored tweets, in the order of `threads.jsonl`.
+        """
+        cursor = self.db.execute('SELECT twitter_id, offset FROM thread_tweet ORDER BY offset;')
+        while rows := cursor.fetchmany(batch_size):
+            yield rows
+
+    def iter_member_ids(self, qid: str, conv_ids: list[str] | None = None,
+                        batch_size: int = 10000) -> Generator[list[str], None, None]:
+        """
+        Yields batches of the ids of the stored tweets referred to by `qid` (optionally only those
+        in the conversations `conv_ids`) from the index alone, without reading the tweets themselves.
+        """
+        query = '''SELECT t.twitter_id
+                   FROM membership m JOIN thread_tweet t ON t.conversation_id = m.conversation_id
+                   WHERE m.qid = ?'''
+        if conv_ids is not None:
+            self.db.execute('CREATE TEMP TABLE IF NOT EXISTS conv_filter (conversation_id TEXT PRIMARY KEY);')
+            self.db.execute('DELETE FROM conv_filter;')
+            self.db.executemany('INSERT OR IGNORE INTO conv_filter (conversation_id) VALUES (?);',
+                                [(conv_id,) for conv_id in conv_ids])
+            query += ' AND m.conversation_id IN (SELECT conversation_id FROM conv_filter)'
+        cursor = self.db.execute(query + ';', (qid,))
+        while rows := cursor.fetchmany(batch_size):
+            yield [row[0] for row in rows]
+
+
+async def download_threads(conv_ids: list[str],
+                           store: ThreadStore,
+                           concurrency: int = 4,
+                           endpoint: str = SEARCH_ENDPOINT,
+                           bucket: TokenBucket | None = None,
+                           max_length: int = MAX_QUERY_LENGTH,
+                           converter: PageConverter | None = None) -> tuple[int, int]:
+    """
+    Downloads all tweets of the conversations in `conv_ids` with batched queries and adds them
+    to the `store`. Conversations are only marked as done once all pages of their batch were written.
+    Returns the number of requests and tweets.
+    """
+    if bucket is None:
+        bucket = TokenBucket()
+    if converter is None:
+        converter = PageConverter()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    batches = plan_batches(conv_ids, max_length=max_length)
+    logger.info(f'Fetching {len(conv_ids):,} conversations with {len(batches):,} batched queries.')
+
+    stats = {'requests': 0, 'tweets': 0}
+
+    async def run(session: aiohttp.ClientSession, batch: list[str]):
+        async with semaphore:
+            tweets = []
+            async for page in fetch_pages(session, bucket, batch_query(batch), endpoint=endpoint):
+                stats['requests'] += 1
+                if 'data' not in page:
+                    continue
+                tweets += converter(page)
+
+        # route results back to their conversations and only mark the batch as done once it is on disk
+        store.add_batch(batch, tweets)
+        stats['tweets'] += len(tweets)
+        logger.debug(f'Got {len(tweets):,} tweets for {len(batch)} conversations')
+
+    timeout = aiohttp.ClientTimeout(total=None, sock_read=120)
+    async with aiohttp.ClientSession(timeout=timeout,
+                                     connector=aiohttp.TCPConnector(limit=concurrency)) as session:
+        await asyncio.gather(*[run(session, batch) for batch in batches])
+
+    return stats['requests'], stats['tweets']
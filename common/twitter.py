@@ -1,12 +1,18 @@
 import logging
 from datetime import datetime
-from typing import Generator, Any
+from dataclasses import dataclass
+from typing import Generator, Any, TYPE_CHECKING
+
+import orjson
 from searchtweets import ResultStream
 from common.config import settings
 
 from nacsos_data.models.items.twitter import TwitterItemModel, TwitterUserModel, Hashtag, Cashtag, ContextAnnotation, \
     Mention, URL, ReferencedTweet
 
+if TYPE_CHECKING:
+    from common.users import UserStore
+
 
 def api_page_to_tweets(page: dict[str, Any]) -> Generator[TwitterItemModel, None, None]:
     """
@@ -91,7 +97,152 @@ def api_page_to_tweets(page: dict[str, Any]) -> Generator[TwitterItemModel, None
         yield tweet_obj
 
 
-def download_query(query: str) -> Generator[TwitterItemModel, None, None]:
+def parse_timestamp(value: str) -> datetime:
+    # API timestamps look like '2022-12-31T23:59:59.000Z', fromisoformat is much faster than strptime
+    return datetime.fromisoformat(value[:19])
+
+
+def _raw_user(user_obj: dict[str, Any]) -> dict[str, Any]:
+    # same fields as `TwitterUserModel(...).dict(exclude_none=True)` in `api_page_to_tweets`
+    metrics = user_obj.get('public_metrics', {})
+    user = {
+        'id': user_obj['id'],
+        'name': None if user_obj['name'] == user_obj['username'] else user_obj['name'],
+        'username': user_obj['username'],
+        'created_at': user_obj['created_at'][:19],
+        'verified': user_obj['verified'],
+        'description': user_obj.get('description'),
+        'location': user_obj.get('location'),
+        'followers_count': metrics.get('followers_count'),
+        'following_count': metrics.get('following_count'),
+        'tweet_count': metrics.get('tweet_count'),
+        'listed_count': metrics.get('listed_count')
+    }
+    return {key: value for key, value in user.items() if value is not None}
+
+
+def api_page_to_raw_tweets(page: dict[str, Any], validate: bool = False, include_user: bool = True) \
+        -> Generator[dict[str, Any], None, None]:
+    """
+    Fast path for `api_page_to_tweets`, which translates the API response directly into dictionaries
+    with the same layout as `TwitterItemModel.json()` without constructing any pydantic models.
+    Timestamps are kept as ISO strings (see `parse_timestamp`).
+    If `validate` is set, every tweet is additionally checked by parsing it into a `TwitterItemModel`.
+    Without `include_user`, the user profile is not embedded (see `common.users.UserStore`).
+    """
+    users = {}
+    if include_user and 'includes' in page and 'users' in page['includes']:
+        users = {user['id']: user for user in page['includes']['users']}
+
+    for tweet in page['data']:
+        user = None
+        if tweet['author_id'] in users:
+            user = _raw_user(users[tweet['author_id']])
+
+        ref_tweets = None
+        if 'referenced_tweets' in tweet:
+            ref_tweets = [{'id': ref_tweet['id'], 'type': ref_tweet['type']}
+                          for ref_tweet in tweet['referenced_tweets']]
+        latlon = None
+        if 'geo' in tweet and 'coordinates' in tweet['geo'] and tweet['geo'].get('type') == 'Point':
+            latlon = tweet['geo']['coordinates'].get('coordinates')
+
+        entities = tweet.get('entities', {})
+        hashtags = None
+        if 'hashtags' in entities:
+            hashtags = [{'start': ht['start'], 'end': ht['end'], 'tag': ht['tag']}
+                        for ht in entities['hashtags']]
+        cashtags = None
+        if 'cashtags' in entities:
+            cashtags = [{'start': ct['start'], 'end': ct['end'], 'tag': ct['tag']}
+                        for ct in entities['cashtags']]
+        urls = None
+        if 'urls' in entities:
+            urls = [{'start': url['start'], 'end': url['end'], 'url': url['url'], 'url_expanded': url['expanded_url']}
+                    for url in entities['urls']]
+        mentions = None
+        if 'mentions' in entities:
+            mentions = [{'start': m['start'], 'end': m['end'], 'username': m['username'], 'user_id': m['id']}
+                        for m in entities['mentions']]
+
+        annotations = None
+        if 'context_annotations' in tweet:
+            annotations = [{'domain_id': ca['domain']['id'], 'domain_name': ca['domain']['name'],
+                            'entity_id': ca['entity']['id'], 'entity_name': ca['entity']['name']}
+                           for ca in tweet['context_annotations']]
+
+        metrics = tweet['public_metrics']
+        tweet_obj = {
+            'text': tweet['text'],
+            'twitter_id': str(tweet['id']),
+            'twitter_author_id': str(tweet['author_id']),
+            'created_at': tweet['created_at'][:19],
+            'language': tweet.get('lang'),
+            'conversation_id': tweet.get('conversation_id'),
+            'referenced_tweets': ref_tweets,
+            'annotations': annotations,
+            'latitude': latlon[0] if latlon else None,
+            'longitude': latlon[1] if latlon else None,
+            'hashtags': hashtags,
+            'mentions': mentions,
+            'urls': urls,
+            'cashtags': cashtags,
+            'retweet_count': metrics['retweet_count'],
+            'reply_count': metrics['reply_count'],
+            'like_count': metrics['like_count'],
+            'quote_count': metrics['quote_count'],
+            'user': user
+        }
+
+        if validate:
+            TwitterItemModel.parse_obj(tweet_obj)
+
+        yield tweet_obj
+
+
+def page_to_lines(page: dict[str, Any], raw: bool = True, validate: bool = False, users: 'UserStore | None' = None) \
+        -> Generator[tuple[str, str | None, bytes], None, None]:
+    """
+    Serialises all tweets on a page for the jsonl files and yields (twitter_id, conversation_id, line).
+    In `raw` mode, the fast path via `api_page_to_raw_tweets` and orjson is used.
+    If a `UserStore` is given, user profiles are written there instead of being embedded in every tweet.
+    """
+    if users is not None:
+        users.add_page(page)
+
+    if raw:
+        for tweet in api_page_to_raw_tweets(page, validate=validate, include_user=users is None):
+            yield tweet['twitter_id'], tweet['conversation_id'], orjson.dumps(tweet) + b'\n'
+    else:
+        for tweet in api_page_to_tweets(page):
+            if users is not None:
+                tweet.user = None
+            yield tweet.twitter_id, tweet.conversation_id, (tweet.json() + '\n').encode()
+
+
+@dataclass
+class PageConverter:
+    """
+    Settings for how the downloaders turn API pages into jsonl lines (see `page_to_lines`).
+    """
+    raw: bool = True
+    validate: bool = False
+    users: 'UserStore | None' = None
+
+    def __call__(self, page: dict[str, Any]) -> Generator[tuple[str, str | None, bytes], None, None]:
+        return page_to_lines(page, raw=self.raw, validate=self.validate, users=self.users)
+
+
+SEARCH_ENDPOINT = 'https://api.twitter.com/2/tweets/search/all'
+COUNTS_ENDPOINT = 'https://api.twitter.com/2/tweets/counts/all'
+START_TIME = '2006-03-21T00:00:00Z'
+END_TIME = '2022-12-31T23:59:59Z'
+
+
+def search_params(query: str,
+                  start_time: str | None = START_TIME,
+                  end_time: str | None = END_TIME,
+                  since_id: str | None = None) -> dict[str, Any]:
     request_params = {
         'query': query,
         'tweet.fields': 'attachments,author_id,conversation_id,created_at,entities,geo,id,'
@@ -106,22 +257,47 @@ def download_query(query: str) -> Generator[TwitterItemModel, None, None]:
                        'protected,public_metrics,url,username,verified,withheld',
         'place.fields': 'contained_within,country,country_code,full_name,geo,id,name,place_type',
         'sort_order': 'recency',
-        'start_time': '2006-03-21T00:00:00Z',
-        'end_time': '2022-12-31T23:59:59Z',
         'max_results': 100
     }
+    if start_time is not None:
+        request_params['start_time'] = start_time
+    if end_time is not None:
+        request_params['end_time'] = end_time
+    if since_id is not None:
+        request_params['since_id'] = since_id
+    return request_params
+
+
+def download_pages(query: str,
+                   next_token: str | None = None,
+                   start_time: str | None = START_TIME,
+                   end_time: str | None = END_TIME,
+                   endpoint: str = SEARCH_ENDPOINT) -> Generator[dict[str, Any], None, None]:
+    """
+    Yields the raw response pages for `query`.
+    When a `next_token` is given (e.g. from a checkpoint), the stream continues from that page.
+    The `endpoint` can point to a local replay of recorded pages (see `common.replay`).
+    """
+    request_params = search_params(query, start_time, end_time)
+    if next_token is not None:
+        request_params['next_token'] = next_token
 
     logging.info(f'Starting stream for query: {query}')
     logging.debug(f'Bearer: {settings.TWITTER_BEARER}')
     stream = ResultStream(
-        endpoint='https://api.twitter.com/2/tweets/search/all',
+        endpoint=endpoint,
         request_parameters=request_params,
         bearer_token=settings.TWITTER_BEARER,
         max_tweets=10 ** 15,
         max_requests=10 ** 9,
         output_format='r')
 
-    for results in stream.stream():
+    yield from stream.stream()
+
+
+def download_query(query: str, next_token: str | None = None,
+                   endpoint: str = SEARCH_ENDPOINT) -> Generator[TwitterItemModel, None, None]:
+    for results in download_pages(query, next_token=next_token, endpoint=endpoint):
         if 'data' in results and type(results['data']) == list:
             logging.debug(f'Received page with {len(results["data"])} tweets!')
             yield from api_page_to_tweets(results)
@@ -0,0 +1,207 @@
+import sqlite3
+import logging
+from pathlib import Path
+from datetime import date
+from typing import Any, Generator
+
+import typer
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from nacsos_data.db import DatabaseEngine
+
+from common.config import settings
+
+logger = logging.getLogger('users')
+
+USER_FIELDS = ['name', 'username', 'created_at', 'verified', 'description', 'location',
+               'followers_count', 'following_count', 'tweet_count', 'listed_count']
+
+# Typed user profiles in the database; one snapshot per user and day it was observed.
+TWITTER_USER_DDL = '''
+CREATE TABLE IF NOT EXISTS twitter_user (
+    project_id        uuid    NOT NULL,
+    twitter_author_id varchar NOT NULL,
+    observed_at       date    NOT NULL,
+    name              varchar,
+    username          varchar,
+    created_at        timestamp,
+    verified          boolean,
+    description       text,
+    location          varchar,
+    followers_count   integer,
+    following_count   integer,
+    tweet_count       integer,
+    listed_count      integer,
+    PRIMARY KEY (project_id, twitter_author_id, observed_at)
+);
+
+CREATE OR REPLACE VIEW twitter_user_latest AS
+SELECT DISTINCT ON (project_id, twitter_author_id) *
+FROM twitter_user
+ORDER BY project_id, twitter_author_id, observed_at DESC;
+'''
+
+# Populates `twitter_user` from profiles that are embedded in `twitter_item."user"` (legacy imports).
+# Each author gets one snapshot, taken from the tweet with the highest reported tweet count; authors that have
+# a snapshot already are skipped, so running it again adds nothing.
+TWITTER_USER_BACKFILL = '''
+INSERT INTO twitter_user (project_id, twitter_author_id, observed_at, name, username, created_at, verified,
+                          description, location, followers_count, following_count, tweet_count, listed_count)
+SELECT DISTINCT ON (ti.twitter_author_id) ti.project_id, ti.twitter_author_id, :observed_at ::date,
+       u.name, u.username, u.created_at, u.verified, u.description, u.location,
+       u.followers_count, u.following_count, u.tweet_count, u.listed_count
+FROM twitter_item ti,
+     jsonb_to_record(ti."user") as u ("name" text, "username" text, "created_at" timestamp, "verified" bool,
+                                      "description" text, "location" text, "followers_count" int,
+                                      "following_count" int, "tweet_count" int, "listed_count" int)
+WHERE ti.project_id = :project_id
+  AND jsonb_typeof(ti."user") = 'object'
+  AND NOT EXISTS (SELECT 1
+                  FROM twitter_user tu
+                  WHERE tu.project_id = ti.project_id
+                    AND tu.twitter_author_id = ti.twitter_author_id)
+ORDER BY ti.twitter_author_id, u.tweet_count DESC NULLS LAST
+ON CONFLICT DO NOTHING;
+'''
+
+
+class UserStore:
+    """
+    Deduplicated store of user profiles (`users.sqlite`) that is filled during the download.
+    Instead of copying the profile into every tweet, each user is kept once per day
+    it was observed (`observed_at`); tweets only reference users by `twitter_author_id`.
+    """
+
+    def __init__(self, target_dir: Path, observed_at: str | None = None):
+        self.file = (target_dir / 'users.sqlite').resolve()
+        self.file.parent.mkdir(parents=True, exist_ok=True)
+        self.observed_at = observed_at or date.today().isoformat()
+
+        self.db = sqlite3.connect(self.file)
+        self.db.execute(f'''
+            CREATE TABLE IF NOT EXISTS twitter_user (
+                twitter_author_id TEXT NOT NULL,
+                observed_at TEXT NOT NULL,
+                {", ".join(f"{field} {'INTEGER' if field.endswith('_count') or field == 'verified' else 'TEXT'}"
+                           for field in USER_FIELDS)},
+                PRIMARY KEY (twitter_author_id, observed_at)
+            );''')
+        self._seen: set[str] = set()
+
+    def close(self):
+        self.db.close()
+
+    def add_page(self, page: dict[str, Any]) -> int:
+        """
+        Adds all profiles from the `includes` of an API response page (unless they were already
+        observed today). Returns the number of new snapshots.
+        """
+        rows = []
+        for user in page.get('includes', {}).get('users', []):
+            if user['id'] in self._seen:
+                continue
+            self._seen.add(user['id'])
+            metrics = user.get('public_metrics', {})
+            rows.append((
+                user['id'], self.observed_at,
+                None if user['name'] == user['username'] else user['name'],
+                user['username'],
+                user['created_at'][:19] if user.get('created_at') else None,
+                user.get('verified'),
+                user.get('description'),
+                user.get('location'),
+                metrics.get('followers_count'),
+                metrics.get('following_count'),
+                metrics.get('tweet_count'),
+                metrics.get('listed_count')
+            ))
+        if rows:
+            self.db.executemany(f'INSERT OR IGNORE INTO twitter_user VALUES ({", ".join("?" * 12)});', rows)
+            self.db.commit()
+        return len(rows)
+
+    def iter_profiles(self, batch_size: int = 10000) -> Generator[list[dict[str, Any]], None, None]:
+        cursor = self.db.execute(f'SELECT twitter_author_id, observed_at, {", ".join(USER_FIELDS)} '
+                                 f'FROM twitter_user;')
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield [{
+                'twitter_author_id': row[0],
+                'observed_at': row[1],
+                **{field: value for field, value in zip(USER_FIELDS, row[2:])},
+                'verified': None if row[5] is None else bool(row[5])
+            } for row in rows]
+
+
+def ensure_user_table(session: Session):
+    session.execute(text(TWITTER_USER_DDL))
+    session.commit()
+
+
+def import_users(session: Session, store: UserStore, project_id: str) -> int:
+    """
+    Copies all profile snapshots from the local `store` into the `twitter_user` table.
+    """
+    stmt = text(f'''
+        INSERT INTO twitter_user (project_id, twitter_author_id, observed_at, {", ".join(USER_FIELDS)})
+        VALUES (:project_id, :twitter_author_id, :observed_at ::date,
+                {", ".join(f":{field}" for field in USER_FIELDS)})
+        ON CONFLICT DO NOTHING;''')
+    num_users = 0
+    for batch in store.iter_profiles():
+        session.execute(stmt, [{**row, 'project_id': project_id} for row in batch])
+        session.commit()
+        num_users += len(batch)
+        logger.debug(f'Imported {num_users:,} user profiles')
+    return num_users
+
+
+def backfill_users(session: Session, project_id: str, observed_at: str | None = None) -> int:
+    """
+    Extracts the profiles embedded in `twitter_item."user"` of already imported tweets into `twitter_user`.
+    """
+    result = session.execute(text(TWITTER_USER_BACKFILL), {
+        'project_id': project_id,
+        'observed_at': observed_at or date.today().isoformat()
+    })
+    session.commit()
+    return result.rowcount
+
+
+def import_profiles(session: Session, target_dir: Path, project_id: str, backfill: bool = False) -> int:
+    """
+    Fills `twitter_user` from the user store in `target_dir` (if there is one) and, with `backfill`, once from the
+    profiles embedded in already imported tweets (which scans all tweets). Returns the number of new snapshots.
+    """
+    ensure_user_table(session)
+    num_users = 0
+    if (target_dir / 'users.sqlite').exists():
+        store = UserStore(target_dir)
+        num_users += import_users(session, store, project_id)
+        store.close()
+        logger.info(f'Imported {num_users:,} user profiles.')
+    if backfill:
+        num_embedded = backfill_users(session, project_id)
+        logger.info(f'Extracted {num_embedded:,} user profiles embedded in tweets.')
+        num_users += num_embedded
+    return num_users
+
+
+# Creates and fills `twitter_user` for tweets that are already in the database, including the one-off
+# extraction of the profiles that older imports embedded in `twitter_item."user"`.
+def main(target_dir: str | None = None,  # directory with `users.sqlite`, by default the raw tweets
+         backfill: bool = True,  # extract profiles from tweets of authors without a snapshot
+         log_level: str = 'INFO'):
+    logging.basicConfig(format='%(asctime)s [%(levelname)s] %(name)s: %(message)s', level=log_level)
+    db_engine = DatabaseEngine(host=settings.HOST, port=settings.PORT,
+                               user=settings.USER, password=settings.PASSWORD,
+                               database=settings.DATABASE)
+    with db_engine.session() as session:  # type: Session
+        import_profiles(session, Path(target_dir or settings.DATA_RAW_TWEETS).resolve(), settings.PROJECT_ID,
+                        backfill=backfill)
+
+
+if __name__ == '__main__':
+    typer.run(main)
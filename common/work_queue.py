@@ -0,0 +1,204 @@
+import os
+import time
+import socket
+import logging
+import threading
+from typing import Any
+
+import orjson
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from nacsos_data.db import DatabaseEngine
+
+logger = logging.getLogger('work-queue')
+
+# Work units (ranges of item ids, see `common.batches.key_ranges`) that any number of workers on any number of machines
+# claim with `FOR UPDATE SKIP LOCKED`. A claim is a lease: units of workers that stopped renewing it are claimed again.
+WORK_QUEUE_DDL = '''
+CREATE TABLE IF NOT EXISTS work_queue (
+    queue      varchar     NOT NULL PRIMARY KEY,
+    config     jsonb       NOT NULL,
+    created_at timestamptz NOT NULL DEFAULT now()
+);
+
+CREATE TABLE IF NOT EXISTS work_unit (
+    queue        varchar     NOT NULL REFERENCES work_queue (queue) ON DELETE CASCADE,
+    unit_id      integer     NOT NULL,
+    lower_bound  uuid,
+    upper_bound  uuid,
+    status       varchar     NOT NULL DEFAULT 'pending',  -- pending, running, done, failed
+    worker       varchar,
+    attempts     integer     NOT NULL DEFAULT 0,
+    leased_until timestamptz,
+    finished_at  timestamptz,
+    num_items    integer,
+    PRIMARY KEY (queue, unit_id)
+);
+
+CREATE INDEX IF NOT EXISTS work_unit_claim ON work_unit (queue, status, leased_until);
+'''
+
+CLAIM = '''
+UPDATE work_unit
+SET status       = 'running',
+    worker       = :worker,
+    attempts     = attempts + 1,
+    leased_until = now() + make_interval(secs => :lease_seconds)
+WHERE (queue, unit_id) = (SELECT queue, unit_id
+                          FROM work_unit
+                          WHERE queue = :queue
+                            AND (status = 'pending' OR (status = 'running' AND leased_until < now()))
+                          ORDER BY unit_id
+                          LIMIT 1 FOR UPDATE SKIP LOCKED)
+RETURNING unit_id, attempts, lower_bound, upper_bound;
+'''
+
+
+def worker_name() -> str:
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def ensure_queue_tables(session: Session):
+    session.execute(text(WORK_QUEUE_DDL))
+    session.commit()
+
+
+def create_queue(session: Session, queue: str, config: dict[str, Any], ranges: list[tuple[Any, Any]]) -> int:
+    """
+    Creates the work queue `queue` with one unit per range, unless it exists already.
+    `config` is everything workers need to know about the job (e.g. the metadata id to write annotations to).
+    Returns the number of units that were added.
+    """
+    ensure_queue_tables(session)
+    created = session.execute(text('INSERT INTO work_queue (queue, config) VALUES (:queue, :config ::jsonb) '
+                                   'ON CONFLICT DO NOTHING;'),
+                              {'queue': queue, 'config': orjson.dumps(config).decode()}).rowcount
+    if created == 0:
+        session.rollback()
+        logger.warning(f'Work queue "{queue}" exists already, not adding units.')
+        return 0
+    session.execute(text('INSERT INTO work_unit (queue, unit_id, lower_bound, upper_bound) '
+                         'VALUES (:queue, :unit_id, :lower, :upper);'),
+                    [{'queue': queue, 'unit_id': unit_id, 'lower': lower, 'upper': upper}
+                     for unit_id, (lower, upper) in enumerate(ranges)])
+    session.commit()
+    return len(ranges)
+
+
+def queue_config(session: Session, queue: str) -> dict[str, Any]:
+    config = session.execute(text('SELECT config FROM work_queue WHERE queue = :queue;'), {'queue': queue}).scalar()
+    if config is None:
+        raise KeyError(f'There is no work queue "{queue}".')
+    return config
+
+
+def queue_progress(session: Session, queue: str) -> dict[str, int]:
+    return {status: count for status, count in session.execute(
+        text('SELECT status, count(1) FROM work_unit WHERE queue = :queue GROUP BY status;'), {'queue': queue})}
+
+
+def done_units(session: Session, queue: str) -> list[tuple[int, Any, Any, int]]:
+    """
+    (unit_id, lower, upper, num_items) of all finished units of `queue`.
+    """
+    return [tuple(row) for row in session.execute(
+        text("SELECT unit_id, lower_bound, upper_bound, num_items FROM work_unit "
+             "WHERE queue = :queue AND status = 'done' ORDER BY unit_id;"), {'queue': queue})]
+
+
+def claim(session: Session, queue: str, worker: str, lease_seconds: float,
+          max_attempts: int) -> tuple[int, Any, Any] | None:
+    """
+    Claims the next pending unit (or one whose lease ran out) and returns (unit_id, lower, upper),
+    or None if there is nothing to do. Units that failed `max_attempts` times are marked as failed instead.
+    """
+    while True:
+        row = session.execute(text(CLAIM), {'queue': queue, 'worker': worker,
+                                            'lease_seconds': lease_seconds}).first()
+        session.commit()
+        if row is None:
+            return None
+        unit_id, attempts, lower, upper = row
+        if attempts <= max_attempts:
+            return unit_id, lower, upper
+        logger.error(f'Giving up on unit {unit_id} of "{queue}" after {max_attempts} attempts.')
+        finish(session, queue, unit_id, worker, status='failed')
+
+
+def renew(session: Session, queue: str, unit_id: int, worker: str, lease_seconds: float) -> bool:
+    renewed = session.execute(text('UPDATE work_unit '
+                                   'SET leased_until = now() + make_interval(secs => :lease_seconds) '
+                                   'WHERE queue = :queue AND unit_id = :unit_id AND worker = :worker '
+                                   "  AND status = 'running';"),
+                              {'queue': queue, 'unit_id': unit_id, 'worker': worker,
+                               'lease_seconds': lease_seconds}).rowcount
+    session.commit()
+    return renewed > 0
+
+
+def finish(session: Session, queue: str, unit_id: int, worker: str, status: str = 'done',
+           num_items: int | None = None) -> bool:
+    """
+    Marks the unit as `done` (or `failed`, or `pending` to hand it back) if `worker` still holds it.
+    """
+    finished = session.execute(text('UPDATE work_unit '
+                                    'SET status = :status, num_items = :num_items, leased_until = NULL, '
+                                    "    finished_at = CASE WHEN :status = 'pending' THEN NULL ELSE now() END "
+                                    'WHERE queue = :queue AND unit_id = :unit_id AND worker = :worker;'),
+                               {'queue': queue, 'unit_id': unit_id, 'worker': worker, 'status': status,
+                                'num_items': num_items}).rowcount
+    session.commit()
+    return finished > 0
+
+
+def run_worker(db_engine: DatabaseEngine, queue: str, task, lease_seconds: float = 600., max_attempts: int = 3,
+               poll_seconds: float = 10., worker: str | None = None) -> int:
+    """
+    Claims units of `queue` one after the other and passes their range of item ids to `task.run`
+    (e.g. `common.classify.ClassifyTask`, which has to be set up already) until no unit is left.
+    While a unit is processed, a background thread renews its lease every third of `lease_seconds`.
+    Tasks have to be idempotent: a unit whose lease ran out is processed again by another worker.
+    Without pending units, the worker polls every `poll_seconds` until no other worker holds a unit either.
+    Returns the number of items that were processed.
+    """
+    worker = worker or worker_name()
+    num_items = 0
+    with db_engine.session() as session:  # type: Session
+        while True:
+            unit = claim(session, queue, worker, lease_seconds, max_attempts)
+            if unit is None:
+                # units of workers that crashed come back once their lease runs out
+                if queue_progress(session, queue).get('running', 0) == 0:
+                    break
+                time.sleep(poll_seconds)
+                continue
+            unit_id, lower, upper = unit
+            logger.info(f'{worker} claimed unit {unit_id} of "{queue}".')
+
+            stop = threading.Event()
+
+            def heartbeat():
+                with db_engine.session() as heartbeat_session:  # type: Session
+                    while not stop.wait(lease_seconds / 3):
+                        if not renew(heartbeat_session, queue, unit_id, worker, lease_seconds):
+                            logger.warning(f'{worker} lost the lease on unit {unit_id} of "{queue}".')
+                            return
+
+            thread = threading.Thread(target=heartbeat, name='work-queue-heartbeat', daemon=True)
+            thread.start()
+            try:
+                unit_items = task.run((lower, upper))
+            except BaseException:
+                finish(session, queue, unit_id, worker, status='pending')
+                raise
+            finally:
+                stop.set()
+                thread.join()
+
+            if finish(session, queue, unit_id, worker, num_items=unit_items):
+                num_items += unit_items
+                logger.info(f'{worker} finished unit {unit_id} of "{queue}" with {unit_items:,} items '
+                            f'({queue_progress(session, queue)}).')
+            else:
+                logger.warning(f'Unit {unit_id} of "{queue}" was taken over by another worker.')
+    return num_items
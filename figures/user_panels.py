@@ -115,12 +115,19 @@ class Container:
         stmt = text(f"""
         WITH tmp AS (
             SELECT twitter_id, ti.twitter_author_id,
-                  (ti."user" -> 'username')::text                                                     as username,
-                  (ti."user" -> 'created_at')::text::timestamp                                        as created,
-                  extract('day' from date_trunc('day', :time_to ::timestamp -
-                                                       (ti."user" -> 'created_at')::text::timestamp)) as days,
-                  (ti."user" -> 'tweet_count')::int                                                   as n_tweets
+                  u.username                                                                 as username,
+                  u.created_at                                                               as created,
+                  extract('day' from date_trunc('day', :time_to ::timestamp - u.created_at)) as days,
+                  u.tweet_count                                                              as n_tweets
             FROM twitter_item ti
+            LEFT JOIN LATERAL (SELECT *
+                               FROM twitter_user tu
+                               WHERE tu.project_id = ti.project_id
+                                 AND tu.twitter_author_id = ti.twitter_author_id
+                               -- last snapshot up to the tweet, else the first after it
+                               ORDER BY tu.observed_at <= ti.created_at::date DESC,
+                                        abs(tu.observed_at - ti.created_at::date)
+                               LIMIT 1) u ON TRUE
             LEFT JOIN bot_annotation ba_tech ON (
                                 ti.item_id = ba_tech.item_id
                             AND ba_tech.bot_annotation_metadata_id = 'fc73da56-9f51-4d2b-ad35-2a01dbe9b275'
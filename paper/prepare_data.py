@@ -23,19 +23,15 @@ def fetch_user_stats() -> list[UserTweetCounts]:
                                         u.verified,
                                         u.description,
                                         ti.referenced_tweets = 'null' as is_orig
-                                 FROM twitter_item ti,
-                                      jsonb_to_record(ti."user") as u (
-                                                                       "name" text,
-                                                                       "username" text,
-                                                                       "location" text,
-                                                                       "tweet_count" int,
-                                                                       "listed_count" int,
-                                                                       "followers_count" int,
-                                                                       "following_count" int,
-                                                                       "created_at" timestamp,
-                                                                       "verified" bool,
-                                                                       "description" text
-                                          )
+                                 FROM twitter_item ti
+                                          LEFT JOIN LATERAL (SELECT *
+                                                             FROM twitter_user tu
+                                                             WHERE tu.project_id = ti.project_id
+                                                               AND tu.twitter_author_id = ti.twitter_author_id
+                                                             -- last snapshot up to the tweet, else the first after it
+                                                             ORDER BY tu.observed_at <= ti.created_at::date DESC,
+                                                                      abs(tu.observed_at - ti.created_at::date)
+                                                             LIMIT 1) u ON TRUE
                                  WHERE ti.project_id = :project_id
                                    AND ti.created_at >= :start ::timestamp
                                    AND ti.created_at <= :end ::timestamp)
@@ -1,25 +1,89 @@
-from pathlib import Path
+import asyncio
 import logging
+from pathlib import Path
+from datetime import datetime
+
+import typer
+from nacsos_data.db import DatabaseEngine
+
 from common.queries import queries
-from common.twitter import download_query
+from common.twitter import SEARCH_ENDPOINT, PageConverter
+from common.users import UserStore
+from common.async_twitter import download_entries, TokenBucket
+from common.refresh import refresh_entries, newest_in_db
 from common.config import settings
 
-if __name__ == '__main__':
-    logging.basicConfig(format='%(asctime)s [%(levelname)s] %(name)s: %(message)s', level=logging.DEBUG)
+
+def newest_ids_in_db(qids: list[str]) -> dict[str, str]:
+    db_engine = DatabaseEngine(host=settings.HOST, port=settings.PORT,
+                               user=settings.USER, password=settings.PASSWORD,
+                               database=settings.DATABASE)
+    since_ids = {}
+    with db_engine.session() as session:
+        for qid in qids:
+            twitter_id, created_at = newest_in_db(session, settings.PROJECT_ID, qid)
+            if twitter_id is not None:
+                logging.info(f'{qid}: newest tweet in the database is {twitter_id} from {created_at}')
+                since_ids[qid] = twitter_id
+    return since_ids
+
+
+def main(concurrency: int = 4,
+         endpoint: str = SEARCH_ENDPOINT,
+         min_interval: float = 1.,
+         restart: bool = False,
+         shard: str = '',  # comma-separated list of qids to split into time windows
+         shard_size: int = 250000,
+         raw: bool = True,  # convert tweets without constructing pydantic models
+         validate: bool = False,  # validate converted tweets against the pydantic models
+         normalize_users: bool = False,  # store user profiles once in users.sqlite instead of in every tweet
+         parquet: bool = False,  # additionally write completed sub-queries to the parquet dataset
+         refresh: bool = False,  # only download tweets newer than the ones on disk (into delta files)
+         refresh_stamp: str | None = None,  # name of the delta, defaults to the current time; reuse it to resume
+         since_db: bool = False,  # take the newest tweet per sub-query from the database instead of the files
+         log_level: str = 'DEBUG'):
+    logging.basicConfig(format='%(asctime)s [%(levelname)s] %(name)s: %(message)s', level=log_level)
     TARGET_DIR = Path(settings.DATA_RAW_TWEETS)
+    users = UserStore(TARGET_DIR) if normalize_users else None
+    converter = PageConverter(raw=raw, validate=validate, users=users)
 
+    entries = []
     for cat, sub_queries in queries.items():
         logging.info(f'Looking at {cat} with {len(sub_queries)} sub-queries.')
-        for entry in sub_queries:
-            logging.info(f'Getting tweets for {cat} {entry["qid"]} -> {entry["query"]}')
-
-            file_explicit = (TARGET_DIR / f'{entry["qid"]}_explicit.jsonl').resolve()
-            file_explicit.parent.mkdir(parents=True, exist_ok=True)
-            file_conv_ids = (TARGET_DIR / f'{entry["qid"]}_conversations.txt').resolve()
-
-            with open(file_explicit, 'w') as f_out_ex, \
-                    open(file_conv_ids, 'w') as f_out_conv_ids:
-                for tweet in download_query(entry['query'] + ' -is:retweet lang:en'):
-                    f_out_ex.write(tweet.json() + '\n')
-                    if tweet.conversation_id:
-                        f_out_conv_ids.write(f'{tweet.conversation_id}\n')
+        entries += sub_queries
+
+    bucket = TokenBucket(min_interval=min_interval)
+    parquet_root = TARGET_DIR / 'parquet' if parquet else None
+
+    if refresh:
+        stamp = refresh_stamp or datetime.now().strftime('%Y%m%dT%H%M')
+        since_ids = None
+        if since_db:
+            since_ids = newest_ids_in_db([entry['qid'] for entry in entries])
+        logging.info(f'Refreshing {len(entries)} sub-queries into delta {stamp}.')
+        num_pages, num_tweets = asyncio.run(refresh_entries(entries, TARGET_DIR,
+                                                            stamp=stamp,
+                                                            since_ids=since_ids,
+                                                            concurrency=concurrency,
+                                                            endpoint=endpoint,
+                                                            bucket=bucket,
+                                                            converter=converter,
+                                                            parquet=parquet_root))
+    else:
+        logging.info(f'Downloading {len(entries)} sub-queries with {concurrency} concurrent streams.')
+        num_pages, num_tweets = asyncio.run(download_entries(entries, TARGET_DIR,
+                                                             concurrency=concurrency,
+                                                             endpoint=endpoint,
+                                                             bucket=bucket,
+                                                             restart=restart,
+                                                             shard=set(q for q in shard.split(',') if q),
+                                                             shard_size=shard_size,
+                                                             converter=converter,
+                                                             parquet=parquet_root))
+    logging.info(f'Downloaded {num_tweets:,} tweets in {num_pages:,} pages.')
+    if users is not None:
+        users.close()
+
+
+if __name__ == '__main__':
+    typer.run(main)
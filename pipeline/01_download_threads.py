@@ -1,27 +1,64 @@
-from pathlib import Path
+import asyncio
 import logging
+from pathlib import Path
+
+import typer
+
 from common.queries import queries
-from common.twitter import download_query
+from common.twitter import SEARCH_ENDPOINT, PageConverter
+from common.users import UserStore
+from common.async_twitter import TokenBucket
+from common.threads import ThreadStore, download_threads, read_ids, MAX_QUERY_LENGTH
 from common.config import settings
+from common.parquet_store import jsonl_to_parquet, THREADS_QID
 
-if __name__ == '__main__':
-    logging.basicConfig(format='%(asctime)s [%(levelname)s] %(name)s: %(message)s', level=logging.DEBUG)
+
+# Threads are downloaded once across all sub-queries into `threads.jsonl`, the sqlite registry
+# `threads.sqlite` keeps track of which conversation belongs to which qid (see `common.threads.ThreadStore`).
+def main(concurrency: int = 4,
+         endpoint: str = SEARCH_ENDPOINT,
+         min_interval: float = 1.,
+         max_query_length: int = MAX_QUERY_LENGTH,
+         raw: bool = True,  # convert tweets without constructing pydantic models
+         validate: bool = False,  # validate converted tweets against the pydantic models
+         normalize_users: bool = False,  # store user profiles once in users.sqlite instead of in every tweet
+         parquet: bool = False,  # additionally write all thread tweets to the parquet dataset
+         log_level: str = 'DEBUG'):
+    logging.basicConfig(format='%(asctime)s [%(levelname)s] %(name)s: %(message)s', level=log_level)
     TARGET_DIR = Path(settings.DATA_RAW_TWEETS)
+    store = ThreadStore(TARGET_DIR)
+    users = UserStore(TARGET_DIR) if normalize_users else None
+    converter = PageConverter(raw=raw, validate=validate, users=users)
+
     for cat, sub_queries in queries.items():
         logging.info(f'Looking at {cat} with {len(sub_queries)} sub-queries.')
         for entry in sub_queries:
-            logging.info(f'Getting threads for {cat} {entry["qid"]}')
-
-            file_implicit = (TARGET_DIR / f'{entry["qid"]}_implicit.jsonl').resolve()
             file_conv_ids = (TARGET_DIR / f'{entry["qid"]}_conversations.txt').resolve()
+            conv_ids = read_ids(file_conv_ids)
+            store.register(entry['qid'], conv_ids)
+
+            num_total, num_done = store.num_conversations(entry['qid'])
+            logging.info(f'There are {len(conv_ids)} unique conversations for {entry["qid"]} in {cat} '
+                         f'({num_done:,} of {num_total:,} already fetched)')
 
-            with open(file_conv_ids, 'r') as f_in_conv_ids:
-                conv_ids = [conv_id for conv_id in f_in_conv_ids]
+    num_total, num_done = store.num_conversations()
+    pending = store.pending()
+    logging.info(f'There are {num_total:,} unique conversations across all sub-queries, '
+                 f'{num_done:,} were fetched already, {len(pending):,} to go.')
 
-            logging.info(f'There are {len(conv_ids)} (unique: {len(set(conv_ids))}) conversations'
-                         f' for {entry["qid"]} in {cat}')
+    num_requests, num_tweets = asyncio.run(download_threads(pending, store,
+                                                            concurrency=concurrency,
+                                                            endpoint=endpoint,
+                                                            bucket=TokenBucket(min_interval=min_interval),
+                                                            max_length=max_query_length,
+                                                            converter=converter))
+    logging.info(f'Downloaded {num_tweets:,} tweets with {num_requests:,} requests.')
+    if parquet:
+        jsonl_to_parquet(store.file_store, THREADS_QID, TARGET_DIR / 'parquet')
+    store.close()
+    if users is not None:
+        users.close()
 
-            with open(file_implicit, 'w') as f_out_impl:
-                for conv_id in set(conv_ids):
-                    for tweet in download_query(f'conversation_id:{conv_id} -is:retweet lang:en'):
-                        f_out_impl.write(tweet.json() + '\n')
+
+if __name__ == '__main__':
+    typer.run(main)
@@ -1,220 +1,208 @@
 import logging
 import uuid
-from collections import defaultdict
+import time
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import typer
 
 from nacsos_data.db import DatabaseEngine
-from nacsos_data.db.schemas import TwitterItem
 from nacsos_data.db.schemas.annotations import AnnotationScheme
 from nacsos_data.models.annotations import AnnotationSchemeLabel, AnnotationSchemeLabelChoice
-from nacsos_data.db.schemas.bot_annotations import BotAnnotationMetaData, BotAnnotation
-from nacsos_data.db.schemas.imports import Import, M2MImportItemType, M2MImportItem
-
-from nacsos_data.models.items.twitter import TwitterItemModel
+from nacsos_data.db.schemas.bot_annotations import BotAnnotationMetaData
 from sqlalchemy.orm import Session
 
 from common.queries import queries
 from common.config import settings
-
-if __name__ == '__main__':
+from common.users import import_profiles
+from common.refresh import delta_name, delta_tag, existing_items
+from common.bulk_load import TableStats, TABLES, log_stats
+from common.threads import ThreadStore, read_ids
+from common.importer import ImportState, import_qid, import_threads, renumber_tech
+
+
+def main(delta: str | None = None,  # only import the delta of this incremental refresh (see common.refresh)
+         meta_id: str | None = None,  # add query annotations to this existing metadata instead of a new scheme
+         bulk: bool = False,  # load rows with COPY via staging tables instead of INSERT statements
+         chunk_size: int = 8 * 2 ** 20,  # bytes of a file that are parsed, written and committed at once
+         workers: int = 1,  # number of sub-queries that are imported in parallel
+         parse_workers: int = 0,  # number of processes that parse the chunks of each file (0 parses inline)
+         implicit: bool = False,  # also import the thread tweets (see 01) as implicit tweets of each sub-query
+         restart: bool = False):  # forget which sub-queries were imported already
     logging.basicConfig(format='%(asctime)s [%(levelname)s] %(name)s: %(message)s', level=logging.WARNING)
     logger = logging.getLogger('import')
     logger.setLevel('DEBUG')
+    logging.getLogger('importer').setLevel('DEBUG')
+    logging.getLogger('bulk-load').setLevel('DEBUG')
+    logging.getLogger('users').setLevel('DEBUG')
 
     TARGET_DIR = Path(settings.DATA_RAW_TWEETS).resolve()
     logger.info(f'Reading data from {TARGET_DIR}')
 
+    # Reruns continue where the last run stopped, completed sub-queries are skipped
+    file_state = TARGET_DIR / ('import_state.json' if delta is None else f'import_state_{delta}.json')
+    if restart:
+        file_state.unlink(missing_ok=True)
+    state = ImportState.load(file_state)
+    if meta_id is not None:
+        state.meta_id = meta_id
+
     db_engine = DatabaseEngine(host=settings.HOST, port=settings.PORT,
                                user=settings.USER, password=settings.PASSWORD,
                                database=settings.DATABASE)
     logger.info(f'Connecting to database {db_engine._connection_str}')
 
-    quid2cati = {
-        query['qid']: cat_i
+    # (cat_i, cat, q_i, entry), the position in this list is the provisional `repeat` of the query annotation
+    entries = [
+        (cat_i, cat, q_i, entry)
         for cat_i, (cat, sub_queries) in enumerate(queries.items())
-        for q_i, query in enumerate(sub_queries)
-    }
-    quid2qi = {
-        query['qid']: q_i
-        for cat_i, (_, sub_queries) in enumerate(queries.items())
-        for q_i, query in enumerate(sub_queries)
-    }
-
-    # keep track of queries for each twitter id
-    twitter2nacsos_id: dict[str, str] = {}
-    annotations = defaultdict(list[str])
+        for q_i, entry in enumerate(sub_queries)
+    ]
+
+    # Create annotation scheme to annotate categories
+    labels = [
+        AnnotationSchemeLabel(
+            name='Technology',
+            key='tech',
+            hint=None,
+            max_repeat=40,
+            required=True,
+            kind='single',
+            choices=[
+                AnnotationSchemeLabelChoice(
+                    name=cat,
+                    value=cat_i,
+                    children=[
+                        AnnotationSchemeLabel(
+                            name=f'Subquery for "{cat}"',
+                            key=f'sub_{cat_i}',
+                            max_repeat=40,
+                            required=True,
+                            kind='single',
+                            choices=[
+                                AnnotationSchemeLabelChoice(
+                                    name=query['qid'],
+                                    hint=query['query'],
+                                    value=q_i
+                                ).dict()
+                                for q_i, query in enumerate(sub_queries)
+                            ]
+                        ).dict()
+                    ]
+                ).dict()
+                for cat_i, (cat, sub_queries) in enumerate(queries.items())
+            ]
+        ).dict()
+    ]
+
+    with db_engine.session() as session:  # type: Session
+        if state.meta_id is None:
+            scheme_id = str(uuid.uuid4())
+            logger.info(f'Creating annotation scheme with id: {scheme_id}')
+            scheme = AnnotationScheme(annotation_scheme_id=scheme_id,
+                                      project_id=settings.PROJECT_ID,
+                                      name='CDR Technologies',
+                                      description='CDR technologies (annotated by respective queries)',
+                                      labels=labels)
+            session.add(scheme)
+            session.commit()
+
+            state.meta_id = str(uuid.uuid4())
+            logger.info(f'Creating metadata item for bot annotations with id {state.meta_id}')
+            meta = BotAnnotationMetaData(
+                bot_annotation_metadata_id=state.meta_id,
+                name='Query annotations',
+                kind='SCRIPT',
+                project_id=settings.PROJECT_ID,
+                annotation_scheme_id=scheme_id
+            )
+            session.add(meta)
+            session.commit()
+        else:
+            logger.info(f'Adding annotations to existing metadata item {state.meta_id}')
+        state.save(file_state)
+
+        known = {}
+        if delta is not None:
+            # tweets of the delta may already be in the database from an import with random item ids
+            known = existing_items(session, settings.PROJECT_ID, [
+                (TARGET_DIR / f'{delta_name(entry["qid"], delta)}_explicit.jsonl').resolve()
+                for _, _, _, entry in entries
+            ])
+            logger.info(f'Found {len(known):,} tweets of delta {delta} that are already imported.')
+
+    jobs = []
+    for repeat, (cat_i, cat, q_i, entry) in enumerate(entries, start=1):
+        file_prefix = entry['qid'] if delta is None else delta_name(entry['qid'], delta)
+        file = (TARGET_DIR / f'{file_prefix}_explicit.jsonl').resolve()
+        if entry['qid'] in state.done:
+            logger.info(f'Skipping {cat} {entry["qid"]}, which was imported already.')
+        elif not file.exists():
+            logger.warning(f'Skipping missing file {file}')
+        else:
+            jobs.append(dict(cat_i=cat_i, cat=cat, q_i=q_i, entry=entry, repeat=repeat, meta_id=state.meta_id,
+                             file=file, delta=delta, name_suffix=delta_tag(delta) if delta else None,
+                             known=known, bulk=bulk, parse_workers=parse_workers, chunk_size=chunk_size))
+    logger.info(f'Importing {len(jobs)} sub-queries with {workers} workers.')
+
+    stats = {table: TableStats() for table in TABLES}
+
+    def done(job: dict, job_stats: dict[str, TableStats]):
+        for table, table_stats in job_stats.items():
+            stats[table].add(table_stats)
+        state.done.append(job['entry']['qid'])
+        state.save(file_state)
+        logger.info(f'Done with {job["cat"]} {job["entry"]["qid"]} ({len(state.done)} of {len(entries)}).')
+
+    start = time.perf_counter()
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(import_qid, **job): job for job in jobs}
+            for future in as_completed(futures):
+                done(futures[future], future.result())
+    else:
+        for job in jobs:
+            done(job, import_qid(**job))
+
+    with db_engine.session() as session:  # type: Session
+        # `repeat` of the query annotations is the ordinal of the sub-query per tweet (1..n)
+        logger.info(f'Renumbered {renumber_tech(session, state.meta_id):,} query annotations.')
+
+    if implicit and state.threads_done:
+        logger.info('Skipping thread tweets, which were imported already.')
+    elif implicit and not (TARGET_DIR / 'threads.sqlite').exists():
+        logger.warning(f'Skipping thread tweets, there is no thread store in {TARGET_DIR}')
+    elif implicit:
+        # Thread tweets are imported once after all explicit tweets, so that those are only linked and not loaded again.
+        # Deltas only link the conversations that were found by the refresh.
+        conv_ids = None
+        if delta is not None:
+            conv_ids = {entry['qid']: read_ids(TARGET_DIR / f'{delta_name(entry["qid"], delta)}_conversations.txt')
+                        for _, _, _, entry in entries}
+        thread_store = ThreadStore(TARGET_DIR)
+        num_total, num_done = thread_store.num_conversations()
+        logger.info(f'Importing thread tweets of {num_done:,} of {num_total:,} conversations.')
+        thread_stats = import_threads(thread_store, [entry['qid'] for _, _, _, entry in entries],
+                                      delta=delta, conv_ids=conv_ids, bulk=bulk)
+        thread_store.close()
+        for table, table_stats in thread_stats.items():
+            stats[table].add(table_stats)
+        state.threads_done = True
+        state.save(file_state)
+
+    duration = time.perf_counter() - start
+    log_stats(stats)
+    logger.info(f'Imported {stats["m2m_import_item"].rows:,} tweets in {duration:.1f}s '
+                f'({stats["m2m_import_item"].rows / max(duration, 1e-9):,.0f} tweets/s)')
 
     with db_engine.session() as session:  # type: Session
-        for cat_i, (cat, sub_queries) in enumerate(queries.items()):
-            logger.info(f'Uploading data for {cat} with {len(sub_queries)} sub-queries.')
-            for q_i, entry in enumerate(sub_queries):
-                logger.info(f'Uploading tweets for {cat} {entry["qid"]}')
-                import_id = str(uuid.uuid4())
-                import_orm = Import(import_id=import_id,
-                                    project_id=settings.PROJECT_ID,
-                                    type='script',
-                                    user_id=settings.USER_ID,
-                                    name=f'{cat} ({entry["qid"]})',
-                                    description=f'Subquery *{entry["qid"]}* for *{cat}* '
-                                                f'with query `{entry["query"]} -is:retweet lang:en`')
-
-                session.add(import_orm)
-                session.commit()
-
-                for file, itype in [
-                    ((TARGET_DIR / f'{entry["qid"]}_explicit.jsonl').resolve(), M2MImportItemType.explicit),
-                    # ((TARGET_DIR / f'{entry["qid"]}_implicit.jsonl').resolve(), M2MImportItemType.implicit)
-                ]:
-                    logger.info(f'Preparing import of tweets from file {file}')
-
-                    batch_tweets = []
-                    batch_m2m = []
-                    existing = 0
-                    with open(file, 'r') as f_in:
-                        for line in f_in:
-                            tweet_raw = TwitterItemModel.parse_raw(line)
-
-                            if tweet_raw.twitter_id in twitter2nacsos_id:
-                                nacsos_tweet_id = twitter2nacsos_id[tweet_raw.twitter_id]
-                                existing +=1
-                            else:
-                                nacsos_tweet_id = str(uuid.uuid4())
-                                twitter2nacsos_id[tweet_raw.twitter_id] = nacsos_tweet_id
-
-                                orm_tweet = TwitterItem(**tweet_raw.dict())
-                                orm_tweet.item_id = nacsos_tweet_id
-                                orm_tweet.project_id = settings.PROJECT_ID
-
-                                batch_tweets.append(orm_tweet)
-                                # session.add(orm_tweet)
-                                # session.commit()
-
-                            orm_m2m_i2i = M2MImportItem(item_id=nacsos_tweet_id,
-                                                        import_id=import_id,
-                                                        type='explicit')
-                            batch_m2m.append(orm_m2m_i2i)
-                            # session.add(orm_m2m_i2i)
-                            # session.commit()
-
-                            annotations[tweet_raw.twitter_id].append(entry['qid'])
-
-                    logger.info(f'Gathered {len(batch_tweets)} tweets for insertion '
-                                f'and skipping {existing} already existing tweets.')
-                    logger.info('Bulk-inserting tweets...')
-                    session.add_all(batch_tweets)
-                    session.flush()
-                    session.commit()
-
-                    logger.info('Bulk-inserting m2m relations...')
-                    session.add_all(batch_m2m)
-                    session.flush()
-                    session.commit()
-
-                    logger.info('Done with this query.')
-
-
-
-        # Create annotation scheme to annotate categories
-        labels = [
-            AnnotationSchemeLabel(
-                name='Technology',
-                key='tech',
-                hint=None,
-                max_repeat=40,
-                required=True,
-                kind='single',
-                choices=[
-                    AnnotationSchemeLabelChoice(
-                        name=cat,
-                        value=cat_i,
-                        children=[
-                            AnnotationSchemeLabel(
-                                name=f'Subquery for "{cat}"',
-                                key=f'sub_{cat_i}',
-                                max_repeat=40,
-                                required=True,
-                                kind='single',
-                                choices=[
-                                    AnnotationSchemeLabelChoice(
-                                        name=query['qid'],
-                                        hint=query['query'],
-                                        value=q_i
-                                    ).dict()
-                                    for q_i, query in enumerate(sub_queries)
-                                ]
-                            ).dict()
-                        ]
-                    ).dict()
-                    for cat_i, (cat, sub_queries) in enumerate(queries.items())
-                ]
-            ).dict()
-        ]
-
-        scheme_id = str(uuid.uuid4())
-        logger.info(f'Creating annotation scheme with id: {scheme_id}')
-        scheme = AnnotationScheme(annotation_scheme_id=scheme_id,
-                                  project_id=settings.PROJECT_ID,
-                                  name='CDR Technologies',
-                                  description='CDR technologies (annotated by respective queries)',
-                                  labels=labels)
-        session.add(scheme)
-        session.commit()
-
-        meta_id = str(uuid.uuid4())
-        logger.info(f'Creating metadata item for bot annotations with id {meta_id}')
-        meta = BotAnnotationMetaData(
-            bot_annotation_metadata_id=meta_id,
-            name='Query annotations',
-            kind='SCRIPT',
-            project_id=settings.PROJECT_ID,
-            annotation_scheme_id=scheme_id
-        )
-        session.add(meta)
-        session.commit()
-
-        batch_parents = []
-        batch_children = []
-
-        logger.info(f'Adding annotations for {len(annotations)} tweets')
-        for tweet_id, sub_queries in annotations.items():
-            for repeat, sub_query in enumerate(sub_queries, start=1):
-                cat_i = quid2cati[sub_query]
-                q_i = quid2qi[sub_query]
-
-                parent_id = str(uuid.uuid4())
-                anno = BotAnnotation(
-                    bot_annotation_id=parent_id,
-                    bot_annotation_metadata_id=meta_id,
-                    item_id=twitter2nacsos_id[tweet_id],
-                    parent=None,
-                    key='tech',
-                    repeat=repeat,
-                    value_int=cat_i
-                )
-                # session.add(anno)
-                # session.commit()
-                batch_parents.append(anno)
-
-                sub_anno = BotAnnotation(
-                    bot_annotation_id=str(uuid.uuid4()),
-                    bot_annotation_metadata_id=meta_id,
-                    item_id=twitter2nacsos_id[tweet_id],
-                    parent=parent_id,
-                    key=f'cat_{cat_i}',
-                    repeat=1,
-                    value_int=q_i
-                )
-                # session.add(sub_anno)
-                # session.commit()
-                batch_children.append(sub_anno)
-
-        session.add_all(batch_parents)
-        session.flush()
-        session.commit()
-
-        session.add_all(batch_children)
-        session.flush()
-        session.commit()
+        # Typed user profiles from the normalised user store; profiles embedded in tweets of older imports
+        # are extracted once with `python -m common.users`
+        import_profiles(session, TARGET_DIR, settings.PROJECT_ID)
+
+
+if __name__ == '__main__':
+    typer.run(main)
 
 # DELETE
 # FROM m2m_import_item
@@ -2,116 +2,211 @@ import logging
 import uuid
 from pathlib import Path
 
+import typer
 from sqlalchemy import text
 from sqlalchemy.orm import Session
 
 from nacsos_data.db import DatabaseEngine
 from nacsos_data.db.schemas.annotations import AnnotationScheme
 from nacsos_data.models.annotations import AnnotationSchemeLabel, AnnotationSchemeLabelChoice
-from nacsos_data.db.schemas.bot_annotations import BotAnnotationMetaData, BotAnnotation
+from nacsos_data.db.schemas.bot_annotations import BotAnnotationMetaData
 
 from common.models import Classifier
 from common.config import settings
+from common.refresh import DELTA_FILTER, delta_params
+from common.batches import key_ranges, ensure_annotation_index
+from common.classify import HEADS, FIRST_STAGE_FILE, ClassifyTask, scheme_heads, unannotated_filter
+from common.inference_pool import run_pool, calibrate
+from common.pipelined import log_times
+from common.work_queue import create_queue, queue_config, queue_progress, run_worker
 
 BATCH_SIZE = 500
-MODEL = 'cardiffnlp/twitter-roberta-base-sentiment-latest'
-MODEL_PATH = Path(f'{settings.DATA_MODELS}') / 'cardiff_latest'
+QUEUE_SIZE = 2  # batches that may wait between the reader, the classifier, and the writer
 
-if __name__ == '__main__':
+
+def main(delta: str | None = None,  # only classify tweets from the delta of this incremental refresh
+         meta_id: str | None = None,  # add annotations to this existing metadata instead of a new scheme
+         unannotated: bool = False,  # only classify tweets without annotations of `meta_id` yet (implied by `delta`)
+         heads: str | None = None,  # labels to annotate (see HEADS), by default all (in the scheme of `meta_id`)
+         backend: str = 'torch',  # inference backend: torch, onnx, or onnx-int8 (see common.models.Classifier)
+         num_threads: int | None = None,  # threads used by the inference backend (per worker)
+         cache: bool = True,  # reuse scores of identical (preprocessed) texts, see common.inference_cache
+         cascade: bool = False,  # only classify tweets with the full model that the first stage is unsure about
+         cascade_threshold: float = 0.9,  # confidence of the first stage below which tweets are escalated
+         first_stage_file: str | None = None,  # first stage of the cascade (trained with common.cascade)
+         workers: int = 1,  # inference processes, each pinned to `num_threads` cores (see common.inference_pool)
+         calibrate_pool: bool = False,  # choose workers × threads with a short calibration run instead
+         max_pool_workers: int | None = None,  # most workers the calibration tries
+         worker_memory_gb: float = 2.,  # memory of one worker with its models, caps the workers the calibration tries
+         calibration_size: int = 1000,  # tweets classified by each worker and configuration during calibration
+         range_size: int = 20000,  # tweets per job of a worker (or unit of the work queue)
+         queue: str | None = None,  # work on units of this work queue (see common.work_queue), from any number of hosts
+         prepare: bool = False,  # only create the metadata and the work queue `queue` for the tweets (of the `delta`)
+         lease_seconds: float = 600.):  # units of workers that stopped renewing their lease for this long are retried
     logging.basicConfig(format='%(asctime)s [%(levelname)s] %(name)s: %(message)s', level=logging.WARNING)
     logger = logging.getLogger('classify')
     logger.setLevel('DEBUG')
+    logging.getLogger('pipelined').setLevel('DEBUG')
+    logging.getLogger('inference-cache').setLevel('DEBUG')
+    logging.getLogger('inference-pool').setLevel('DEBUG')
+    logging.getLogger('models').setLevel('DEBUG')
+    logging.getLogger('work-queue').setLevel('DEBUG')
 
     db_engine = DatabaseEngine(host=settings.HOST, port=settings.PORT,
                                user=settings.USER, password=settings.PASSWORD,
                                database=settings.DATABASE)
     logger.info(f'Connecting to database {db_engine._connection_str}')
 
-    logger.info(f'Loading model "{MODEL}" (caching at {MODEL_PATH})')
-    classifier = Classifier(hf_name=MODEL,
-                            cache_dir=MODEL_PATH)
-    classifier.load()
+    if queue is not None and not prepare:
+        # workers take what to classify from the queue, so all units end up in the same metadata
+        with db_engine.session() as session:  # type: Session
+            config = queue_config(session, queue)
+        meta_id, heads, delta = config['meta_id'], config['heads'], config['delta']
+        # queues from before these options existed
+        unannotated = config.get('unannotated', False)
+        cascade_threshold = config.get('cascade_threshold')
+        cascade = cascade_threshold is not None
+
+    if meta_id is None:
+        head_keys = (heads or ','.join(HEADS)).split(',')
+    else:
+        # annotations of an existing metadata item have to fit its scheme (e.g. only `senti` for older runs)
+        with db_engine.session() as session:  # type: Session
+            in_scheme = scheme_heads(session, meta_id)
+        head_keys = [key for key in in_scheme if key in HEADS] if heads is None else heads.split(',')
+        if not_in_scheme := [key for key in head_keys if key not in in_scheme]:
+            raise ValueError(f'Heads {not_in_scheme} are not in the scheme of {meta_id}, which has {in_scheme}.')
+    if unknown := [key for key in head_keys if key not in HEADS]:
+        raise ValueError(f'Unknown heads {unknown}, available are {list(HEADS)}.')
+    logger.info(f'Classifying {", ".join(HEADS[key][0] for key in head_keys)}.')
+
+    item_filter = '' if delta is None else f'AND {DELTA_FILTER} '
+    filter_params = {} if delta is None else delta_params(delta)
+    if delta is not None and meta_id is not None and not unannotated:
+        # tweets of the delta that were imported before (e.g. for another sub-query) are annotated already
+        logger.info(f'Only classifying tweets of delta {delta} without annotations of {meta_id}.')
+        unannotated = True
+    if unannotated:
+        if meta_id is None:
+            raise ValueError('Only classifying unannotated tweets needs the `meta_id` of an earlier run.')
+        missing_filter, missing_params = unannotated_filter(meta_id, head_keys)
+        item_filter += missing_filter
+        filter_params = {**filter_params, **missing_params}
 
     with db_engine.session() as session:  # type: Session
+        if unannotated:
+            ensure_annotation_index(session)
         NUM_TWEETS = session.execute(text("SELECT count(1) "
                                           "FROM item "
-                                          "WHERE project_id = :project_id;"),
-                                     {'project_id': settings.PROJECT_ID}).scalar()
+                                          "WHERE project_id = :project_id "
+                                          f"{item_filter};"),
+                                     {'project_id': settings.PROJECT_ID, **filter_params}).scalar()
         logger.info(f'Found {NUM_TWEETS} to classify, going to process them in batches of {BATCH_SIZE}')
 
-        label_map = {
-            'negative': 0,
-            'neutral': 1,
-            'positive': 2
-        }
-
-        scheme_id = str(uuid.uuid4())
-        logger.info(f'Creating annotation scheme with id: {scheme_id}')
-        scheme = AnnotationScheme(annotation_scheme_id=scheme_id,
-                                  project_id=settings.PROJECT_ID,
-                                  name='Sentiment and Emotions',
-                                  description='Sentiments and emotions',
-                                  labels=[
-                                      AnnotationSchemeLabel(
-                                          name='Sentiment',
-                                          key='senti',
-                                          hint=None,
-                                          max_repeat=3,
-                                          required=True,
-                                          kind='single',
-                                          choices=[
-                                              AnnotationSchemeLabelChoice(name=key, value=value).dict()
-                                              for key, value in label_map.items()
-                                          ]
-                                      ).dict(),
-                                      # FIXME add emotion label
-                                  ])
-        session.add(scheme)
-        session.commit()
-
-        meta_id = str(uuid.uuid4())
-        logger.info(f'Creating metadata item for bot annotations with id {meta_id}')
-        meta = BotAnnotationMetaData(
-            bot_annotation_metadata_id=meta_id,
-            name=f'Classification with {MODEL}',
-            kind='SCRIPT',
-            project_id=settings.PROJECT_ID,
-            annotation_scheme_id=scheme_id
-        )
-        session.add(meta)
-        session.commit()
-
-        for batch_from in range(0, NUM_TWEETS, BATCH_SIZE):
-            logger.info(f'Fetching batch with offset {batch_from}.')
-            tweets = session.execute(text("SELECT item_id, text "
-                                          "FROM item "
-                                          "WHERE project_id = :project_id "
-                                          "ORDER BY item_id "
-                                          "OFFSET :batch_start LIMIT :batch_size;"),
-                                     {
-                                         'project_id': settings.PROJECT_ID,
-                                         'batch_size': BATCH_SIZE,
-                                         'batch_start': batch_from
-                                     }).mappings().all()
-
-            texts = classifier.preprocess([tweet['text'] for tweet in tweets])
-            output = classifier.classify(texts, return_all_scores=True)
-
-            annotations = [
-                BotAnnotation(
-                    bot_annotation_id=str(uuid.uuid4()),
-                    bot_annotation_metadata_id=meta_id,
-                    item_id=str(tweet['item_id']),
-                    parent=None,
-                    key='senti',
-                    repeat=repeat,
-                    value_int=label_map[label],
-                    confidence=score
-                )
-                for tweet, res in zip(tweets, output)
-                for repeat, (label, score) in enumerate(sorted(res.items(), key=lambda e: e[1], reverse=True), start=1)
-            ]
-
-            session.add_all(annotations)
-            session.flush()
+        if meta_id is None:
+            # the labels of the scheme come from the configs of the models
+            labels = {}
+            for key in head_keys:
+                _, model, model_path = HEADS[key]
+                labels[key] = Classifier(hf_name=model, cache_dir=model_path).load_config().labels
+
+            scheme_id = str(uuid.uuid4())
+            logger.info(f'Creating annotation scheme with id: {scheme_id}')
+            scheme = AnnotationScheme(annotation_scheme_id=scheme_id,
+                                      project_id=settings.PROJECT_ID,
+                                      name='Sentiment and Emotions',
+                                      description='Sentiments and emotions',
+                                      labels=[
+                                          AnnotationSchemeLabel(
+                                              name=HEADS[key][0],
+                                              key=key,
+                                              hint=None,
+                                              max_repeat=len(head_labels),
+                                              required=True,
+                                              kind='single',
+                                              choices=[
+                                                  AnnotationSchemeLabelChoice(name=label, value=value).dict()
+                                                  for label, value in head_labels.items()
+                                              ]
+                                          ).dict()
+                                          for key, head_labels in labels.items()
+                                      ])
+            session.add(scheme)
+            session.commit()
+
+            meta_id = str(uuid.uuid4())
+            logger.info(f'Creating metadata item for bot annotations with id {meta_id}')
+            meta = BotAnnotationMetaData(
+                bot_annotation_metadata_id=meta_id,
+                name=f'Classification with {", ".join(HEADS[key][1] for key in labels)}'
+                     + ('' if backend == 'torch' else f' ({backend})')
+                     + (f' (cascade at {cascade_threshold})' if cascade else ''),
+                kind='SCRIPT',
+                project_id=settings.PROJECT_ID,
+                annotation_scheme_id=scheme_id
+            )
+            session.add(meta)
             session.commit()
+        else:
+            logger.info(f'Adding annotations to existing metadata item {meta_id}')
+
+    task = ClassifyTask(meta_id=meta_id,
+                        heads=head_keys,
+                        item_filter=item_filter,
+                        filter_params=filter_params,
+                        batch_size=BATCH_SIZE,
+                        queue_size=QUEUE_SIZE,
+                        backend=backend,
+                        cache=cache,
+                        cascade_threshold=cascade_threshold if cascade else None,
+                        first_stage_file=FIRST_STAGE_FILE if first_stage_file is None else Path(first_stage_file))
+
+    if queue is not None:
+        if prepare:
+            with db_engine.session() as session:  # type: Session
+                ranges = key_ranges(session, task.query, ('item_id', 'item.item_id'),
+                                    params={**filter_params, 'project_id': settings.PROJECT_ID}, step=range_size)
+                num_units = create_queue(session, queue, {'meta_id': meta_id, 'heads': ','.join(head_keys),
+                                                          'delta': delta, 'unannotated': unannotated,
+                                                          'cascade_threshold': task.cascade_threshold}, ranges)
+            logger.info(f'Created work queue "{queue}" with {num_units:,} units for metadata {meta_id}.')
+        else:
+            task.setup(num_threads=num_threads)
+            with db_engine.session() as session:  # type: Session
+                logger.info(f'Working on queue "{queue}" ({queue_progress(session, queue)}).')
+            num_done = run_worker(db_engine, queue, task, lease_seconds=lease_seconds)
+            logger.info(f'Classified {num_done:,} tweets.')
+            log_times(task.times)
+            task.close()
+        return
+
+    if calibrate_pool or workers > 1:
+        task.prepare()
+
+    if calibrate_pool:
+        with db_engine.session() as session:  # type: Session
+            texts = [row['text'] for row in session.execute(text(f'{task.query}LIMIT :limit;'),
+                                                            {**filter_params, 'project_id': settings.PROJECT_ID,
+                                                             'limit': calibration_size}).mappings()]
+        workers, num_threads = calibrate(task, texts, max_workers=max_pool_workers,
+                                         worker_memory=worker_memory_gb * 2 ** 30, batch_size=BATCH_SIZE)
+
+    if workers > 1:
+        with db_engine.session() as session:  # type: Session
+            ranges = key_ranges(session, task.query, ('item_id', 'item.item_id'),
+                                params={**filter_params, 'project_id': settings.PROJECT_ID}, step=range_size)
+        logger.info(f'Classifying {len(ranges):,} ranges of item ids with {workers} workers '
+                    f'× {num_threads or 1} threads.')
+        stats = run_pool(task, ranges, num_workers=workers, threads=num_threads or 1)
+        logger.info(f'Classified {stats.items:,} tweets in {stats.seconds:.1f}s '
+                    f'({stats.items_per_second:,.1f} tweets/s), per worker: {stats.per_worker}')
+    else:
+        task.setup(num_threads=num_threads)
+        num_done = task.run()
+        logger.info(f'Classified {num_done:,} of {NUM_TWEETS:,} tweets.')
+        log_times(task.times)
+        task.close()
+
+
+if __name__ == '__main__':
+    typer.run(main)
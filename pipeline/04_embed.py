@@ -8,8 +8,13 @@ from sqlalchemy.orm import Session
 from nacsos_data.db import DatabaseEngine
 
 from common.models import Embedder
+from common.inference_cache import InferenceCache
 from common.config import settings
 from common.pyw_hnsw import Index
+from common.refresh import DELTA_FILTER, delta_params
+from common.batches import iter_batches, ensure_created_at_index, key_ranges
+from common.embed import EmbedTask, merge_units
+from common.work_queue import create_queue, queue_config, queue_progress, done_units, run_worker
 
 
 def main(model: str = 'all-MiniLM-L6-v2',
@@ -21,12 +26,22 @@ def main(model: str = 'all-MiniLM-L6-v2',
          ef_const: int = 200,
          M_const: int = 64,
          seed: int = 43,
+         delta: str | None = None,  # only embed tweets from this incremental refresh and add them to the index
+         cache: bool = True,  # reuse vectors of identical (preprocessed) texts, see common.inference_cache
+         queue: str | None = None,  # work on units of this work queue (see common.work_queue), from any number of hosts
+         prepare: bool = False,  # only create the work queue `queue` for the tweets (of the `delta`)
+         merge: bool = False,  # only build the index from the units of the finished work queue `queue`
+         range_size: int = 20000,  # tweets per unit of the work queue
+         units_dir: str | None = None,  # vectors of the units, has to be shared by the hosts of all workers for `merge`
+         lease_seconds: float = 600.,  # units of workers that stopped renewing their lease for this long are retried
          log_level: str = 'DEBUG',
          default_log_level: str = 'WARNING'
          ):
     logging.basicConfig(format='%(asctime)s [%(levelname)s] %(name)s: %(message)s', level=default_log_level)
     logger = logging.getLogger('embed')
     logger.setLevel(log_level)
+    logging.getLogger('inference-cache').setLevel(log_level)
+    logging.getLogger('work-queue').setLevel(log_level)
 
     if model_path is None:
         model_path = Path(settings.DATA_MODELS) / 'minilm_l6_v2'
@@ -45,37 +60,103 @@ def main(model: str = 'all-MiniLM-L6-v2',
                                database=settings.DATABASE)
     logger.info(f'Connecting to database {db_engine._connection_str}')
 
+    if queue is not None:
+        units_dir = Path(f'{target_file}_units') / queue if units_dir is None else Path(units_dir)
+        if not prepare:
+            # workers take the model and the delta from the queue, so all units are embedded the same way
+            with db_engine.session() as session:  # type: Session
+                config = queue_config(session, queue)
+            model, delta = config['model'], config['delta']
+        task = EmbedTask(model=model, model_path=model_path, units_dir=units_dir,
+                         item_filter='' if delta is None else f'AND {DELTA_FILTER} ',
+                         filter_params={} if delta is None else delta_params(delta),
+                         batch_size=batch_size, cache=cache)
+
+        if prepare:
+            with db_engine.session() as session:  # type: Session
+                ranges = key_ranges(session, task.query, ('item_id', 'item.item_id'),
+                                    params={**task.filter_params, 'project_id': settings.PROJECT_ID},
+                                    step=range_size)
+                num_units = create_queue(session, queue, {'model': model, 'delta': delta}, ranges)
+            logger.info(f'Created work queue "{queue}" with {num_units:,} units.')
+        elif merge:
+            with db_engine.session() as session:  # type: Session
+                progress = queue_progress(session, queue)
+                units = done_units(session, queue)
+            if set(progress.keys()) != {'done'}:
+                raise RuntimeError(f'Work queue "{queue}" is not finished yet: {progress}')
+            # exactly the files of the finished units, which all have to be here
+            unit_files = [(task.unit_file(lower), unit_items) for _, lower, _, unit_items in units]
+            num_items = sum(unit_items for _, unit_items in unit_files)
+            logger.info(f'Building index from {num_items:,} vectors in {units_dir}')
+
+            index = Index(space=space, dim=dims)
+            known: set[str] = set()
+            if delta is None:
+                index.init_index(max_elements=num_items, ef_construction=ef_const, M=M_const, random_seed=seed)
+            else:
+                index.load_index(target_file)
+                index.resize_index(index.cur_ind + num_items)
+                known = set(index.dict_labels.values())
+            num_added = merge_units(unit_files, index, known)
+            logger.info(f'Added {num_added:,} vectors, saving index.')
+            index.save_index(target_file)
+        else:
+            task.setup()
+            with db_engine.session() as session:  # type: Session
+                logger.info(f'Working on queue "{queue}" ({queue_progress(session, queue)}).')
+            num_done = run_worker(db_engine, queue, task, lease_seconds=lease_seconds)
+            logger.info(f'Embedded {num_done:,} tweets.')
+            task.close()
+        return
+
     logger.info(f'Loading model "{model}" (caching at {model_path})')
-    embedder = Embedder(hf_name=model, cache_dir=model_path)
+    inference_cache = InferenceCache(Path(settings.DATA_MODELS)) if cache else None
+    embedder = Embedder(hf_name=model, cache_dir=model_path, cache=inference_cache)
     embedder.load()
 
+    item_filter = '' if delta is None else f'AND {DELTA_FILTER} '
+    filter_params = {} if delta is None else delta_params(delta)
+
     with db_engine.session() as session:  # type: Session
         NUM_TWEETS = session.execute(text("SELECT count(1) "
                                           "FROM item "
-                                          "WHERE project_id = :project_id;"),
-                                     {'project_id': settings.PROJECT_ID}).scalar()
+                                          "WHERE project_id = :project_id "
+                                          f"{item_filter};"),
+                                     {'project_id': settings.PROJECT_ID, **filter_params}).scalar()
         logger.info(f'Found {NUM_TWEETS} to embed, going to process them in batches of {batch_size}')
 
         logger.info(f'Preparing hnswlib index')
 
         index = Index(space=space, dim=dims)
-        index.init_index(max_elements=NUM_TWEETS, ef_construction=ef_const, M=M_const, random_seed=seed)
-
-        for batch_from in range(0, NUM_TWEETS, batch_size):
-            logger.info(f'Fetching batch with offset {batch_from}.')
-            tweets = session.execute(text("""
-                                          SELECT item.item_id, item.text
-                                          FROM item
-                                              JOIN twitter_item ti on item.item_id = ti.item_id
-                                          WHERE item.project_id = :project_id
-                                          ORDER BY ti.created_at
-                                          OFFSET :batch_start LIMIT :batch_size;
-                                          """),
-                                     {
-                                         'project_id': settings.PROJECT_ID,
-                                         'batch_size': batch_size,
-                                         'batch_start': batch_from
-                                     }).mappings().all()
+        known: set[str] = set()
+        if delta is None:
+            index.init_index(max_elements=NUM_TWEETS, ef_construction=ef_const, M=M_const, random_seed=seed)
+        else:
+            index.load_index(target_file)
+            logger.info(f'Extending existing index with {index.cur_ind:,} items by {NUM_TWEETS:,} items.')
+            index.resize_index(index.cur_ind + NUM_TWEETS)
+            # tweets of the delta that were already imported for another sub-query are in the index already
+            known = set(index.dict_labels.values())
+
+        ensure_created_at_index(session)
+        num_done = 0
+        for tweets in iter_batches(session,
+                                   query=f"""
+                                         SELECT item.item_id, item.text, ti.created_at
+                                         FROM item
+                                             JOIN twitter_item ti on item.item_id = ti.item_id
+                                         WHERE item.project_id = :project_id
+                                         {item_filter}
+                                         """,
+                                   keys=[('created_at', 'ti.created_at'), ('item_id', 'ti.item_id')],
+                                   params={**filter_params, 'project_id': settings.PROJECT_ID},
+                                   batch_size=batch_size):
+            num_done += len(tweets)
+            logger.info(f'Fetched batch of {len(tweets)} tweets ({num_done:,} of {NUM_TWEETS:,}).')
+            tweets = [tweet for tweet in tweets if str(tweet['item_id']) not in known]
+            if len(tweets) == 0:
+                continue
 
             texts = embedder.preprocess([tweet['text'] for tweet in tweets])
             uuids = [str(tweet['item_id']) for tweet in tweets]
@@ -87,5 +168,10 @@ def main(model: str = 'all-MiniLM-L6-v2',
         logger.info('Saving index.')
         index.save_index(target_file)
 
+    if inference_cache is not None:
+        inference_cache.report()
+        inference_cache.close()
+
+
 if __name__ == "__main__":
     typer.run(main)